@@ -0,0 +1,208 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+import json
+import platform
+import statistics
+import sys
+import timeit
+
+
+class Scale:
+    """ Size of a synthetic keyboard: keys, layers, encoders and macros/tap dances/combos/key overrides """
+
+    def __init__(self, name, keys, layers, encoders, entries):
+        self.name = name
+        self.keys = keys
+        self.layers = layers
+        self.encoders = encoders
+        self.entries = entries
+
+    def to_json(self):
+        return {"keys": self.keys, "layers": self.layers, "encoders": self.encoders, "entries": self.entries}
+
+
+SCALES = [
+    Scale("small", keys=60, layers=4, encoders=1, entries=16),
+    Scale("medium", keys=120, layers=16, encoders=4, entries=64),
+    Scale("large", keys=300, layers=32, encoders=8, entries=255),
+]
+
+
+class Benchmark:
+
+    def __init__(self, name, fn, gui):
+        self.name = name
+        self.fn = fn
+        self.gui = gui
+
+
+BENCHMARKS = []
+
+
+def benchmark(name, gui=False):
+    """
+    Registers a benchmark. The decorated function gets a Scale, does its setup and returns the
+    callable being timed; setup is not part of the measurement.
+
+    It can also return (callable, Counters): what the counters count during one extra, untimed
+    call is reported along with the time, see Counters.
+    """
+    def wrap(fn):
+        BENCHMARKS.append(Benchmark(name, fn, gui))
+        return fn
+    return wrap
+
+
+class Counters(dict):
+    """
+    Counts of work done by a benchmark, e.g. how many key widgets one keystroke re-renders. Unlike
+    times they are exact, so any increase over the baseline is reported by compare().
+    """
+
+    # only counting during collect(), so that the counting isn't part of the timings
+    enabled = False
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self[name] = self.get(name, 0) + n
+
+    def wrap(self, owner, attr, name=None, weight=None):
+        """ Counts the calls of owner.attr under `name`, each adding weight(*args) if given """
+        fn = getattr(owner, attr)
+        name = name or attr
+
+        def counted(*args, **kwargs):
+            if self.enabled:
+                self.count(name, 1 if weight is None else weight(*args, **kwargs))
+            return fn(*args, **kwargs)
+        setattr(owner, attr, counted)
+
+    def collect(self, run):
+        """ The counts of one call of `run` """
+        self.clear()
+        self.enabled = True
+        try:
+            run()
+        finally:
+            self.enabled = False
+        result = dict(self)
+        self.clear()
+        return result
+
+
+def measure(run, repeat=5, min_time=0.2):
+    """ Seconds per call of `run`: the best and median of `repeat` rounds lasting at least `min_time` each """
+    timer = timeit.Timer(run)
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= min_time or number >= 1 << 20:
+            break
+        number = max(number * 2, int(number * min_time / max(elapsed, 1e-9)))
+    rounds = [elapsed] + timer.repeat(repeat - 1, number)
+    per_call = [t / number for t in rounds]
+    return {"min": min(per_call), "median": statistics.median(per_call), "number": number, "repeat": repeat}
+
+
+def result_key(name, scale):
+    return "{}[{}]".format(name, scale.name)
+
+
+def run_benchmarks(scales=SCALES, select=None, repeat=5, min_time=0.2, progress=print):
+    results = dict()
+    for bench in BENCHMARKS:
+        if select and not any(s in bench.name for s in select):
+            continue
+        for scale in scales:
+            run = bench.fn(scale)
+            counters = None
+            if isinstance(run, tuple):
+                run, counters = run
+            stats = measure(run, repeat, min_time)
+            stats["scale"] = scale.to_json()
+            if counters is not None:
+                stats["counters"] = counters.collect(run)
+            results[result_key(bench.name, scale)] = stats
+            progress("{:<40} {:>12}  {}".format(result_key(bench.name, scale), format_time(stats["min"]),
+                                                format_counters(stats.get("counters", {}))).rstrip())
+    return {
+        "version": 1,
+        "python": platform.python_version(),
+        "platform": sys.platform,
+        "results": results,
+    }
+
+
+def format_time(seconds):
+    for unit, factor in [("s", 1), ("ms", 1e3), ("us", 1e6)]:
+        if seconds * factor >= 1:
+            return "{:.2f} {}".format(seconds * factor, unit)
+    return "{:.0f} ns".format(seconds * 1e9)
+
+
+def format_counters(counters):
+    return " ".join("{}={}".format(name, value) for name, value in sorted(counters.items()))
+
+
+def save(data, path):
+    with open(path, "w") as outf:
+        json.dump(data, outf, indent=1, sort_keys=True)
+
+
+def load(path):
+    with open(path, "r") as inf:
+        return json.load(inf)
+
+
+def growth(results, keys):
+    """ How much slower the largest scale of a benchmark is than the smallest one, among `keys` """
+    times = [(results[key]["scale"]["keys"] * results[key]["scale"]["layers"], results[key]["min"]) for key in keys]
+    if len(times) < 2:
+        return None
+    times.sort()
+    return times[-1][1] / times[0][1] if times[0][1] > 0 else None
+
+
+def compare(baseline, current, threshold=1.25):
+    """
+    Compares results against a baseline, returns (report lines, regressions).
+
+    A benchmark regresses when its best time is more than `threshold` times the baseline, or when
+    it scales worse: its largest/smallest ratio grew more than `threshold` times. The latter does
+    not depend on the speed of the machine the baseline was recorded on, so it catches scaling
+    cliffs even when absolute times aren't comparable.
+    Counters regress when they are higher than in the baseline at all.
+    """
+    lines = []
+    regressions = []
+    base = baseline["results"]
+    for key, r in sorted(current["results"].items()):
+        if key not in base:
+            lines.append("{:<40} {:>12}   (new)".format(key, format_time(r["min"])))
+            continue
+        ratio = r["min"] / base[key]["min"] if base[key]["min"] > 0 else 1
+        flag = ""
+        if ratio > threshold:
+            flag = "REGRESSION"
+            regressions.append(key)
+        elif ratio < 1 / threshold:
+            flag = "faster"
+        lines.append("{:<40} {:>12} {:>12} {:>7.2f}x  {}".format(
+            key, format_time(base[key]["min"]), format_time(r["min"]), ratio, flag).rstrip())
+
+        for name, value in sorted(r.get("counters", {}).items()):
+            before = base[key].get("counters", {}).get(name)
+            if before is not None and value > before:
+                regressions.append("{} {}".format(key, name))
+                lines.append("{:<40} {} {} -> {}  REGRESSION".format(key, name, before, value))
+
+    for name in sorted({key.split("[")[0] for key in current["results"]}):
+        # only the scales present in both runs are comparable
+        keys = [key for key in current["results"] if key.split("[")[0] == name and key in base]
+        old, new = growth(base, keys), growth(current["results"], keys)
+        if old is None or new is None:
+            continue
+        if new / old > threshold:
+            regressions.append("{} scaling".format(name))
+            lines.append("{:<40} scales {:.1f}x from smallest to largest, was {:.1f}x  REGRESSION".format(
+                name, new, old))
+    return lines, regressions
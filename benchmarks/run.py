@@ -0,0 +1,70 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+"""
+Scaling benchmarks on synthetic keyboards of increasing size (keys, layers, encoders and
+macros/tap dances/combos/key overrides), run against the software keyboard emulator.
+
+    python benchmarks/run.py --compare benchmarks/baseline.json
+    python benchmarks/run.py reload macro --scale large
+    python benchmarks/run.py --save benchmarks/baseline.json
+
+With --compare the exit status is 1 when a benchmark got slower than the baseline or scales
+worse than it did, see harness.compare(). Absolute times are only comparable on the machine the
+baseline was recorded on; how each benchmark scales from the small to the large keyboard is
+comparable anywhere.
+"""
+import argparse
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "src", "main", "python"))
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from benchmarks import harness  # noqa: E402
+from benchmarks import suite  # noqa: E402,F401
+from editor.qmk_settings import QmkSettings  # noqa: E402
+
+
+class AppContext:
+
+    @staticmethod
+    def get_resource(name):
+        return os.path.join(ROOT, "src", "main", "resources", "base", name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Vial scaling benchmarks")
+    parser.add_argument("select", nargs="*", help="only run benchmarks whose name contains one of these")
+    parser.add_argument("--scale", action="append", choices=[s.name for s in harness.SCALES],
+                        help="keyboard sizes to run, all of them by default")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--min-time", type=float, default=0.2, help="minimum duration of a round in seconds")
+    parser.add_argument("--no-gui", action="store_true", help="skip benchmarks that need Qt widgets")
+    parser.add_argument("--save", metavar="JSON", help="write the results to a baseline file")
+    parser.add_argument("--compare", metavar="JSON", help="compare the results against a baseline file")
+    parser.add_argument("--threshold", type=float, default=1.25,
+                        help="slowdown ratio reported as a regression (default: %(default)s)")
+    args = parser.parse_args()
+
+    QmkSettings.initialize(AppContext())
+    if args.no_gui:
+        harness.BENCHMARKS[:] = [b for b in harness.BENCHMARKS if not b.gui]
+    scales = [s for s in harness.SCALES if not args.scale or s.name in args.scale]
+
+    results = harness.run_benchmarks(scales, args.select, args.repeat, args.min_time)
+    if args.save:
+        harness.save(results, args.save)
+
+    if args.compare:
+        lines, regressions = harness.compare(harness.load(args.compare), results, args.threshold)
+        print()
+        print("\n".join(lines))
+        if regressions:
+            print("\n{} regression(s): {}".format(len(regressions), ", ".join(regressions)))
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
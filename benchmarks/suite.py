@@ -0,0 +1,177 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+import itertools
+import struct
+
+from benchmarks.harness import Counters, benchmark
+from benchmarks.synthetic import make_emulator, make_expressions, make_keyboard, make_macros
+from keycodes.keycodes import Keycode
+from protocol.keyboard_comm import Keyboard
+
+
+@benchmark("reload")
+def bench_reload(scale):
+    emu = make_emulator(scale)
+
+    def run():
+        Keyboard(emu, usb_send=emu.usb_send).reload()
+    return run
+
+
+@benchmark("save_layout")
+def bench_save_layout(scale):
+    return make_keyboard(scale).save_layout
+
+
+@benchmark("restore_layout")
+def bench_restore_layout(scale):
+    kb = make_keyboard(scale)
+    # alternate between two different layouts so every restore has to change every key
+    layouts = itertools.cycle([make_keyboard(scale, seed=1).save_layout(), kb.save_layout()])
+
+    def run():
+        kb.restore_layout(next(layouts))
+    return run
+
+
+@benchmark("keycode_serialize")
+def bench_keycode_serialize(scale):
+    kb = make_keyboard(scale)
+    codes = list(struct.unpack(">{}H".format(len(kb.dev.keymap) // 2), kb.dev.keymap))
+
+    def run():
+        for code in codes:
+            Keycode.serialize(code)
+    return run
+
+
+@benchmark("keycode_deserialize")
+def bench_keycode_deserialize(scale):
+    kb = make_keyboard(scale)
+    names = list(kb.layout.values())
+
+    def run():
+        for name in names:
+            Keycode.deserialize(name)
+    return run
+
+
+@benchmark("any_keycode_parser")
+def bench_any_keycode_parser(scale):
+    from any_keycode import AnyKeycode, KeycodeParser
+
+    make_keyboard(scale)
+    names = AnyKeycode.get().names
+    expressions = make_expressions(scale.keys)
+
+    def run():
+        for s in expressions:
+            KeycodeParser(names).parse(s)
+    return run
+
+
+@benchmark("any_keycode_simpleeval")
+def bench_any_keycode_simpleeval(scale):
+    from any_keycode import AnyKeycode
+
+    make_keyboard(scale)
+    anykc = AnyKeycode.get()
+    expressions = make_expressions(scale.keys)
+
+    def run():
+        for s in expressions:
+            anykc.decode_simpleeval(s)
+    return run
+
+
+@benchmark("macro_serialize")
+def bench_macro_serialize(scale):
+    kb = make_keyboard(scale)
+    macros = make_macros(kb.macro_count)
+
+    def run():
+        kb.macros_serialize(macros)
+    return run
+
+
+@benchmark("macro_deserialize")
+def bench_macro_deserialize(scale):
+    kb = make_keyboard(scale)
+    data = kb.macros_serialize(make_macros(kb.macro_count))
+
+    def run():
+        kb.macros_deserialize(data)
+    return run
+
+
+def make_keyboard_widget(scale):
+    from PyQt5.QtWidgets import QApplication
+    from widgets.keyboard_widget import KeyboardWidget
+
+    if QApplication.instance() is None:
+        make_keyboard_widget.app = QApplication([])
+
+    kb = make_keyboard(scale)
+    widget = KeyboardWidget(None)
+    widget.set_keys(kb.keys, kb.encoders)
+    for w in widget.widgets:
+        if w.desc.row is not None:
+            w.setText(Keycode.label(kb.layout[(0, w.desc.row, w.desc.col)]))
+    widget.resize(widget.width, widget.height)
+    return widget
+
+
+@benchmark("keyboard_widget_paint", gui=True)
+def bench_keyboard_widget_paint(scale):
+    from PyQt5.QtGui import QPixmap
+
+    widget = make_keyboard_widget(scale)
+    pixmap = QPixmap(widget.size())
+
+    def run():
+        widget.render(pixmap)
+    return run
+
+
+@benchmark("keyboard_widget_hit_test", gui=True)
+def bench_keyboard_widget_hit_test(scale):
+    widget = make_keyboard_widget(scale)
+    points = [w.polygon.boundingRect().center() for w in widget.widgets]
+
+    def run():
+        for pos in points:
+            widget.hit_test(pos)
+    return run
+
+
+@benchmark("keymap_editor_set_key", gui=True)
+def bench_keymap_editor_set_key(scale):
+    from editor.keymap_editor import KeymapEditor
+    from editor.layout_editor import LayoutEditor
+
+    make_keyboard_widget(scale)
+    kb = make_keyboard(scale)
+    editor = KeymapEditor(LayoutEditor())
+    editor.keyboard = kb
+    editor.rebuild_layers()
+    editor.container.set_keys(kb.keys, kb.encoders)
+    editor.refresh_layer_display()
+    container = editor.container
+    container.set_active_key(container.widgets[0])
+
+    # key widgets given a new legend, and keys within the areas scheduled for a repaint
+    counters = Counters()
+    for w in container.widgets:
+        counters.wrap(w, "setText", "displayed")
+
+    def repainted(*args):
+        if not args:
+            return len(container.widgets)
+        return sum(1 for w in container.widgets if container.key_rect(w).intersects(args[0]))
+    counters.wrap(container, "update", "repainted", repainted)
+
+    codes = itertools.cycle(["KC_A", "KC_B"])
+
+    def run():
+        # a keystroke in the keycode picker: sets the selected key and moves on to the next one
+        editor.set_key(next(codes))
+    return run, counters
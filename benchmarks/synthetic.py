@@ -0,0 +1,77 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+import math
+import random
+
+from keycodes.keycodes import recreate_keyboard_keycodes
+from macro.macro_action import ActionText, ActionTap, ActionDelay
+from protocol.emulator import KeyboardEmulator
+from protocol.keyboard_comm import Keyboard
+
+# keycodes used to fill synthetic keymaps: basic keys, modifiers and a few layer/mod-tap codes
+KEYCODES = [0x04 + x for x in range(40)] + [0xE0 + x for x in range(8)] + [0x5220, 0x5221, 0x2204, 0x6129]
+
+
+def make_definition(scale, cols=20):
+    """ Vial definition with scale.keys keys on a matrix `cols` wide, and scale.encoders encoders """
+    rows = int(math.ceil(scale.keys / cols))
+    keymap = []
+    for row in range(rows):
+        keymap.append(["{},{}".format(row, col) for col in range(min(cols, scale.keys - row * cols))])
+    if scale.encoders:
+        keymap.append(["{},{}\n\n\n\n\n\n\n\n\ne".format(idx, direction)
+                       for idx in range(scale.encoders) for direction in range(2)])
+    return {"name": "Synthetic {}".format(scale.name), "matrix": {"rows": rows, "cols": cols},
+            "layouts": {"keymap": keymap}}
+
+
+def make_emulator(scale, seed=0):
+    """ Emulated keyboard of the given scale with a random keymap and entries filled in """
+    rng = random.Random(seed)
+    entries = min(scale.entries, 255)
+    emu = KeyboardEmulator(make_definition(scale), layers=scale.layers, macro_count=entries,
+                           macro_memory=min(0xFFFF, 64 * entries), tap_dance_count=entries, combo_count=entries,
+                           key_override_count=entries)
+    for x in range(0, len(emu.keymap), 2):
+        emu.keymap[x:x + 2] = rng.choice(KEYCODES).to_bytes(2, "big")
+    for layer in range(scale.layers):
+        for idx in range(scale.encoders):
+            emu.encoders[(layer, idx, 0)] = rng.choice(KEYCODES)
+            emu.encoders[(layer, idx, 1)] = rng.choice(KEYCODES)
+    for x in range(entries):
+        emu.tap_dance[x] = b"".join(rng.choice(KEYCODES).to_bytes(2, "little") for _ in range(4)) + b"\xC8\x00"
+        emu.combo[x] = b"".join(rng.choice(KEYCODES).to_bytes(2, "little") for _ in range(5))
+    return emu
+
+
+def make_keyboard(scale, seed=0):
+    emu = make_emulator(scale, seed)
+    kb = Keyboard(emu, usb_send=emu.usb_send)
+    kb.reload()
+    recreate_keyboard_keycodes(kb)
+    return kb
+
+
+def make_expressions(count, seed=0):
+    """ Keycodes written the way people type them into the "Any" keycode dialog or .vil files """
+    rng = random.Random(seed)
+    forms = ["LCTL_T(KC_{})", "LT({}, KC_{})", "LSFT(KC_{})", "MT(MOD_LCTL | MOD_LALT, KC_{})", "C(S(KC_{}))",
+             "KC_{} | 0x100"]
+    expressions = []
+    for x in range(count):
+        form = rng.choice(forms)
+        if form.startswith("LT("):
+            expressions.append(form.format(rng.randrange(4), rng.choice("ABCDEFGH")))
+        else:
+            expressions.append(form.format(rng.choice("ABCDEFGH")))
+    return expressions
+
+
+def make_macros(count, seed=0):
+    rng = random.Random(seed)
+    macros = []
+    for x in range(count):
+        macros.append([ActionText("macro {}".format(x)),
+                       ActionTap([rng.choice(KEYCODES) for _ in range(3)]),
+                       ActionDelay(rng.randint(1, 1000)),
+                       ActionText("done")])
+    return macros
@@ -628,7 +628,7 @@ class Animation(BasicEditor):
 
     def valid(self):
         return (sys.platform != "emscripten") and isinstance(self.device, VialKeyboard) and \
-               (self.device.keyboard)
+               (self.device.keyboard) and self.device.keyboard.stage_loaded("amk_animation")
     
     def on_keyboard_file_changed(self):
         item = self.file_lst.currentItem()
@@ -1,11 +1,14 @@
 # SPDX-License-Identifier: GPL-2.0-or-later
-from PyQt5.QtWidgets import QVBoxLayout, QHBoxLayout, QLabel, QSlider, QDoubleSpinBox, QCheckBox, QGridLayout, QPushButton
-from PyQt5.QtCore import Qt
+from PyQt5.QtWidgets import QVBoxLayout, QHBoxLayout, QLabel, QSlider, QDoubleSpinBox, QCheckBox, QGridLayout, QPushButton, \
+    QProgressBar
+from PyQt5.QtCore import Qt, QObject, pyqtSignal
 
 from PyQt5.QtGui import QPalette
 from PyQt5.QtWidgets import QApplication
 
+from amk.protocol import AMK_BATCH_CHUNK
 from editor.basic_editor import BasicEditor
+from write_coalescer import WriteCoalescer
 from amk.widget import ClickableWidget, AmkWidget
 from widgets.square_button import SquareButton
 from util import tr
@@ -45,6 +48,12 @@ def apc_rt_display(widget, apc, rt):
     else:
         widget.masked = False
 
+class BatchNotifier(QObject):
+    """ Brings the progress of APC/RT batches running on the device I/O thread over to the GUI thread """
+    notifyProgress = pyqtSignal(int, int)
+    notifyDone = pyqtSignal()
+
+
 class ApcRt(BasicEditor):
 
     def __init__(self, layout_editor):
@@ -175,10 +184,24 @@ class ApcRt(BasicEditor):
         layout.addLayout(apc_rt_layout)
         layout.addStretch(1)
 
+        # only shown while a group write big enough to take a while is running
+        self.batch_bar = QProgressBar()
+        self.batch_bar.setMaximumWidth(300)
+        self.batch_cancel_btn = QPushButton(tr("ApcRt", "Cancel"))
+        self.batch_cancel_btn.clicked.connect(self.on_batch_cancel)
+        batch_layout = QHBoxLayout()
+        batch_layout.addStretch(1)
+        batch_layout.addWidget(self.batch_bar)
+        batch_layout.addWidget(self.batch_cancel_btn)
+        batch_layout.addStretch(1)
+        self.batch_bar.hide()
+        self.batch_cancel_btn.hide()
+
         v_layout = QVBoxLayout()
         v_layout.addWidget(w)
         v_layout.addStretch(1)
         v_layout.addLayout(layout)
+        v_layout.addLayout(batch_layout)
         v_layout.addStretch(4)
 
         self.addLayout(v_layout)
@@ -186,8 +209,17 @@ class ApcRt(BasicEditor):
         self.keyboard = None
         self.device = None
         self.current_profile = 0
+        # sliders and spin boxes write through here, so that dragging them doesn't flood the device
+        self.writes = WriteCoalescer()
+        # group writes in flight, cancelling bumps the generation they were started in
+        self.batches = 0
+        self.batch_generation = 0
+        self.notifier = BatchNotifier()
+        self.notifier.notifyProgress.connect(self.on_batch_progress)
+        self.notifier.notifyDone.connect(self.on_batch_done)
 
     def rebuild(self, device):
+        self.writes.flush()
         super().rebuild(device)
         if self.valid():
             self.keyboard = device.keyboard
@@ -199,7 +231,8 @@ class ApcRt(BasicEditor):
         # Check if vial protocol is v3 or later
         return isinstance(self.device, VialKeyboard) and \
                (self.device.keyboard and (self.device.keyboard.keyboard_type.startswith("ms") or self.device.keyboard.keyboard_type == "ec")) and \
-               ((self.device.keyboard.cols // 8 + 1) * self.device.keyboard.rows <= 28)
+               ((self.device.keyboard.cols // 8 + 1) * self.device.keyboard.rows <= 28) and \
+               self.device.keyboard.stage_loaded("amk_apcrt")
 
     def reset_apcrt_widget(self):
         apc_min = AMK_APC_MIN/AMK_APCRT_SCALE_DOWN
@@ -243,9 +276,12 @@ class ApcRt(BasicEditor):
             self.keyboardWidget.update_layout()
             self.reset_apcrt_widget()
 
+            # per-key values are only loaded once the tab is activated
+            loaded = self.keyboard.amk_keys_loaded()
             for widget in self.keyboardWidget.widgets:
-                apc_rt_display(widget, self.keyboard.amk_apc[self.keyboard.amk_profile][(widget.desc.row, widget.desc.col)],
-                            self.keyboard.amk_rt[self.keyboard.amk_profile][(widget.desc.row, widget.desc.col)])
+                if loaded:
+                    apc_rt_display(widget, self.keyboard.amk_apc[self.keyboard.amk_profile][(widget.desc.row, widget.desc.col)],
+                                self.keyboard.amk_rt[self.keyboard.amk_profile][(widget.desc.row, widget.desc.col)])
 
                 widget.setOn(False)
 
@@ -273,6 +309,7 @@ class ApcRt(BasicEditor):
 
     def activate(self):
         if self.valid():
+            self.keyboard.ensure_amk_keys()
             self.reset_keyboard_widget()
             apc = None
             rt = None
@@ -393,6 +430,8 @@ class ApcRt(BasicEditor):
         """ Called when a key on the keyboard widget is clicked """
         if not self.keyboardWidget.active_keys:
             return
+        # the values shown for the key must include what is still pending for it
+        self.writes.flush()
 
         widget = list(self.keyboardWidget.active_keys.values())[0]
         row = widget.desc.row
@@ -446,7 +485,7 @@ class ApcRt(BasicEditor):
         self.apc_sld.setValue(int(self.apcrt_scale(val*100)))
         self.apc_dpb.setValue(val)
         if self.keyboardWidget.active_keys:
-            self.update_group_apc(self.keyboardWidget.active_keys, int(self.apcrt_scale(self.apc_sld.value(), False)))
+            self.submit_group("apc", self.update_group_apc, int(self.apcrt_scale(self.apc_sld.value(), False)))
             #row = self.keyboardWidget.active_key.desc.row
             #col = self.keyboardWidget.active_key.desc.col
             #self.keyboard.apply_apc(row, col, val)
@@ -461,7 +500,7 @@ class ApcRt(BasicEditor):
         val = self.apcrt_scale(self.apc_sld.value()/100.0, False)
         self.apc_dpb.setValue(val)
         if self.keyboardWidget.active_keys:
-            self.update_group_apc(self.keyboardWidget.active_keys, int(self.apcrt_scale(self.apc_sld.value(), False)))
+            self.submit_group("apc", self.update_group_apc, int(self.apcrt_scale(self.apc_sld.value(), False)))
             #row = self.keyboardWidget.active_key.desc.row
             #col = self.keyboardWidget.active_key.desc.col
             #self.keyboard.apply_apc(row, col, self.apc_sld.value())
@@ -498,7 +537,7 @@ class ApcRt(BasicEditor):
             #row = self.keyboardWidget.active_key.desc.row
             #col = self.keyboardWidget.active_key.desc.col
             #self.keyboard.apply_rt(row, col, val)
-            self.update_group_rt(self.keyboardWidget.active_keys, self.get_current_rt())
+            self.submit_group("rt", self.update_group_rt, self.get_current_rt())
         self.rt_dpb.blockSignals(False)
         self.rt_sld.blockSignals(False)
 
@@ -513,19 +552,11 @@ class ApcRt(BasicEditor):
             #row = self.keyboardWidget.active_key.desc.row
             #col = self.keyboardWidget.active_key.desc.col
             #self.keyboard.apply_rt(row, col, self.rt_sld.value())
-            self.update_group_rt(self.keyboardWidget.active_keys, self.get_current_rt())
+            self.submit_group("rt", self.update_group_rt, self.get_current_rt())
         self.rt_dpb.blockSignals(False)
         self.rt_sld.blockSignals(False)
         self.reset_active_apcrt()
     
-    def update_group_apc(self, keys, val):
-        for idx, key in keys.items():
-            #print("apply apc for key({},{}):value:{}".format(key.desc.row, key.desc.col, val))
-            if self.keyboard.amk_apcrt_version == 1:
-                self.keyboard.apply_apc(key.desc.row, key.desc.col, int(self.apcrt_scale(val)))
-            else:
-                self.keyboard.apply_apc(key.desc.row, key.desc.col, val)
-
     def on_rt_down_dpb(self):
         self.rt_down_sld.blockSignals(True)
         self.rt_down_dpb.blockSignals(True)
@@ -534,7 +565,7 @@ class ApcRt(BasicEditor):
         self.rt_down_dpb.setValue(val)
 
         if self.keyboardWidget.active_keys:
-            self.update_group_rt(self.keyboardWidget.active_keys, self.get_current_rt())
+            self.submit_group("rt", self.update_group_rt, self.get_current_rt())
 
         self.rt_down_dpb.blockSignals(False)
         self.rt_down_sld.blockSignals(False)
@@ -547,7 +578,7 @@ class ApcRt(BasicEditor):
         self.rt_down_dpb.setValue(self.apcrt_scale(self.rt_down_sld.value()/100.0, False))
 
         if self.keyboardWidget.active_keys:
-            self.update_group_rt(self.keyboardWidget.active_keys, self.get_current_rt())
+            self.submit_group("rt", self.update_group_rt, self.get_current_rt())
 
         self.rt_down_dpb.blockSignals(False)
         self.rt_down_sld.blockSignals(False)
@@ -579,13 +610,13 @@ class ApcRt(BasicEditor):
             self.rt_dpb.setValue(AMK_RT_DEFAULT/AMK_APCRT_SCALE_DOWN)
 
             if self.keyboardWidget.active_keys:
-                self.update_group_rt(self.keyboardWidget.active_keys, self.get_current_rt())
+                self.submit_group("rt", self.update_group_rt, self.get_current_rt())
         else:
             self.rt_sld.setValue(0)
             self.rt_dpb.setValue(0.0)
 
             if self.keyboardWidget.active_keys:
-                self.update_group_rt(self.keyboardWidget.active_keys, self.get_current_rt())
+                self.submit_group("rt", self.update_group_rt, self.get_current_rt())
 
             self.rt_cont_cbx.setEnabled(False)
             self.rt_down_cbx.setEnabled(False)
@@ -606,7 +637,7 @@ class ApcRt(BasicEditor):
 
     def on_rt_cont_check(self):
         if self.keyboardWidget.active_keys:
-            self.update_group_rt(self.keyboardWidget.active_keys, self.get_current_rt())
+            self.submit_group("rt", self.update_group_rt, self.get_current_rt())
 
         self.reset_active_apcrt()
 
@@ -628,26 +659,63 @@ class ApcRt(BasicEditor):
             self.rt_down_sld.setEnabled(False)
 
         if self.keyboardWidget.active_keys:
-            self.update_group_rt(self.keyboardWidget.active_keys, self.get_current_rt())
+            self.submit_group("rt", self.update_group_rt, self.get_current_rt())
 
         self.rt_down_dpb.blockSignals(False)
         self.rt_down_sld.blockSignals(False)
 
         self.reset_active_apcrt()
 
+    def submit_group(self, name, update, val):
+        """ Queues update(keys, val) for the selected keys, later writes to the same keys replace it """
+        keys = dict(self.keyboardWidget.active_keys)
+        positions = tuple(sorted((key.desc.row, key.desc.col) for key in keys.values()))
+        self.writes.submit((name, positions), self.apply_group, update, keys, val)
+
+    def apply_group(self, update, keys, val):
+        update(keys, val)
+        self.reset_active_apcrt()
+
     def update_group_apc(self, keys, val):
-        for idx, key in keys.items():
-            #print("apply apc for key({},{}):value:{}".format(key.desc.row, key.desc.col, val))
-            self.keyboard.apply_apc(key.desc.row, key.desc.col, val)
+        self.run_batch(self.keyboard.apply_apc_batch, [(key.desc.row, key.desc.col, val) for key in keys.values()])
 
     def update_group_rt(self, keys, val):
-        for idx, key in keys.items():
-            #print("apply rt for key({},{}):value:{}".format(key.desc.row, key.desc.col, val))
-            self.keyboard.apply_rt(key.desc.row, key.desc.col, val)
+        self.run_batch(self.keyboard.apply_rt_batch, [(key.desc.row, key.desc.col, val) for key in keys.values()])
+
+    def run_batch(self, apply, writes):
+        """ Writes the batch on the device I/O thread, the display catches up once it's done """
+        generation = self.batch_generation
+        self.batches += 1
+        future = apply(writes, progress=self.notifier.notifyProgress.emit,
+                       cancelled=lambda: self.batch_generation != generation)
+        future.add_done_callback(lambda f: self.notifier.notifyDone.emit())
+
+    def on_batch_progress(self, done, total):
+        if total <= AMK_BATCH_CHUNK:
+            return
+        self.batch_bar.setMaximum(total)
+        self.batch_bar.setValue(done)
+        self.batch_bar.show()
+        self.batch_cancel_btn.show()
+
+    def on_batch_done(self):
+        self.batches -= 1
+        if self.batches == 0:
+            self.batch_bar.hide()
+            self.batch_cancel_btn.hide()
+        self.reset_active_apcrt()
+
+    def on_batch_cancel(self):
+        # keys written so far keep their new value, the cache only holds what the keyboard confirmed
+        self.writes.clear()
+        self.batch_generation += 1
 
     def switch_profile(self, idx):
+        # pending writes belong to the profile being left
+        self.writes.flush()
         #print("Activate profile:", idx)
         self.keyboard.amk_profile = idx
+        self.keyboard.ensure_amk_keys()
         self.reset_keyboard_widget()
         for i in range(self.keyboard.amk_profile_count):
             self.profile_btns[i].setChecked(False)
@@ -289,14 +289,18 @@ class Dks(BasicEditor):
         # Check if vial protocol is v3 or later
         return isinstance(self.device, VialKeyboard) and \
                (self.device.keyboard and (self.device.keyboard.keyboard_type.startswith("ms") or self.device.keyboard.keyboard_type == "ec")) and \
-               ((self.device.keyboard.cols // 8 + 1) * self.device.keyboard.rows <= 28)
+               ((self.device.keyboard.cols // 8 + 1) * self.device.keyboard.rows <= 28) and \
+               self.device.keyboard.stage_loaded("amk_apcrt")
 
     def reset_keyboard_widget(self):
         if self.valid():
             self.keyboardWidget.update_layout()
 
+            # per-key values are only loaded once the tab is activated
+            loaded = self.keyboard.amk_keys_loaded()
             for widget in self.keyboardWidget.widgets:
-                dks_display(widget, self.keyboard.amk_dks[(widget.desc.row,widget.desc.col)])
+                if loaded:
+                    dks_display(widget, self.keyboard.amk_dks[(widget.desc.row,widget.desc.col)])
                 widget.setOn(False)
 
             self.keyboardWidget.update()
@@ -304,6 +308,7 @@ class Dks(BasicEditor):
 
     def activate(self):
         if self.valid():
+            self.keyboard.ensure_amk_keys()
             self.reset_keyboard_widget()
             self.refresh_dks(self.active_dks)
 
@@ -8,6 +8,7 @@ import os, json
 from util import tr
 
 from editor.basic_editor import BasicEditor
+from write_coalescer import WriteCoalescer
 from vial_device import VialKeyboard
 
 class Misc(BasicEditor):
@@ -263,8 +264,11 @@ class Misc(BasicEditor):
         self.keyboard = None
         self.device = None
         self.advance = False
+        # sliders and spin boxes write through here, so that dragging them doesn't flood the device
+        self.writes = WriteCoalescer()
 
     def rebuild(self, device):
+        self.writes.flush()
         super().rebuild(device)
         if self.valid():
             self.keyboard = device.keyboard
@@ -276,7 +280,8 @@ class Misc(BasicEditor):
         return isinstance(self.device, VialKeyboard) and \
                (self.device.keyboard and \
                (self.device.keyboard.keyboard_speed == "hs" or self.device.keyboard.keyboard_type.startswith("ms") or self.device.keyboard.keyboard_type == "ec")) and \
-               ((self.device.keyboard.cols // 8 + 1) * self.device.keyboard.rows <= 28)
+               ((self.device.keyboard.cols // 8 + 1) * self.device.keyboard.rows <= 28) and \
+               self.device.keyboard.stage_loaded("amk_misc") and self.device.keyboard.stage_loaded("amk_apcrt")
 
     def reset_ui(self):
         self.nk_cbx.blockSignals(True)
@@ -407,7 +412,7 @@ class Misc(BasicEditor):
         self.dd_sbx.setValue(val)
         self.dd_sbx.blockSignals(False)
 
-        self.keyboard.apply_debounce(val, True)
+        self.writes.submit("down_debounce", self.keyboard.apply_debounce, val, True)
 
     def on_dd_sbx(self):
         #print("Down debounce spinbox changed")
@@ -416,7 +421,7 @@ class Misc(BasicEditor):
         self.dd_sld.setValue(val)
         self.dd_sld.blockSignals(False)
 
-        self.keyboard.apply_debounce(val, True)
+        self.writes.submit("down_debounce", self.keyboard.apply_debounce, val, True)
 
     def on_ud_sld(self):
         #print("Up debounce slider changed")
@@ -425,7 +430,7 @@ class Misc(BasicEditor):
         self.ud_sbx.setValue(val)
         self.ud_sbx.blockSignals(False)
 
-        self.keyboard.apply_debounce(val, False)
+        self.writes.submit("up_debounce", self.keyboard.apply_debounce, val, False)
 
     def on_ud_sbx(self):
         #print("Up debounce spinbox changed")
@@ -434,7 +439,7 @@ class Misc(BasicEditor):
         self.ud_sld.setValue(val)
         self.ud_sld.blockSignals(False)
 
-        self.keyboard.apply_debounce(val, False)
+        self.writes.submit("up_debounce", self.keyboard.apply_debounce, val, False)
 
     def on_apcrt_cbb(self):
         #print("apcrt combobox changed")
@@ -467,6 +472,8 @@ class Misc(BasicEditor):
 
     def on_im_btn(self):
         import_file, file_type = QFileDialog.getOpenFileName(None, "Select Config File", os.getcwd(), "Config Files (*.json);;All Files (*)")
+        # the imported values must not be overwritten by a write still pending from the sliders
+        self.writes.clear()
         with open(import_file, encoding="utf-8") as fp:
             kbd = json.load(fp)
             if kbd["name"] != self.device.desc["product_string"] or \
@@ -514,6 +521,8 @@ class Misc(BasicEditor):
 
             keys = kbd.get("keys", None)
             if keys is not None:
+                # unchanged keys are skipped, so the current values must be known
+                self.keyboard.ensure_all_amk_keys()
                 for key in keys:
                     row = key["row"]
                     col = key["col"]
@@ -538,6 +547,7 @@ class Misc(BasicEditor):
 
     def on_ex_btn(self):
         export_file, file_type = QFileDialog.getSaveFileName(None, "Select Config File", os.getcwd(), "Config Files (*.json);;All Files (*)")
+        self.writes.flush()
         kbd = {}
         kbd["name"] = self.device.desc["product_string"]
         kbd["vendor_id"] = self.device.desc["vendor_id"]
@@ -557,6 +567,7 @@ class Misc(BasicEditor):
         kbd["noise_sens"] = self.noise_sld.value()
         kbd["keys"] = []
 
+        self.keyboard.ensure_all_amk_keys()
         for row, col in self.keyboard.rowcol.keys():
             for profile in range(self.keyboard.amk_profile_count):
                 key = {}
@@ -657,7 +668,7 @@ class Misc(BasicEditor):
         self.noise_dpb.blockSignals(True)
         self.noise_sld.blockSignals(True)
         self.noise_sld.setValue(self.noise_dpb.value())
-        self.keyboard.apply_noise_sensitivity(self.noise_sld.value())
+        self.writes.submit("noise_sensitivity", self.keyboard.apply_noise_sensitivity, self.noise_sld.value())
         self.noise_sld.blockSignals(False)
         self.noise_dpb.blockSignals(False)
 
@@ -665,7 +676,7 @@ class Misc(BasicEditor):
         self.noise_dpb.blockSignals(True)
         self.noise_sld.blockSignals(True)
         self.noise_dpb.setValue(self.noise_sld.value())
-        self.keyboard.apply_noise_sensitivity(self.noise_sld.value())
+        self.writes.submit("noise_sensitivity", self.keyboard.apply_noise_sensitivity, self.noise_sld.value())
         self.noise_sld.blockSignals(False)
         self.noise_dpb.blockSignals(False)
 
@@ -673,7 +684,7 @@ class Misc(BasicEditor):
         self.apc_dpb.blockSignals(True)
         self.apc_sld.blockSignals(True)
         self.apc_sld.setValue(self.apc_dpb.value())
-        self.keyboard.apply_apc_sensitivity(self.apc_sld.value())
+        self.writes.submit("apc_sensitivity", self.keyboard.apply_apc_sensitivity, self.apc_sld.value())
         self.apc_sld.blockSignals(False)
         self.apc_dpb.blockSignals(False)
 
@@ -681,7 +692,7 @@ class Misc(BasicEditor):
         self.apc_dpb.blockSignals(True)
         self.apc_sld.blockSignals(True)
         self.apc_dpb.setValue(self.apc_sld.value())
-        self.keyboard.apply_apc_sensitivity(self.apc_sld.value())
+        self.writes.submit("apc_sensitivity", self.keyboard.apply_apc_sensitivity, self.apc_sld.value())
         self.apc_sld.blockSignals(False)
         self.apc_dpb.blockSignals(False)
 
@@ -689,7 +700,7 @@ class Misc(BasicEditor):
         self.rt_dpb.blockSignals(True)
         self.rt_sld.blockSignals(True)
         self.rt_sld.setValue(self.rt_dpb.value())
-        self.keyboard.apply_rt_sensitivity(self.rt_sld.value())
+        self.writes.submit("rt_sensitivity", self.keyboard.apply_rt_sensitivity, self.rt_sld.value())
         self.rt_sld.blockSignals(False)
         self.rt_dpb.blockSignals(False)
 
@@ -697,7 +708,7 @@ class Misc(BasicEditor):
         self.rt_dpb.blockSignals(True)
         self.rt_sld.blockSignals(True)
         self.rt_dpb.setValue(self.rt_sld.value())
-        self.keyboard.apply_rt_sensitivity(self.rt_sld.value())
+        self.writes.submit("rt_sensitivity", self.keyboard.apply_rt_sensitivity, self.rt_sld.value())
         self.rt_sld.blockSignals(False)
         self.rt_dpb.blockSignals(False)
 
@@ -705,7 +716,7 @@ class Misc(BasicEditor):
         self.top_dpb.blockSignals(True)
         self.top_sld.blockSignals(True)
         self.top_sld.setValue(self.top_dpb.value())
-        self.keyboard.apply_top_sensitivity(self.top_sld.value())
+        self.writes.submit("top_sensitivity", self.keyboard.apply_top_sensitivity, self.top_sld.value())
         self.top_sld.blockSignals(False)
         self.top_dpb.blockSignals(False)
 
@@ -713,7 +724,7 @@ class Misc(BasicEditor):
         self.top_dpb.blockSignals(True)
         self.top_sld.blockSignals(True)
         self.top_dpb.setValue(self.top_sld.value())
-        self.keyboard.apply_top_sensitivity(self.top_sld.value())
+        self.writes.submit("top_sensitivity", self.keyboard.apply_top_sensitivity, self.top_sld.value())
         self.top_sld.blockSignals(False)
         self.top_dpb.blockSignals(False)
 
@@ -721,7 +732,7 @@ class Misc(BasicEditor):
         self.btm_dpb.blockSignals(True)
         self.btm_sld.blockSignals(True)
         self.btm_sld.setValue(self.btm_dpb.value())
-        self.keyboard.apply_btm_sensitivity(self.btm_sld.value())
+        self.writes.submit("btm_sensitivity", self.keyboard.apply_btm_sensitivity, self.btm_sld.value())
         self.btm_sld.blockSignals(False)
         self.btm_dpb.blockSignals(False)
 
@@ -729,7 +740,7 @@ class Misc(BasicEditor):
         self.btm_dpb.blockSignals(True)
         self.btm_sld.blockSignals(True)
         self.btm_dpb.setValue(self.btm_sld.value())
-        self.keyboard.apply_btm_sensitivity(self.btm_sld.value())
+        self.writes.submit("btm_sensitivity", self.keyboard.apply_btm_sensitivity, self.btm_sld.value())
         self.btm_sld.blockSignals(False)
         self.btm_dpb.blockSignals(False)
 
@@ -1,6 +1,9 @@
 import struct
+import time
 
+from hid_metrics import HidMetrics
 from keycodes.keycodes import Keycode
+from packet_tracer import PacketTracer
 
 from protocol.base_protocol import BaseProtocol
 
@@ -75,6 +78,9 @@ RGB_LED_KANA = 4
 DKS_EVENT_MAX = 4
 DKS_KEY_MAX = 4
 
+# how many per-key writes of a batch are pipelined between progress reports and cancellation checks
+AMK_BATCH_CHUNK = 32
+
 class DksKey:
     def __init__(self):
         self.down_events = ([0,0,0,0],[0,0,0,0],[0,0,0,0],[0,0,0,0])
@@ -463,10 +469,12 @@ class ProtocolAmk(BaseProtocol):
 
     def reload_apc(self, profile):
         """ Reload APC information from keyboard """
-        for row, col in self.rowcol.keys():
-            data = self.usb_send(self.dev, 
-                                struct.pack("BBBBB", AMK_PROTOCOL_PREFIX, AMK_PROTOCOL_GET_APC, row, col, profile),
-                                retries=20)
+        keys = list(self.rowcol.keys())
+        responses = self.usb_send_many(self.dev,
+                                       [struct.pack("BBBBB", AMK_PROTOCOL_PREFIX, AMK_PROTOCOL_GET_APC, row, col, profile)
+                                        for row, col in keys],
+                                       retries=20)
+        for (row, col), data in zip(keys, responses):
             val = struct.unpack(">H", data[3:5])
             if self.amk_apcrt_version == 1:
                 self.amk_apc[profile][(row, col)] = val[0] * self.amk_apcrt_scale
@@ -476,10 +484,12 @@ class ProtocolAmk(BaseProtocol):
 
     def reload_rt(self, profile):
         """ Reload RT information from keyboard """
-        for row, col in self.rowcol.keys():
-            data = self.usb_send(self.dev, 
-                                struct.pack("BBBBB", AMK_PROTOCOL_PREFIX, AMK_PROTOCOL_GET_RT, row, col, profile),
-                                retries=20)
+        keys = list(self.rowcol.keys())
+        responses = self.usb_send_many(self.dev,
+                                       [struct.pack("BBBBB", AMK_PROTOCOL_PREFIX, AMK_PROTOCOL_GET_RT, row, col, profile)
+                                        for row, col in keys],
+                                       retries=20)
+        for (row, col), data in zip(keys, responses):
             val = struct.unpack(">H", data[3:5])[0]
             rt = {}
             if self.amk_apcrt_version == 1:
@@ -500,6 +510,45 @@ class ProtocolAmk(BaseProtocol):
             self.amk_rt[profile][(row, col)] = rt
             #print("AMK protocol: RT={}, row={}, col={}, profile={}".format(self.amk_rt[profile][(row, col)], row, col, profile))
 
+    def amk_keys_loaded(self, profile=None):
+        """ Whether APC/RT of the profile (the one being edited by default) and DKS are loaded """
+        if profile is None:
+            profile = self.amk_profile
+        return profile in self.amk_apcrt_loaded and self.amk_dks_loaded
+
+    def load_amk_keys(self, profile):
+        """ Reads APC/RT of one profile and DKS unless they are already loaded; runs on the I/O thread """
+        if profile not in self.amk_apcrt_loaded:
+            self.reload_apc(profile)
+            self.reload_rt(profile)
+            self.amk_apcrt_loaded.add(profile)
+        if not self.amk_dks_loaded:
+            self.reload_dks()
+            self.amk_dks_loaded = True
+
+    def ensure_amk_keys(self, profile=None):
+        """
+        Per-key APC/RT/DKS state is only read from the keyboard when an editor needs it:
+        the requested profile is loaded right away, the other ones are prefetched in the background
+        """
+        if profile is None:
+            profile = self.amk_profile
+        self.worker.call(self.load_amk_keys, profile)
+        if not self.amk_prefetch_started:
+            self.amk_prefetch_started = True
+            self.worker.post(self.prefetch_amk_keys)
+
+    def prefetch_amk_keys(self):
+        for profile in range(self.amk_profile_count):
+            # stop when the keyboard is being closed or reloaded
+            if self.reload_graph is not None and self.reload_graph.cancelled:
+                return
+            self.load_amk_keys(profile)
+
+    def ensure_all_amk_keys(self):
+        self.amk_prefetch_started = True
+        self.worker.call(self.prefetch_amk_keys)
+
     def dump_apcrt(self):
         for i in range(self.amk_profile_count):
             for row, col in self.rowcol.keys():
@@ -510,10 +559,12 @@ class ProtocolAmk(BaseProtocol):
 
     def reload_dks(self):
         """ Reload DKS information from keyboard """
-        for row, col in self.rowcol.keys():
-            data = self.usb_send(self.dev, 
-                                struct.pack("BBBB", AMK_PROTOCOL_PREFIX, AMK_PROTOCOL_GET_DKS, row, col),
-                                retries=20)
+        keys = list(self.rowcol.keys())
+        responses = self.usb_send_many(self.dev,
+                                       [struct.pack("BBBB", AMK_PROTOCOL_PREFIX, AMK_PROTOCOL_GET_DKS, row, col)
+                                        for row, col in keys],
+                                       retries=20)
+        for (row, col), data in zip(keys, responses):
             dks_data = data[3:15]
             dks = DksKey()
             dks.parse(dks_data)
@@ -596,7 +647,7 @@ class ProtocolAmk(BaseProtocol):
 
         #self.amk_dks[(row,col)].dump()
         data = struct.pack("BBBB", AMK_PROTOCOL_PREFIX, AMK_PROTOCOL_SET_DKS, row, col) + self.amk_dks[(row,col)].pack_dks()
-        data = self.usb_send(self.dev, data, retries=20)
+        self.usb_post(self.dev, data, retries=20)
 
     def apply_apc(self, row, col, val):
         if self.amk_apc[self.amk_profile][(row,col)] == val:
@@ -604,16 +655,15 @@ class ProtocolAmk(BaseProtocol):
 
         #print("Update APC at({},{}), old({}), new({})".format(row, col, self.amk_apc[(row,col)], val))
         self.amk_apc[self.amk_profile][(row,col)] = val
+        self.usb_post(self.dev, self.apc_packet(row, col, val, self.amk_profile), retries=20)
+
+    def apc_packet(self, row, col, val, profile):
         if self.amk_apcrt_version == 1:
             val = val // self.amk_apcrt_scale
-
-        data = struct.pack(">BBBBHB", AMK_PROTOCOL_PREFIX, AMK_PROTOCOL_SET_APC, row, col, val, self.amk_profile)
-        data = self.usb_send(self.dev, data, retries=20)
+        return struct.pack(">BBBBHB", AMK_PROTOCOL_PREFIX, AMK_PROTOCOL_SET_APC, row, col, val, profile)
 
     def apply_rt(self, row, col, val):
-        if self.amk_rt[self.amk_profile][(row,col)]["cont"] == val["cont"] and \
-            self.amk_rt[self.amk_profile][(row,col)]["down"] == val["down"] and \
-            self.amk_rt[self.amk_profile][(row,col)]["up"] == val["up"]:
+        if self.rt_matches(self.amk_rt[self.amk_profile][(row,col)], val):
             return
 
         #print("Update RT at({},{}), old({}), new({})".format(row, col, self.amk_rt[(row,col)], val))
@@ -621,6 +671,13 @@ class ProtocolAmk(BaseProtocol):
         self.amk_rt[self.amk_profile][(row,col)]["cont"] = val["cont"] 
         self.amk_rt[self.amk_profile][(row,col)]["down"] = val["down"] 
         self.amk_rt[self.amk_profile][(row,col)]["up"] = val["up"] 
+        self.usb_post(self.dev, self.rt_packet(row, col, val, self.amk_profile), retries=20)
+
+    @staticmethod
+    def rt_matches(rt, val):
+        return rt["cont"] == val["cont"] and rt["down"] == val["down"] and rt["up"] == val["up"]
+
+    def rt_packet(self, row, col, val, profile):
         rt = 0x8000 if val["cont"] else 0
         if self.amk_apcrt_version == 1:
             rt = rt + (((val["down"]//self.amk_apcrt_scale) & 0x3F) << 6)
@@ -629,9 +686,72 @@ class ProtocolAmk(BaseProtocol):
             rt = rt + ((val["down"] & 0x7F) << 7)
             rt = rt + (val["up"] & 0x7F)
 
-        data = struct.pack(">BBBBHB", AMK_PROTOCOL_PREFIX, AMK_PROTOCOL_SET_RT, row, col, rt, self.amk_profile)
-
-        data = self.usb_send(self.dev, data, retries=20)
+        return struct.pack(">BBBBHB", AMK_PROTOCOL_PREFIX, AMK_PROTOCOL_SET_RT, row, col, rt, profile)
+
+    def apply_apc_batch(self, writes, progress=None, cancelled=None):
+        """
+        Sets the APC of many keys of the current profile, `writes` is a list of (row, col, value).
+        Keys already at their value are skipped; see run_amk_batch for how the rest is written.
+        """
+        profile = self.amk_profile
+        apc = self.amk_apc[profile]
+        writes = list(writes)
+
+        def matches(row, col, val):
+            return apc[(row, col)] == val
+
+        def commit(row, col, val):
+            apc[(row, col)] = val
+
+        def packet(row, col, val):
+            return self.apc_packet(row, col, val, profile)
+        return self.worker.post(self.run_amk_batch, writes, matches, packet, commit, progress, cancelled)
+
+    def apply_rt_batch(self, writes, progress=None, cancelled=None):
+        """
+        Sets the RT of many keys of the current profile, `writes` is a list of (row, col, {"cont", "down", "up"}).
+        Keys already at their value are skipped; see run_amk_batch for how the rest is written.
+        """
+        profile = self.amk_profile
+        rt = self.amk_rt[profile]
+        writes = [(row, col, dict(val)) for row, col, val in writes]
+
+        def matches(row, col, val):
+            return self.rt_matches(rt[(row, col)], val)
+
+        def commit(row, col, val):
+            rt[(row, col)].update(cont=val["cont"], down=val["down"], up=val["up"])
+
+        def packet(row, col, val):
+            return self.rt_packet(row, col, val, profile)
+        return self.worker.post(self.run_amk_batch, writes, matches, packet, commit, progress, cancelled)
+
+    def run_amk_batch(self, writes, matches, packet, commit, progress=None, cancelled=None):
+        """
+        Runs on the device I/O thread: sends the packets for `writes` pipelined, AMK_BATCH_CHUNK at a time,
+        and commits each chunk to the cached state once it got its responses. progress(done, total) is
+        called from the I/O thread after every chunk and cancelled() is checked before each of them.
+        Returns how many writes were done, fewer than requested when cancelled.
+
+        When its pipeline stalls usb_send_many sends the chunk again, which is fine here: APC/RT set packets
+        carry the absolute value of one key, so a repeated packet writes the same thing twice.
+
+        Writes for which matches() holds are skipped. That is checked here rather than when the batch is
+        queued, so that it sees what the batches queued before this one committed.
+        """
+        writes = [w for w in writes if not matches(*w)]
+        done = 0
+        for x in range(0, len(writes), AMK_BATCH_CHUNK):
+            if cancelled is not None and cancelled():
+                break
+            chunk = writes[x:x + AMK_BATCH_CHUNK]
+            self.usb_send_many(self.dev, [packet(*w) for w in chunk], retries=20)
+            for w in chunk:
+                commit(*w)
+            done += len(chunk)
+            if progress is not None:
+                progress(done, len(writes))
+        return done
 
     def apply_poll_rate(self, val):
         if self.amk_poll_rate == val:
@@ -639,7 +759,7 @@ class ProtocolAmk(BaseProtocol):
 
         #print("Update poll rate: old({}), new({})".format(self.amk_poll_rate, val))
         self.amk_poll_rate = val
-        data = self.usb_send(self.dev, struct.pack("BBB", AMK_PROTOCOL_PREFIX, AMK_PROTOCOL_SET_POLL_RATE, val), retries=20)
+        self.usb_post(self.dev, struct.pack("BBB", AMK_PROTOCOL_PREFIX, AMK_PROTOCOL_SET_POLL_RATE, val), retries=20)
 
     def apply_debounce(self, val, down):
         if down:
@@ -656,7 +776,7 @@ class ProtocolAmk(BaseProtocol):
             self.amk_up_debounce = val
 
         cmd = AMK_PROTOCOL_SET_DOWN_DEBOUNCE if down else AMK_PROTOCOL_SET_UP_DEBOUNCE
-        data = self.usb_send(self.dev, struct.pack("BBB", AMK_PROTOCOL_PREFIX, cmd, val), retries=20)
+        self.usb_post(self.dev, struct.pack("BBB", AMK_PROTOCOL_PREFIX, cmd, val), retries=20)
     
     def apply_nkro(self, val):
         if self.amk_nkro == val:
@@ -664,7 +784,7 @@ class ProtocolAmk(BaseProtocol):
 
         #print("Update NKRO : old({}), new({})".format(self.amk_nkro, val))
         self.amk_nkro = val
-        data = self.usb_send(self.dev, struct.pack("BBB", AMK_PROTOCOL_PREFIX, AMK_PROTOCOL_SET_NKRO, val), retries=20)
+        self.usb_post(self.dev, struct.pack("BBB", AMK_PROTOCOL_PREFIX, AMK_PROTOCOL_SET_NKRO, val), retries=20)
 
     def compose_config(self):
         config = 1 if self.amk_pole else 0
@@ -680,7 +800,7 @@ class ProtocolAmk(BaseProtocol):
         #print("Update POLE: old({}), new({})".format(self.amk_pole, val))
         self.amk_pole = val
         config = self.compose_config()
-        data = self.usb_send(self.dev, struct.pack("BBB", AMK_PROTOCOL_PREFIX, AMK_PROTOCOL_SET_MS_CONFIG, config), retries=20)
+        self.usb_post(self.dev, struct.pack("BBB", AMK_PROTOCOL_PREFIX, AMK_PROTOCOL_SET_MS_CONFIG, config), retries=20)
 
     def apply_profile(self, val):
         if self.keyboard_profile == val:
@@ -689,7 +809,7 @@ class ProtocolAmk(BaseProtocol):
         #print("Update PROFILE: old({}), new({})".format(self.keyboard_profile, val))
         self.keyboard_profile = val
         config = self.compose_config()
-        data = self.usb_send(self.dev, struct.pack("BBB", AMK_PROTOCOL_PREFIX, AMK_PROTOCOL_SET_MS_CONFIG, config), retries=20)
+        self.usb_post(self.dev, struct.pack("BBB", AMK_PROTOCOL_PREFIX, AMK_PROTOCOL_SET_MS_CONFIG, config), retries=20)
 
     def apply_dks_disable(self, val):
         if self.amk_dks_disable == val:
@@ -698,14 +818,14 @@ class ProtocolAmk(BaseProtocol):
         #print("Update DKS DISABLE: old({}), new({})".format(self.amk_pole, val))
         self.amk_dks_disable = val
         config = self.compose_config()
-        data = self.usb_send(self.dev, struct.pack("BBB", AMK_PROTOCOL_PREFIX, AMK_PROTOCOL_SET_MS_CONFIG, config), retries=20)
+        self.usb_post(self.dev, struct.pack("BBB", AMK_PROTOCOL_PREFIX, AMK_PROTOCOL_SET_MS_CONFIG, config), retries=20)
 
     def apply_rt_sensitivity(self, val):
         if self.amk_rt_sens == val:
             return
 
         self.amk_rt_sens = val
-        data = self.usb_send(self.dev, struct.pack("BBB", AMK_PROTOCOL_PREFIX, AMK_PROTOCOL_SET_RT_SENS, val), retries=20)
+        self.usb_post(self.dev, struct.pack("BBB", AMK_PROTOCOL_PREFIX, AMK_PROTOCOL_SET_RT_SENS, val), retries=20)
         #print("update RT sensitivity: ", val)
 
     def apply_top_sensitivity(self, val):
@@ -713,7 +833,7 @@ class ProtocolAmk(BaseProtocol):
             return
 
         self.amk_top_sens = val
-        data = self.usb_send(self.dev, struct.pack("BBB", AMK_PROTOCOL_PREFIX, AMK_PROTOCOL_SET_TOP_SENS, val), retries=20)
+        self.usb_post(self.dev, struct.pack("BBB", AMK_PROTOCOL_PREFIX, AMK_PROTOCOL_SET_TOP_SENS, val), retries=20)
         #print("update TOP sensitivity: ", val)
 
     def apply_btm_sensitivity(self, val):
@@ -721,7 +841,7 @@ class ProtocolAmk(BaseProtocol):
             return
 
         self.amk_btm_sens = val
-        data = self.usb_send(self.dev, struct.pack("BBB", AMK_PROTOCOL_PREFIX, AMK_PROTOCOL_SET_BTM_SENS, val), retries=20)
+        self.usb_post(self.dev, struct.pack("BBB", AMK_PROTOCOL_PREFIX, AMK_PROTOCOL_SET_BTM_SENS, val), retries=20)
         #print("update BOTTOM sensitivity: ", val)
 
     def apply_apc_sensitivity(self, val):
@@ -729,7 +849,7 @@ class ProtocolAmk(BaseProtocol):
             return
 
         self.amk_apc_sens = val
-        data = self.usb_send(self.dev, struct.pack("BBB", AMK_PROTOCOL_PREFIX, AMK_PROTOCOL_SET_APC_SENS, val), retries=20)
+        self.usb_post(self.dev, struct.pack("BBB", AMK_PROTOCOL_PREFIX, AMK_PROTOCOL_SET_APC_SENS, val), retries=20)
         #print("update APC sensitivity: ", val)
 
     def apply_noise_sensitivity(self, val):
@@ -737,7 +857,7 @@ class ProtocolAmk(BaseProtocol):
             return
 
         self.amk_noise_sens = val
-        data = self.usb_send(self.dev, struct.pack("BBB", AMK_PROTOCOL_PREFIX, AMK_PROTOCOL_SET_NOISE_SENS, val), retries=20)
+        self.usb_post(self.dev, struct.pack("BBB", AMK_PROTOCOL_PREFIX, AMK_PROTOCOL_SET_NOISE_SENS, val), retries=20)
         #print("update NOISE sensitivity: ", val)
 
     def reload_rgb_strips(self):
@@ -775,10 +895,10 @@ class ProtocolAmk(BaseProtocol):
     def apply_rgb_strip_led(self, strip, index, led):
         self.amk_rgb_strips[strip].set_led(index, led)
 
-        data = self.usb_send(self.dev,
-                            struct.pack("BBB", AMK_PROTOCOL_PREFIX, AMK_PROTOCOL_SET_RGB_STRIP_LED, 
-                                        self.amk_rgb_strips[strip].start+index) + led.pack(), 
-                             retries=20)
+        self.usb_post(self.dev,
+                      struct.pack("BBB", AMK_PROTOCOL_PREFIX, AMK_PROTOCOL_SET_RGB_STRIP_LED, 
+                                  self.amk_rgb_strips[strip].start+index) + led.pack(), 
+                       retries=20)
         #print("AMK protocol: set rgb strip led: strip={}, index={}, led={}".format(strip, index, led.pack()))
 
     def apply_rgb_strip_mode(self, strip, mode):
@@ -786,7 +906,7 @@ class ProtocolAmk(BaseProtocol):
             return
         
         self.amk_rgb_strips[strip].set_mode(mode)
-        data = self.usb_send(self.dev, struct.pack("BBBB", AMK_PROTOCOL_PREFIX, AMK_PROTOCOL_SET_RGB_STRIP_MODE, strip, mode), retries=20)
+        self.usb_post(self.dev, struct.pack("BBBB", AMK_PROTOCOL_PREFIX, AMK_PROTOCOL_SET_RGB_STRIP_MODE, strip, mode), retries=20)
         #print("AMK protocol: set rgb strip mode: index={}, mode={}".format(strip, mode))
     
     def reload_indicator(self, led):
@@ -816,10 +936,10 @@ class ProtocolAmk(BaseProtocol):
                 self.reload_indicator(self.rgb_indicators["kana"])
 
     def apply_rgb_indicator(self, led):
-        data = self.usb_send(self.dev,
-                            struct.pack("BBB", AMK_PROTOCOL_PREFIX, AMK_PROTOCOL_SET_RGB_INDICATOR_LED, 
-                                        led.get_index()) + led.get_led().pack(), 
-                             retries=20)
+        self.usb_post(self.dev,
+                      struct.pack("BBB", AMK_PROTOCOL_PREFIX, AMK_PROTOCOL_SET_RGB_INDICATOR_LED, 
+                                  led.get_index()) + led.get_led().pack(), 
+                       retries=20)
     
     def reload_anim_file_list(self):
         data = self.usb_send(self.dev, 
@@ -852,12 +972,22 @@ class ProtocolAmk(BaseProtocol):
         else:
             print("faild to refresh file list")
 
+    def fast_write(self, dev, data):
+        """ Writes to the vendor endpoint used for fast animation file transfers """
+        dev.write(4, data)
+        PacketTracer.get().record(PacketTracer.OUT, data, PacketTracer.IFACE_AMK_FAST)
+
+    def fast_read(self, dev):
+        data = dev.read(0x84, 64)
+        PacketTracer.get().record(PacketTracer.IN, data, PacketTracer.IFACE_AMK_FAST)
+        return data
+
     def fastopen_anim_file(self, dev, name, read, index=0xFF):
         data = struct.pack("BBBB", AMK_PROTOCOL_PREFIX, AMK_PROTOCOL_OPEN_FILE, index, 1 if read else 0) + bytearray(name, "utf-8")
         data += b"\x00" * (64 - len(data))
 
-        dev.write(4, data)
-        data = dev.read(0x84, 64)
+        self.fast_write(dev, data)
+        data = self.fast_read(dev)
         if data[2] == AMK_PROTOCOL_OK:
             #print("Open file at index:", data[3])
             return data[3]
@@ -867,8 +997,10 @@ class ProtocolAmk(BaseProtocol):
     
     def fastwrite_anim_file(self, dev, index, data, offset):
         data = struct.pack("<BBBBI", AMK_PROTOCOL_PREFIX, AMK_PROTOCOL_WRITE_FILE, index, len(data), offset) + data
-        dev.write(4, data)
-        data = dev.read(0x84, 64)
+        started = time.monotonic()
+        self.fast_write(dev, data)
+        msg, data = data, self.fast_read(dev)
+        HidMetrics.get().record(msg, latency=time.monotonic() - started, bytes_out=len(msg), bytes_in=len(data))
         if data[2] == AMK_PROTOCOL_OK:
             #print("Write file at index:{}, size:{}".format(index, len(data)))
             return True
@@ -877,13 +1009,16 @@ class ProtocolAmk(BaseProtocol):
             return False
     
     def fastwrite_anim_file_vendor(self, dev, data):
-        dev.write(4, data)
+        # a batch of write commands in one transfer, without a response
+        started = time.monotonic()
+        self.fast_write(dev, data)
+        HidMetrics.get().record(data, latency=time.monotonic() - started, bytes_out=len(data))
         return True
 
     def fastread_anim_file(self, dev, index, offset, size):
         data = struct.pack("<BBBBI", AMK_PROTOCOL_PREFIX, AMK_PROTOCOL_READ_FILE, index, size, offset)
-        dev.write(4, data)
-        data = dev.read(0x84, 64)
+        self.fast_write(dev, data)
+        data = self.fast_read(dev)
         if data[2] == AMK_PROTOCOL_OK:
             size = data[3]
             return data[8:8+size] 
@@ -892,8 +1027,8 @@ class ProtocolAmk(BaseProtocol):
 
     def fastclose_anim_file(self, dev, index):
         data = struct.pack("BBB", AMK_PROTOCOL_PREFIX, AMK_PROTOCOL_CLOSE_FILE, index)
-        dev.write(4, data)
-        data = dev.read(0x84, 64)
+        self.fast_write(dev, data)
+        data = self.fast_read(dev)
         if data[2] == AMK_PROTOCOL_OK:
             #print("Close file at index:", index)
             return True
@@ -1007,19 +1142,19 @@ class ProtocolAmk(BaseProtocol):
     def apply_rgb_matrix_led(self, index, led):
         start = self.amk_rgb_matrix["start"]
         self.amk_rgb_matrix["leds"][index] = led
-        data = self.usb_send(self.dev,
-                            struct.pack("BBB", 
-                                        AMK_PROTOCOL_PREFIX, 
-                                        AMK_PROTOCOL_SET_RGB_MATRIX_LED, 
-                                        start+index) + led.pack(), retries=20)
+        self.usb_post(self.dev,
+                      struct.pack("BBB", 
+                                  AMK_PROTOCOL_PREFIX, 
+                                  AMK_PROTOCOL_SET_RGB_MATRIX_LED, 
+                                  start+index) + led.pack(), retries=20)
     
     def apply_rgb_matrix_mode(self, index, mode):
-        data = self.usb_send(self.dev,
-                            struct.pack("BBBB", 
-                                        AMK_PROTOCOL_PREFIX, 
-                                        AMK_PROTOCOL_SET_RGB_MATRIX_MODE, 
-                                        index,
-                                        mode), retries=20)
+        self.usb_post(self.dev,
+                      struct.pack("BBBB", 
+                                  AMK_PROTOCOL_PREFIX, 
+                                  AMK_PROTOCOL_SET_RGB_MATRIX_MODE, 
+                                  index,
+                                  mode), retries=20)
     
     def get_rgb_matrix_led_index(self, row, col):
         index = self.amk_rgb_matrix["data"].get((row, col)) - self.amk_rgb_matrix["start"]
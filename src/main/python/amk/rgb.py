@@ -320,7 +320,8 @@ class RgbStrip(BasicEditor):
 
     def valid(self):
         return isinstance(self.device, VialKeyboard) and \
-               (self.device.keyboard and self.device.keyboard.lighting_amk_rgblight)
+               (self.device.keyboard and self.device.keyboard.lighting_amk_rgblight) and \
+               self.device.keyboard.stage_loaded("amk_rgb")
 
     def on_color_btn_clicked(self):
         self.dlg_color = QColorDialog()
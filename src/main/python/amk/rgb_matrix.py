@@ -8,6 +8,7 @@ from PyQt5.QtWidgets import QApplication
 from themes import Theme
 
 from editor.basic_editor import BasicEditor
+from write_coalescer import WriteCoalescer
 from amk.widget import ClickableWidget, AmkWidget
 from util import tr
 from vial_device import VialKeyboard
@@ -69,6 +70,8 @@ class RgbMatrix(BasicEditor):
         self.keyboard = None
         self.device = None
         self.custom_mode = False
+        # LED writes go through here, so that changing many of them in a row doesn't flood the device
+        self.writes = WriteCoalescer()
 
         self.keyboardWidget = RgbWidget(layout_editor, self)
         self.keyboardWidget.set_enabled(True)
@@ -129,6 +132,7 @@ class RgbMatrix(BasicEditor):
         self.addLayout(h_layout)
 
     def rebuild(self, device):
+        self.writes.flush()
         super().rebuild(device)
         if self.valid():
             self.keyboard = device.keyboard
@@ -138,7 +142,8 @@ class RgbMatrix(BasicEditor):
 
     def valid(self):
         return isinstance(self.device, VialKeyboard) and \
-               (self.device.keyboard and len(self.device.keyboard.amk_rgb_matrix) > 0)
+               (self.device.keyboard and self.device.keyboard.stage_loaded("amk_rgb") and
+                len(self.device.keyboard.amk_rgb_matrix) > 0)
 
     def reset_keyboard_widget(self):
         if self.valid():
@@ -201,6 +206,7 @@ class RgbMatrix(BasicEditor):
         return self.custom_cbx.checkState() == Qt.Checked
 
     def on_custom_check(self):
+        self.writes.flush()
         if self.custom_cbx.checkState() == Qt.Checked:
             self.keyboard.apply_rgb_matrix_mode(0, self.keyboard.amk_rgb_matrix["mode"]["custom"])
         else:
@@ -244,7 +250,7 @@ class RgbMatrix(BasicEditor):
                 led.set_hue(hue)
                 led.set_sat(sat)
                 led.set_val(val)
-                self.keyboard.apply_rgb_matrix_led(index, led)
+                self.writes.submit(("rgb_matrix_led", index), self.keyboard.apply_rgb_matrix_led, index, led)
                 rgb_display(key, self.is_custom_mode(), led)
 
         self.keyboardWidget.update()
@@ -257,7 +263,7 @@ class RgbMatrix(BasicEditor):
             if led is not None:
                 on = not led.get_on()
                 led.set_on(on)
-                self.keyboard.apply_rgb_matrix_led(index, led)
+                self.writes.submit(("rgb_matrix_led", index), self.keyboard.apply_rgb_matrix_led, index, led)
                 rgb_display(key, self.is_custom_mode(), led)
 
         self.keyboardWidget.update()
@@ -269,7 +275,7 @@ class RgbMatrix(BasicEditor):
             if led is not None:
                 dynamic = not led.get_dynamic()
                 led.set_dynamic(dynamic)
-                self.keyboard.apply_rgb_matrix_led(index, led)
+                self.writes.submit(("rgb_matrix_led", index), self.keyboard.apply_rgb_matrix_led, index, led)
                 rgb_display(key, self.is_custom_mode(), led)
 
         self.keyboardWidget.update()
@@ -281,7 +287,7 @@ class RgbMatrix(BasicEditor):
             if led is not None:
                 blink = not led.get_blink()
                 led.set_blink(blink)
-                self.keyboard.apply_rgb_matrix_led(index, led)
+                self.writes.submit(("rgb_matrix_led", index), self.keyboard.apply_rgb_matrix_led, index, led)
                 rgb_display(key, self.is_custom_mode(), led)
 
         self.keyboardWidget.update()
@@ -293,7 +299,7 @@ class RgbMatrix(BasicEditor):
             if led is not None:
                 breath = not led.get_breath()
                 led.set_breath(breath)
-                self.keyboard.apply_rgb_matrix_led(index, led)
+                self.writes.submit(("rgb_matrix_led", index), self.keyboard.apply_rgb_matrix_led, index, led)
                 rgb_display(key, self.is_custom_mode(), led)
 
         self.keyboardWidget.update()
@@ -305,7 +311,7 @@ class RgbMatrix(BasicEditor):
             if led is not None:
                 speed = self.speed_sld.value()
                 led.set_speed(speed)
-                self.keyboard.apply_rgb_matrix_led(index, led)
+                self.writes.submit(("rgb_matrix_led", index), self.keyboard.apply_rgb_matrix_led, index, led)
                 rgb_display(key, self.is_custom_mode(), led)
 
         self.keyboardWidget.update()
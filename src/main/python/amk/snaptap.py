@@ -262,6 +262,7 @@ class Snaptap(BasicEditor):
     def valid(self):
         return isinstance(self.device, VialKeyboard) and \
                (self.device.keyboard and (self.device.keyboard.keyboard_type.startswith("ms") or self.device.keyboard.keyboard_type == "ec")) and \
+               self.device.keyboard.stage_loaded("amk_apcrt") and \
                (self.device.keyboard.amk_snaptap == True )
 
     def reset_ui(self):
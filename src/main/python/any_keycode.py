@@ -1,4 +1,6 @@
 import ast
+import re
+from functools import lru_cache
 
 import simpleeval
 import operator
@@ -90,8 +92,123 @@ for x in range(16):
     functions["LT{}".format(x)] = lambda kc, layer=x: (r("QK_LAYER_TAP") | (((layer)&0xF) << 8) | ((kc)&0xFF))
 
 
+class ParseError(Exception):
+    """ The expression is outside of what KeycodeParser handles """
+
+
+class KeycodeParser:
+    """
+    Recursive-descent parser for the expressions keycodes are usually written as: names, numbers,
+    calls such as LT(3, KC_SPC) or LCTL_T(KC_A), parentheses and the | ^ & << >> + - operators,
+    which have the same precedence as in Python. Anything else raises ParseError, so that the
+    caller can hand it to simpleeval instead.
+    """
+
+    TOKENS = re.compile(r"[ \t]*(?:(0[xX][0-9a-fA-F]+|[0-9]+)|([A-Za-z_][A-Za-z0-9_]*)|(<<|>>|[|^&+\-(),]))")
+
+    # operator -> (precedence, function), higher binds tighter
+    BINARY = {
+        "|": (1, operator.or_),
+        "^": (2, operator.xor),
+        "&": (3, operator.and_),
+        "<<": (4, operator.lshift), ">>": (4, operator.rshift),
+        "+": (5, operator.add), "-": (5, operator.sub),
+    }
+
+    def __init__(self, names):
+        self.names = names
+
+    def tokenize(self, s):
+        tokens = []
+        pos = 0
+        s = s.rstrip(" \t")
+        while pos < len(s):
+            m = self.TOKENS.match(s, pos)
+            if m is None:
+                raise ParseError("unexpected {!r}".format(s[pos:]))
+            number, name, op = m.groups()
+            if number is not None:
+                if len(number) > 1 and number[0] == "0" and number[1] not in "xX" and number.strip("0"):
+                    # leading zeros are a syntax error in Python
+                    raise ParseError("invalid number {!r}".format(number))
+                tokens.append(("number", int(number, 0)))
+            elif name is not None:
+                tokens.append(("name", name))
+            else:
+                tokens.append(("op", op))
+            pos = m.end()
+        return tokens
+
+    def parse(self, s):
+        if not isinstance(s, str):
+            raise ParseError("not a string")
+        self.tokens = self.tokenize(s)
+        self.pos = 0
+        value = self.binary()
+        if self.pos != len(self.tokens):
+            raise ParseError("trailing {!r}".format(self.tokens[self.pos][1]))
+        return value
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return None, None
+
+    def expect(self, op):
+        if self.peek() != ("op", op):
+            raise ParseError("expected {!r}".format(op))
+        self.pos += 1
+
+    def binary(self, min_precedence=1):
+        """ Precedence climbing over BINARY, all of which are left-associative """
+        value = self.atom()
+        while True:
+            kind, op = self.peek()
+            if kind != "op" or op not in self.BINARY:
+                return value
+            precedence, fn = self.BINARY[op]
+            if precedence < min_precedence:
+                return value
+            self.pos += 1
+            value = fn(value, self.binary(precedence + 1))
+
+    def atom(self):
+        kind, value = self.peek()
+        self.pos += 1
+        if kind == "number":
+            return value
+        if kind == "op" and value == "(":
+            value = self.binary()
+            self.expect(")")
+            return value
+        if kind != "name":
+            raise ParseError("unexpected {!r}".format(value))
+
+        if self.peek() != ("op", "("):
+            if value not in self.names:
+                raise ParseError("unknown name {!r}".format(value))
+            return self.names[value]
+
+        if value not in functions:
+            raise ParseError("unknown function {!r}".format(value))
+        self.pos += 1
+        args = []
+        if self.peek() != ("op", ")"):
+            args.append(self.binary())
+            while self.peek() == ("op", ","):
+                self.pos += 1
+                args.append(self.binary())
+        self.expect(")")
+        try:
+            return functions[value](*args)
+        except TypeError as e:
+            raise ParseError(str(e))
+
+
 class AnyKeycode:
 
+    instance = None
+
     def __init__(self):
         self.ops = simpleeval.DEFAULT_OPERATORS.copy()
         self.ops.update({
@@ -101,6 +218,14 @@ class AnyKeycode:
         })
         self.names = dict()
         self.prepare_names()
+        self.generation = Keycode.generation
+
+    @classmethod
+    def get(cls):
+        """ AnyKeycode for the current keycode set """
+        if cls.instance is None or cls.instance.generation != Keycode.generation:
+            cls.instance = cls()
+        return cls.instance
 
     def prepare_names(self):
         for kc in KEYCODES_SPECIAL + KEYCODES_BASIC + KEYCODES_SHIFTED + KEYCODES_ISO + KEYCODES_BACKLIGHT + \
@@ -114,4 +239,16 @@ class AnyKeycode:
         self.names.update(macros)
 
     def decode(self, s):
+        try:
+            return KeycodeParser(self.names).parse(s)
+        except ParseError:
+            return self.decode_simpleeval(s)
+
+    def decode_simpleeval(self, s):
         return simpleeval.simple_eval(s, names=self.names, functions=functions, operators=self.ops)
+
+
+@lru_cache(maxsize=4096)
+def decode(s, generation):
+    """ AnyKeycode.decode() with the keycode set of `generation`, which must be the current one """
+    return AnyKeycode.get().decode(s)
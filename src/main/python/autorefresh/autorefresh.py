@@ -1,4 +1,5 @@
 import sys
+from functools import partial
 
 from PyQt5.QtCore import QObject, pyqtSignal
 
@@ -19,6 +20,10 @@ class Autorefresh(QObject):
 
     instance = None
     devices_updated = pyqtSignal(object, bool)
+    # device, stage name, stages done, total stages; emitted from the device I/O thread for background stages
+    reload_progress = pyqtSignal(object, str, int, int)
+    # device, exception; emitted from the device I/O thread when a queued write to it failed
+    write_failed = pyqtSignal(object, object)
 
     def __init__(self):
         super().__init__()
@@ -71,12 +76,16 @@ class Autorefresh(QObject):
             self.current_device = self.devices[idx]
 
         if self.current_device is not None:
+            progress = partial(self.reload_progress.emit, self.current_device)
             if self.current_device.sideload:
-                self.current_device.open(self.thread.sideload_json)
+                self.current_device.open(self.thread.sideload_json, progress)
             elif self.current_device.via_stack:
-                self.current_device.open(self.thread.via_stack_json["definitions"][self.current_device.via_id])
+                self.current_device.open(self.thread.via_stack_json["definitions"][self.current_device.via_id],
+                                         progress)
             else:
-                self.current_device.open(None)
+                self.current_device.open(None, progress)
+            if getattr(self.current_device, "keyboard", None) is not None:
+                self.current_device.keyboard.write_failed = partial(self.write_failed.emit, self.current_device)
         self.thread.set_device(self.current_device)
 
     def on_devices_updated(self, devices, changed):
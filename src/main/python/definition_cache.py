@@ -0,0 +1,117 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+import hashlib
+import logging
+import os
+import pathlib
+import sys
+
+
+class DefinitionCache:
+    """
+    Persistent cache of the LZMA-compressed vial.json definitions downloaded from keyboards.
+
+    Entries are keyed by keyboard UID, definition size and protocol versions, so a firmware update
+    which changes the definition size or protocol will miss the cache. Each file stores a SHA-256
+    of the payload which is verified on read; once the cache grows past max_bytes the least
+    recently used entries are evicted.
+    """
+
+    SUFFIX = ".vdef"
+
+    instance = None
+
+    def __init__(self, directory, max_bytes=16 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    @classmethod
+    def default(cls):
+        """ Shared cache in the application data directory, None where there is no persistent storage """
+        if sys.platform == "emscripten":
+            return None
+        if cls.instance is None:
+            from PyQt5.QtCore import QStandardPaths
+
+            directory = QStandardPaths.writableLocation(QStandardPaths.AppLocalDataLocation)
+            cls.instance = cls(os.path.join(directory, "definitions"))
+        return cls.instance
+
+    def path(self, keyboard_id, size, via_protocol, vial_protocol):
+        name = "{:016X}-{}-{}-{}{}".format(keyboard_id, size, via_protocol, vial_protocol, self.SUFFIX)
+        return os.path.join(self.directory, name)
+
+    def get(self, keyboard_id, size, via_protocol, vial_protocol):
+        """ Returns the cached compressed definition, or None if missing or corrupted """
+        path = self.path(keyboard_id, size, via_protocol, vial_protocol)
+        try:
+            with open(path, "rb") as inf:
+                data = inf.read()
+        except OSError:
+            return None
+
+        digest, payload = data[:32], data[32:]
+        if len(payload) != size or hashlib.sha256(payload).digest() != digest:
+            logging.warning("Discarding corrupted cached definition %s", path)
+            self.remove(path)
+            return None
+
+        # bump mtime, this is what the LRU eviction goes by
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return payload
+
+    def put(self, keyboard_id, size, via_protocol, vial_protocol, payload):
+        try:
+            pathlib.Path(self.directory).mkdir(parents=True, exist_ok=True)
+            path = self.path(keyboard_id, size, via_protocol, vial_protocol)
+            # write and rename so that a crash can't leave a truncated entry behind
+            tmp = path + ".tmp"
+            with open(tmp, "wb") as outf:
+                outf.write(hashlib.sha256(payload).digest() + payload)
+            os.replace(tmp, path)
+            self.evict()
+        except OSError as e:
+            logging.warning("Failed to cache keyboard definition: %s", e)
+
+    def invalidate(self, keyboard_id=None):
+        """ Removes the cached definitions of one keyboard, or of every keyboard if keyboard_id is None """
+        prefix = "" if keyboard_id is None else "{:016X}-".format(keyboard_id)
+        for path, _, _ in self.entries():
+            if os.path.basename(path).startswith(prefix):
+                self.remove(path)
+
+    def entries(self):
+        """ List of (path, size, mtime) for every cached definition """
+        out = []
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return out
+        for name in names:
+            if not name.endswith(self.SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            out.append((path, st.st_size, st.st_mtime))
+        return out
+
+    def evict(self):
+        entries = sorted(self.entries(), key=lambda e: e[2])
+        total = sum(e[1] for e in entries)
+        # always keep the most recent entry even if it is over the limit on its own
+        while total > self.max_bytes and len(entries) > 1:
+            path, size, _ = entries.pop(0)
+            self.remove(path)
+            total -= size
+
+    @staticmethod
+    def remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -1,13 +1,14 @@
 # SPDX-License-Identifier: GPL-2.0-or-later
 import json
 
-from PyQt5.QtWidgets import QHBoxLayout, QLabel, QVBoxLayout, QMessageBox, QWidget
+from PyQt5.QtWidgets import QHBoxLayout, QLabel, QVBoxLayout, QMessageBox, QWidget, QProgressDialog, QApplication
 from PyQt5.QtCore import Qt, pyqtSignal
 
 from any_keycode_dialog import AnyKeycodeDialog
 from editor.basic_editor import BasicEditor
 from widgets.keyboard_widget import KeyboardWidget, EncoderWidget
 from keycodes.keycodes import Keycode
+from protocol.restore_plan import RestoreCancelled
 from widgets.square_button import SquareButton
 from tabbed_keycodes import TabbedKeycodes, keycode_filter_masked
 from util import tr, KeycodeDisplay
@@ -73,7 +74,6 @@ class KeymapEditor(BasicEditor):
 
     def on_empty_space_clicked(self):
         self.container.deselect()
-        self.container.update()
 
     def on_keycode_changed(self, code):
         self.set_key(code)
@@ -141,7 +141,25 @@ class KeymapEditor(BasicEditor):
                                        QMessageBox.Yes | QMessageBox.No)
             if ret != QMessageBox.Yes:
                 return
-        self.keyboard.restore_layout(data)
+
+        plan = self.keyboard.plan_restore(data)
+        dialog = QProgressDialog(tr("KeymapEditor", "Restoring {} changes, about {:.1f}s...").format(
+            len(plan), plan.estimate()), tr("KeymapEditor", "Cancel"), 0, len(plan), self.widget())
+        dialog.setWindowModality(Qt.WindowModal)
+        dialog.setMinimumDuration(500)
+
+        def progress(done, total):
+            dialog.setMaximum(total)
+            dialog.setValue(done)
+            QApplication.processEvents()
+
+        try:
+            plan.execute(progress, dialog.wasCanceled)
+        except RestoreCancelled:
+            QMessageBox.warning(self.widget(), "", tr("KeymapEditor", "Restore cancelled, {} of {} changes were "
+                                                                      "written.").format(plan.done, len(plan)))
+        finally:
+            dialog.close()
         self.refresh_layer_display()
 
     def on_any_keycode(self):
@@ -183,6 +201,17 @@ class KeymapEditor(BasicEditor):
         self.container.update()
         self.container.updateGeometry()
 
+    def refresh_key_display(self, widget):
+        """ Refresh just the key widgets showing the same keymap entry as `widget` """
+
+        desc = widget.desc
+        code = self.code_for_widget(widget)
+        for w in self.container.widgets:
+            if (w.desc.row, w.desc.col, w.desc.encoder_idx, w.desc.encoder_dir) == \
+                    (desc.row, desc.col, desc.encoder_idx, desc.encoder_dir):
+                KeycodeDisplay.display_keycode(w, code)
+                self.container.update_key(w)
+
     def switch_layer(self, idx):
         self.container.deselect()
         self.current_layer = idx
@@ -215,7 +244,7 @@ class KeymapEditor(BasicEditor):
             keycode = kc.qmk_id.replace("(kc)", "({})".format(keycode))
 
         self.keyboard.set_encoder(l, i, d, keycode)
-        self.refresh_layer_display()
+        self.refresh_key_display(self.container.active_key)
 
     def set_key_matrix(self, keycode):
         l, r, c = self.current_layer, self.container.active_key.desc.row, self.container.active_key.desc.col
@@ -231,11 +260,10 @@ class KeymapEditor(BasicEditor):
                 keycode = kc.qmk_id.replace("(kc)", "({})".format(keycode))
 
             self.keyboard.set_key(l, r, c, keycode)
-            self.refresh_layer_display()
+            self.refresh_key_display(self.container.active_key)
 
     def on_key_clicked(self):
         """ Called when a key on the keyboard widget is clicked """
-        self.refresh_layer_display()
         if self.container.active_mask:
             self.tabbed_keycodes.set_keycode_filter(keycode_filter_masked)
         else:
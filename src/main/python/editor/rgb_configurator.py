@@ -9,6 +9,7 @@ from editor.basic_editor import BasicEditor
 from widgets.clickable_label import ClickableLabel
 from util import tr
 from vial_device import VialKeyboard
+from write_coalescer import WriteCoalescer
 
 
 class QmkRgblightEffect:
@@ -124,8 +125,11 @@ class BasicHandler(QObject):
         super().__init__()
         self.device = self.keyboard = None
         self.widgets = []
+        # sliders write through here, so that dragging them doesn't flood the device
+        self.writes = WriteCoalescer()
 
     def set_device(self, device):
+        self.writes.flush()
         self.device = device
         if self.valid():
             self.keyboard = self.device.keyboard
@@ -201,6 +205,9 @@ class QmkRgblightHandler(BasicHandler):
         return isinstance(self.device, VialKeyboard) and self.device.keyboard.lighting_qmk_rgblight
 
     def on_underglow_brightness_changed(self, value):
+        self.writes.submit("brightness", self.apply_underglow_brightness, value)
+
+    def apply_underglow_brightness(self, value):
         self.device.keyboard.set_qmk_rgblight_brightness(value)
         self.update.emit()
 
@@ -225,6 +232,8 @@ class QmkRgblightHandler(BasicHandler):
         h, s, v, a = color.getHsvF()
         if h < 0:
             h = 0
+        # the color includes the brightness, which a pending brightness write must not override afterwards
+        self.writes.clear()
         self.device.keyboard.set_qmk_rgblight_color(int(255 * h), int(255 * s), int(255 * v))
         self.update.emit()
 
@@ -269,7 +278,7 @@ class QmkBacklightHandler(BasicHandler):
         return isinstance(self.device, VialKeyboard) and self.device.keyboard.lighting_qmk_backlight
 
     def on_backlight_brightness_changed(self, value):
-        self.device.keyboard.set_qmk_backlight_brightness(value)
+        self.writes.submit("brightness", self.device.keyboard.set_qmk_backlight_brightness, value)
 
     def on_backlight_breathing_changed(self, checked):
         self.device.keyboard.set_qmk_backlight_effect(int(checked))
@@ -320,10 +329,10 @@ class VialRGBHandler(BasicHandler):
         self.effects = []
 
     def on_rgb_brightness_changed(self, value):
-        self.keyboard.set_vialrgb_brightness(value)
+        self.writes.submit("brightness", self.keyboard.set_vialrgb_brightness, value)
 
     def on_rgb_speed_changed(self, value):
-        self.keyboard.set_vialrgb_speed(value)
+        self.writes.submit("speed", self.keyboard.set_vialrgb_speed, value)
 
     def on_rgb_effect_changed(self, index):
         self.keyboard.set_vialrgb_mode(self.effects[index].idx)
@@ -410,6 +419,8 @@ class RGBConfigurator(BasicEditor):
         self.addLayout(buttons)
 
     def on_save(self):
+        for h in self.handlers:
+            h.writes.flush()
         self.device.keyboard.save_rgb()
 
     def valid(self):
@@ -426,6 +437,8 @@ class RGBConfigurator(BasicEditor):
             h.unblock_signals()
 
     def update_from_keyboard(self):
+        for h in self.handlers:
+            h.writes.flush()
         self.device.keyboard.reload_rgb()
 
         self.block_signals()
@@ -0,0 +1,161 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+import json
+import threading
+
+
+class CommandMetrics:
+    """ Counters and a latency histogram for one command """
+
+    # upper bounds of the latency buckets, in milliseconds; the last bucket is open-ended
+    BUCKETS = [0.25, 0.5, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 2048]
+
+    def __init__(self):
+        self.count = 0
+        self.failures = 0
+        self.retries = 0
+        self.timeouts = 0
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        self.histogram = [0] * (len(self.BUCKETS) + 1)
+
+    def observe(self, latency_ms):
+        bucket = 0
+        while bucket < len(self.BUCKETS) and latency_ms > self.BUCKETS[bucket]:
+            bucket += 1
+        self.histogram[bucket] += 1
+        self.latency_sum += latency_ms
+        self.latency_max = max(self.latency_max, latency_ms)
+
+    def percentile(self, p):
+        """ Upper bound of the bucket holding the p-th percentile latency """
+        total = sum(self.histogram)
+        if total == 0:
+            return None
+        seen = 0
+        for bucket, n in enumerate(self.histogram):
+            seen += n
+            if seen >= total * p / 100:
+                return self.BUCKETS[bucket] if bucket < len(self.BUCKETS) else self.latency_max
+        return self.latency_max
+
+    def to_json(self):
+        samples = sum(self.histogram)
+        return {
+            "count": self.count,
+            "failures": self.failures,
+            "retries": self.retries,
+            "timeouts": self.timeouts,
+            "bytes_out": self.bytes_out,
+            "bytes_in": self.bytes_in,
+            "latency_ms": {
+                "mean": self.latency_sum / samples if samples else None,
+                "p50": self.percentile(50),
+                "p95": self.percentile(95),
+                "max": self.latency_max if samples else None,
+                "buckets": self.BUCKETS,
+                "histogram": self.histogram,
+            },
+        }
+
+
+class HidMetrics:
+    """
+    Process-wide traffic statistics keyed by command: (command byte, subcommand byte) for the
+    Vial (0xFE xx) and AMK (0xFD xx) command sets, (command byte, None) for plain VIA commands.
+
+    Recording a request is a dict lookup and a few additions under a lock, cheap enough to stay
+    enabled all the time; set `enabled` to False to skip it entirely.
+    """
+
+    VIAL_PREFIX = 0xFE
+    AMK_PREFIX = 0xFD
+
+    instance = None
+
+    def __init__(self):
+        self.enabled = True
+        self.lock = threading.Lock()
+        self.commands = dict()
+        self.names = None
+
+    @classmethod
+    def get(cls):
+        if cls.instance is None:
+            cls.instance = cls()
+        return cls.instance
+
+    @classmethod
+    def key(cls, msg):
+        if not msg:
+            return None, None
+        if msg[0] in (cls.VIAL_PREFIX, cls.AMK_PREFIX) and len(msg) > 1:
+            return msg[0], msg[1]
+        return msg[0], None
+
+    def record(self, msg, latency=None, retries=0, timeouts=0, bytes_out=0, bytes_in=0, ok=True):
+        """ Records one request; latency is in seconds, None for requests that don't wait for a response """
+        if not self.enabled:
+            return
+        key = self.key(msg)
+        with self.lock:
+            metrics = self.commands.get(key)
+            if metrics is None:
+                metrics = self.commands[key] = CommandMetrics()
+            metrics.count += 1
+            metrics.retries += retries
+            metrics.timeouts += timeouts
+            metrics.bytes_out += bytes_out
+            metrics.bytes_in += bytes_in
+            if not ok:
+                metrics.failures += 1
+            elif latency is not None:
+                metrics.observe(latency * 1000)
+
+    def mean_latency(self, msg):
+        """ Mean latency in seconds of the command `msg` belongs to, None until one was answered """
+        with self.lock:
+            metrics = self.commands.get(self.key(msg))
+            samples = sum(metrics.histogram) if metrics is not None else 0
+            return metrics.latency_sum / samples / 1000 if samples else None
+
+    def reset(self):
+        with self.lock:
+            self.commands = dict()
+
+    def command_names(self):
+        """ Maps keys to constant names, VIA/Vial from protocol.constants and AMK from amk.protocol """
+        if self.names is None:
+            from protocol import constants
+            from amk import protocol as amk
+
+            names = dict()
+            for name, value in vars(constants).items():
+                if name.startswith("CMD_VIA_") and name != "CMD_VIA_VIAL_PREFIX":
+                    names[(value, None)] = name[len("CMD_VIA_"):]
+                elif name.startswith("CMD_VIAL_"):
+                    names[(self.VIAL_PREFIX, value)] = name[len("CMD_"):]
+            for name, value in vars(amk).items():
+                if name.startswith("AMK_PROTOCOL_") and name not in ("AMK_PROTOCOL_PREFIX", "AMK_PROTOCOL_OK"):
+                    names[(self.AMK_PREFIX, value)] = "AMK_" + name[len("AMK_PROTOCOL_"):]
+            self.names = names
+        return self.names
+
+    def command_name(self, key):
+        cmd, sub = key
+        label = "{:02X}".format(cmd) if sub is None else "{:02X} {:02X}".format(cmd, sub)
+        name = self.command_names().get(key)
+        return label if name is None else "{} {}".format(label, name)
+
+    def to_json(self):
+        with self.lock:
+            commands = sorted(self.commands.items(), key=lambda kv: (kv[0][0], -1 if kv[0][1] is None else kv[0][1]))
+            return {
+                "commands": [dict(command=self.command_name(key), cmd=key[0], sub=key[1], **metrics.to_json())
+                             for key, metrics in commands],
+            }
+
+    def dump(self, path):
+        with open(path, "w") as outf:
+            json.dump(self.to_json(), outf, indent=1)
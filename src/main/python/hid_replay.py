@@ -0,0 +1,165 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+import json
+import threading
+import time
+from collections import deque, defaultdict
+
+from util import MSG_LEN, response_matches
+
+
+class ReplayError(Exception):
+    pass
+
+
+class HidRecorder:
+    """
+    Wraps a hidapi device and records every request together with its response and round-trip time,
+    so the session can later be replayed with ReplayDevice without the keyboard attached.
+
+    Responses come in the order of the requests, also for pipelined ones. A response goes to the oldest
+    request it can be the answer to (see util.response_matches); requests before that one lost their
+    response, and a response no pending request matches is a late one hid_send skips as well.
+    """
+
+    VERSION = 1
+
+    # set by --record-hid, picked up by the next keyboard that is opened
+    armed_path = None
+
+    def __init__(self, dev):
+        self.dev = dev
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.pending = deque()
+        self.exchanges = []
+
+    @classmethod
+    def arm(cls, path):
+        cls.armed_path = path
+
+    @classmethod
+    def take_armed(cls):
+        path, cls.armed_path = cls.armed_path, None
+        return path
+
+    def write(self, data):
+        ret = self.dev.write(data)
+        with self.lock:
+            # strip the hidapi report id
+            self.pending.append((bytes(data[1:]), time.monotonic()))
+        return ret
+
+    def read(self, length, timeout_ms=0):
+        data = self.dev.read(length, timeout_ms=timeout_ms)
+        if data:
+            now = time.monotonic()
+            with self.lock:
+                match = self.match(bytes(data))
+                if match is not None:
+                    request, sent_at = match
+                    self.exchanges.append({
+                        "t": round(sent_at - self.started, 6),
+                        "rtt": round(now - sent_at, 6),
+                        "req": request.hex(),
+                        "resp": bytes(data).hex(),
+                    })
+        return data
+
+    def match(self, data):
+        for x, (request, sent_at) in enumerate(self.pending):
+            if response_matches(request, data):
+                for y in range(x + 1):
+                    self.pending.popleft()
+                return request, sent_at
+        return None
+
+    def __getattr__(self, name):
+        return getattr(self.dev, name)
+
+    def to_json(self):
+        with self.lock:
+            return {"version": self.VERSION, "msg_len": MSG_LEN, "exchanges": list(self.exchanges)}
+
+    def save(self, path):
+        with open(path, "w") as outf:
+            json.dump(self.to_json(), outf, indent=1)
+
+
+class ReplayDevice:
+    """
+    Stands in for a hidapi device by answering requests from a session recorded with HidRecorder.
+
+    Each request is answered with the next response recorded for the same request bytes; once those
+    run out the last one is repeated, so a recording can be replayed any number of times. A response
+    becomes readable after the recorded round-trip time, or after `latency` seconds if it is given,
+    multiplied by `scale`; with latency=0 replay runs as fast as possible.
+
+    Requests that were never recorded raise ReplayError, unless `echo_unknown` is set, in which case
+    they are answered with the request itself like most VIA/Vial set commands are.
+
+        kb = Keyboard(ReplayDevice.load("session.json", latency=0.001))
+        kb.reload()
+    """
+
+    def __init__(self, exchanges, latency=None, scale=1.0, echo_unknown=False):
+        self.latency = latency
+        self.scale = scale
+        self.echo_unknown = echo_unknown
+        self.responses = defaultdict(deque)
+        self.last = dict()
+        for e in exchanges:
+            request = bytes.fromhex(e["req"])
+            self.responses[request].append((bytes.fromhex(e["resp"]), e["rtt"]))
+        self.in_flight = deque()
+        self.requests = 0
+        self.nonblocking = False
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        with open(path, "r") as inf:
+            data = json.load(inf)
+        if data.get("version") != HidRecorder.VERSION:
+            raise ReplayError("unsupported recording version {}".format(data.get("version")))
+        return cls(data["exchanges"], **kwargs)
+
+    def response(self, request):
+        queue = self.responses.get(request)
+        if queue:
+            self.last[request] = queue.popleft()
+            return self.last[request]
+        if request in self.last:
+            return self.last[request]
+        if self.echo_unknown:
+            return request, 0
+        raise ReplayError("request {} is not in the recording".format(request.hex()))
+
+    def write(self, data):
+        request = bytes(data[1:])
+        response, rtt = self.response(request)
+        latency = rtt if self.latency is None else self.latency
+        self.in_flight.append((response, time.monotonic() + latency * self.scale))
+        self.requests += 1
+        return len(data)
+
+    def set_nonblocking(self, nonblocking):
+        self.nonblocking = bool(nonblocking)
+
+    def read(self, length, timeout_ms=0):
+        if not self.in_flight:
+            if timeout_ms > 0 and not self.nonblocking:
+                time.sleep(timeout_ms / 1000)
+            return b""
+        response, ready_at = self.in_flight[0]
+        delay = ready_at - time.monotonic()
+        if delay > 0:
+            if self.nonblocking:
+                return b""
+            if timeout_ms > 0 and delay > timeout_ms / 1000:
+                time.sleep(timeout_ms / 1000)
+                return b""
+            time.sleep(delay)
+        self.in_flight.popleft()
+        return response[:length]
+
+    def close(self):
+        pass
@@ -3,6 +3,7 @@
 # SPDX-License-Identifier: GPL-2.0-or-later
 
 import sys
+import threading
 
 from keycodes.keycodes_v5 import keycodes_v5
 from keycodes.keycodes_v6 import keycodes_v6
@@ -14,6 +15,8 @@ class Keycode:
     recorder_alias_to_keycode = dict()
     qmk_id_to_keycode = dict()
     protocol = 0
+    # bumped whenever the keycode tables are regenerated, to invalidate what was derived from them
+    generation = 0
 
     def __init__(self, qmk_id, label, tooltip=None, masked=False, printable=None, recorder_alias=None, alias=None):
         self.qmk_id = qmk_id
@@ -49,6 +52,7 @@ class Keycode:
         # this is to handle cases of qmk_id LCTL(kc) propagated here from find_inner_keycode
         if qmk_id == "kc":
             qmk_id = "KC_NO"
+        ensure_keycodes()
         return KEYCODES_MAP.get(qmk_id)
 
     @classmethod
@@ -75,6 +79,7 @@ class Keycode:
 
     @classmethod
     def find_by_qmk_id(cls, qmk_id):
+        ensure_keycodes()
         return cls.qmk_id_to_keycode.get(qmk_id)
 
     @classmethod
@@ -105,11 +110,16 @@ class Keycode:
     @classmethod
     def serialize(cls, code):
         """ Converts integer keycode to string """
+        if 0 <= code < KeycodeTables.SIZE:
+            name = KeycodeTables.get().names[code]
+            return hex(code) if name is None else name
+
         if cls.protocol == 6:
             masked = keycodes_v6.masked
         else:
             masked = keycodes_v5.masked
 
+        ensure_keycodes()
         if (code & 0xFF00) not in masked:
             kc = RAWCODES_MAP.get(code)
             if kc is not None:
@@ -125,15 +135,29 @@ class Keycode:
     def deserialize(cls, val, reraise=False):
         """ Converts string keycode to integer """
 
-        from any_keycode import AnyKeycode
-
         if isinstance(val, int):
             return val
+        code = KeycodeTables.get().codes.get(val)
+        if code is not None:
+            return code
+        if isinstance(val, str) and val.startswith("0x"):
+            # what serialize() gives for keycodes without a name
+            try:
+                return int(val, 16)
+            except ValueError:
+                pass
+        return cls.parse(val, reraise)
+
+    @classmethod
+    def parse(cls, val, reraise=False):
+        """ deserialize() without the lookup tables, for anything that isn't the name of a keycode """
+
         if val in cls.qmk_id_to_keycode:
             return cls.resolve(cls.qmk_id_to_keycode[val].qmk_id)
-        anykc = AnyKeycode()
+
+        from any_keycode import decode
         try:
-            return anykc.decode(val)
+            return decode(val, cls.generation)
         except Exception:
             if reraise:
                 raise
@@ -762,29 +786,102 @@ KEYCODES_MIDI_ADVANCED = [
     K("MI_BENDU", "ᴹᴵᴰᴵ\nBendᵁᴾ", "Midi bend pitch up"),
 ]
 
+# created along with KEYCODES, see ensure_keycodes()
 KEYCODES_HIDDEN = []
-for x in range(256):
-    KEYCODES_HIDDEN.append(K("TD({})".format(x), "TD({})".format(x)))
 
 KEYCODES = []
 KEYCODES_MAP = dict()
 RAWCODES_MAP = dict()
+# whether KEYCODES and the maps have to be rebuilt from the lists above before they are used
+keycodes_stale = True
+keycodes_lock = threading.Lock()
 
 K = None
 
 
-def recreate_keycodes():
-    """ Regenerates global KEYCODES array """
+class KeycodeTables:
+    """
+    Every 16-bit keycode which has a name, including the masked ones such as LCTL(KC_A), in a dense
+    list indexed by the raw keycode, and the reverse dict. They turn Keycode.serialize() and
+    Keycode.deserialize() into a single lookup. Made on first use after the keycodes were recreated,
+    and only if the set of keycodes actually changed.
+    """
+
+    SIZE = 0x10000
+
+    instance = None
+
+    def __init__(self, signature):
+        self.signature = signature
+        self.generation = Keycode.generation
+
+        masked = keycodes_v6.masked if Keycode.protocol == 6 else keycodes_v5.masked
+        names = [None] * self.SIZE
+        for code, kc in RAWCODES_MAP.items():
+            if 0 <= code < self.SIZE and (code & 0xFF00) not in masked:
+                names[code] = kc.qmk_id
+        inners = [(code, kc.qmk_id) for code, kc in RAWCODES_MAP.items() if 0 <= code <= 0xFF]
+        for outer in masked:
+            kc = RAWCODES_MAP.get(outer)
+            if kc is None or not 0 <= outer < self.SIZE:
+                continue
+            for code, qmk_id in inners:
+                names[outer | code] = sys.intern(kc.qmk_id.replace("kc", qmk_id))
+        self.names = names
+
+        codes = {name: code for code, name in enumerate(names) if name is not None}
+        # plain names resolve like Keycode.parse() does, including the ones which can't be
+        for qmk_id, kc in Keycode.qmk_id_to_keycode.items():
+            try:
+                codes[qmk_id] = Keycode.resolve(kc.qmk_id)
+            except RuntimeError:
+                codes.pop(qmk_id, None)
+        self.codes = codes
+
+    @staticmethod
+    def current_signature():
+        ensure_keycodes()
+        return Keycode.protocol, len(Keycode.qmk_id_to_keycode), tuple(kc.qmk_id for kc in KEYCODES)
+
+    @classmethod
+    def get(cls):
+        if cls.instance is None or cls.instance.generation != Keycode.generation:
+            signature = cls.current_signature()
+            if cls.instance is None or cls.instance.signature != signature:
+                cls.instance = cls(signature)
+            cls.instance.generation = Keycode.generation
+        return cls.instance
 
-    KEYCODES.clear()
-    KEYCODES.extend(KEYCODES_SPECIAL + KEYCODES_BASIC + KEYCODES_SHIFTED + KEYCODES_ISO + KEYCODES_LAYERS +
-                    KEYCODES_BOOT + KEYCODES_MODIFIERS + KEYCODES_QUANTUM + KEYCODES_BACKLIGHT + KEYCODES_MEDIA +
-                    KEYCODES_TAP_DANCE + KEYCODES_MACRO + KEYCODES_USER + KEYCODES_HIDDEN + KEYCODES_MIDI)
-    KEYCODES_MAP.clear()
-    RAWCODES_MAP.clear()
-    for keycode in KEYCODES:
-        KEYCODES_MAP[keycode.qmk_id.replace("(kc)", "")] = keycode
-        RAWCODES_MAP[Keycode.deserialize(keycode.qmk_id)] = keycode
+
+def recreate_keycodes():
+    """ Regenerates global KEYCODES array, on first use """
+
+    global keycodes_stale
+    keycodes_stale = True
+    Keycode.generation += 1
+
+
+def ensure_keycodes():
+    """ Builds KEYCODES, KEYCODES_MAP and RAWCODES_MAP if recreate_keycodes() was called since they last were """
+
+    global keycodes_stale
+    if not keycodes_stale:
+        return
+    with keycodes_lock:
+        if not keycodes_stale:
+            return
+        if not KEYCODES_HIDDEN:
+            KEYCODES_HIDDEN.extend(Keycode("TD({})".format(x), "TD({})".format(x)) for x in range(256))
+        KEYCODES.clear()
+        KEYCODES.extend(KEYCODES_SPECIAL + KEYCODES_BASIC + KEYCODES_SHIFTED + KEYCODES_ISO + KEYCODES_LAYERS +
+                        KEYCODES_BOOT + KEYCODES_MODIFIERS + KEYCODES_QUANTUM + KEYCODES_BACKLIGHT + KEYCODES_MEDIA +
+                        KEYCODES_TAP_DANCE + KEYCODES_MACRO + KEYCODES_USER + KEYCODES_HIDDEN + KEYCODES_MIDI)
+        KEYCODES_MAP.clear()
+        RAWCODES_MAP.clear()
+        for keycode in KEYCODES:
+            KEYCODES_MAP[keycode.qmk_id.replace("(kc)", "")] = keycode
+            RAWCODES_MAP[Keycode.parse(keycode.qmk_id)] = keycode
+        keycodes_stale = False
 
 
 def create_user_keycodes():
@@ -888,5 +985,3 @@ def recreate_keyboard_keycodes(keyboard):
 
     recreate_keycodes()
 
-
-recreate_keycodes()
@@ -1,4 +1,3 @@
-from keycodes.keycodes import Keycode
 from keymap import brazilian, canadian_csa, danish, eurkey, french, german, hebrew, hungarian, japanese, latam, norwegian, russian, slovak, spanish, swedish, swedish_swerty, swiss, croatian
 
 KEYMAPS = [
@@ -24,8 +23,3 @@ KEYMAPS = [
     ("Swiss (QWERTZ)", swiss.keymap)
 ]
 
-# make sure that qmk IDs we used are all correct
-for name, keymap in KEYMAPS:
-    for qmk_id in keymap.keys():
-        if Keycode.find_by_qmk_id(qmk_id) is None:
-            raise RuntimeError("Misconfigured - cannot find QMK keycode {}".format(qmk_id))
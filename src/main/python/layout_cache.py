@@ -0,0 +1,167 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+import hashlib
+import json
+import logging
+import os
+import pathlib
+from collections import OrderedDict
+
+from kle_serial import Serial as KleSerial, Key
+
+
+class ParsedLayout:
+    """ Result of deserializing a KLE keymap and assigning matrix positions / encoders to its keys """
+
+    def __init__(self, keys, encoders, rowcol, encoderpos):
+        self.keys = keys
+        self.encoders = encoders
+        self.rowcol = rowcol
+        self.encoderpos = encoderpos
+        self.encoder_count = max(encoderpos) + 1 if encoderpos else 0
+
+    @classmethod
+    def parse(cls, keymap):
+        kb = KleSerial().deserialize(keymap)
+
+        keys = []
+        encoders = []
+        rowcol = OrderedDict()
+        encoderpos = OrderedDict()
+
+        for key in kb.keys:
+            key.row = key.col = None
+            key.encoder_idx = key.encoder_dir = None
+            if key.labels[4] == "e":
+                idx, direction = key.labels[0].split(",")
+                idx, direction = int(idx), int(direction)
+                key.encoder_idx = idx
+                key.encoder_dir = direction
+                encoderpos[idx] = True
+                encoders.append(key)
+            elif key.decal or (key.labels[0] and "," in key.labels[0]):
+                row, col = 0, 0
+                if key.labels[0] and "," in key.labels[0]:
+                    row, col = key.labels[0].split(",")
+                    row, col = int(row), int(col)
+                key.row = row
+                key.col = col
+                rowcol[(row, col)] = True
+                keys.append(key)
+
+            # bottom right corner determines layout index and option in this layout
+            key.layout_index = -1
+            key.layout_option = -1
+            if key.labels[8]:
+                idx, opt = key.labels[8].split(",")
+                key.layout_index, key.layout_option = int(idx), int(opt)
+
+        return cls(keys, encoders, list(rowcol), list(encoderpos))
+
+    @staticmethod
+    def key_to_json(key, defaults):
+        """ Only attributes which differ from a fresh Key() are stored """
+        out = {}
+        for attr, value in vars(key).items():
+            if attr == "default":
+                if vars(value) != vars(defaults.default):
+                    out[attr] = vars(value)
+            elif not hasattr(defaults, attr) or getattr(defaults, attr) != value:
+                out[attr] = value
+        return out
+
+    @staticmethod
+    def key_from_json(data):
+        key = Key()
+        for attr, value in data.items():
+            if attr == "default":
+                key.default.__dict__.update(value)
+            else:
+                setattr(key, attr, value)
+        return key
+
+    def to_json(self):
+        defaults = Key()
+        return {
+            "keys": [self.key_to_json(key, defaults) for key in self.keys],
+            "encoders": [self.key_to_json(key, defaults) for key in self.encoders],
+            "rowcol": self.rowcol,
+            "encoderpos": self.encoderpos,
+        }
+
+    @classmethod
+    def from_json(cls, data):
+        return cls([cls.key_from_json(k) for k in data["keys"]],
+                   [cls.key_from_json(k) for k in data["encoders"]],
+                   [tuple(x) for x in data["rowcol"]],
+                   data["encoderpos"])
+
+
+class LayoutCache:
+    """
+    Memoizes ParsedLayout by a hash of the KLE keymap, so reconnecting the same keyboard
+    (or sideloading the same JSON again) skips KLE deserialization entirely.
+
+    Parsed layouts are kept in memory for the lifetime of the process; when a directory is set
+    they are also stored there, so they survive restarts. The Key objects are shared between
+    Keyboard instances and must be treated as read-only.
+    """
+
+    instance = None
+
+    def __init__(self, directory=None, max_entries=16):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    @classmethod
+    def get(cls):
+        if cls.instance is None:
+            cls.instance = cls()
+        return cls.instance
+
+    @staticmethod
+    def digest(keymap):
+        return hashlib.sha256(json.dumps(keymap, sort_keys=True, separators=(",", ":")).encode("utf-8")).hexdigest()
+
+    def path(self, digest):
+        return os.path.join(self.directory, digest + ".json")
+
+    def load(self, digest):
+        if self.directory is None:
+            return None
+        try:
+            with open(self.path(digest), "r") as inf:
+                return ParsedLayout.from_json(json.load(inf))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.warning("Failed to load cached layout %s: %s", digest, e)
+            return None
+
+    def store(self, digest, layout):
+        if self.directory is None:
+            return
+        try:
+            pathlib.Path(self.directory).mkdir(parents=True, exist_ok=True)
+            tmp = self.path(digest) + ".tmp"
+            with open(tmp, "w") as outf:
+                json.dump(layout.to_json(), outf, separators=(",", ":"))
+            os.replace(tmp, self.path(digest))
+        except OSError as e:
+            logging.warning("Failed to cache parsed layout: %s", e)
+
+    def parse(self, keymap):
+        """ Returns the ParsedLayout for a KLE keymap, parsing it only on a cache miss """
+        digest = self.digest(keymap)
+        layout = self.entries.get(digest)
+        if layout is None:
+            layout = self.load(digest)
+            if layout is None:
+                layout = ParsedLayout.parse(keymap)
+                self.store(digest, layout)
+            self.entries[digest] = layout
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        else:
+            self.entries.move_to_end(digest)
+        return layout
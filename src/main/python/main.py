@@ -76,6 +76,26 @@ if __name__ == '__main__':
 
         linux_keystroke_recorder()
     else:
+        if "--profile-reload" in sys.argv:
+            # profile loading the first keyboard that gets connected, see protocol/reload_profiler.py
+            from protocol.reload_profiler import ReloadProfiler
+
+            idx = sys.argv.index("--profile-reload")
+            if idx + 1 >= len(sys.argv):
+                sys.exit("usage: --profile-reload <trace.json>")
+            ReloadProfiler.arm(os.path.abspath(sys.argv[idx + 1]))
+            del sys.argv[idx:idx + 2]
+
+        if "--record-hid" in sys.argv:
+            # record the session with the first keyboard that gets connected, see hid_replay.py
+            from hid_replay import HidRecorder
+
+            idx = sys.argv.index("--record-hid")
+            if idx + 1 >= len(sys.argv):
+                sys.exit("usage: --record-hid <session.json>")
+            HidRecorder.arm(os.path.abspath(sys.argv[idx + 1]))
+            del sys.argv[idx:idx + 2]
+
         appctxt = VialApplicationContext()       # 1. Instantiate ApplicationContext
         init_logger()
         qt_exception_hook = UncaughtHook()
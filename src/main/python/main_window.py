@@ -15,9 +15,12 @@ from autorefresh.autorefresh import Autorefresh
 from editor.combos import Combos
 from constants import WINDOW_WIDTH, WINDOW_HEIGHT
 from widgets.editor_container import EditorContainer
+from widgets.hid_metrics_panel import HidMetricsPanel
 from editor.firmware_flasher import FirmwareFlasher
 from editor.key_override import KeyOverride
 from protocol.keyboard_comm import ProtocolError
+from protocol.reload_profiler import ReloadProfiler
+from packet_tracer import PacketTracer
 from editor.keymap_editor import KeymapEditor
 from keymaps import KEYMAPS
 from editor.layout_editor import LayoutEditor
@@ -27,6 +30,8 @@ from editor.rgb_configurator import RGBConfigurator
 from tabbed_keycodes import TabbedKeycodes
 from editor.tap_dance import TapDance
 from unlocker import Unlocker
+from definition_cache import DefinitionCache
+from layout_cache import LayoutCache
 from util import tr, EXAMPLE_KEYBOARDS, KeycodeDisplay, EXAMPLE_KEYBOARD_PREFIX
 from vial_device import VialKeyboard
 from editor.matrix_test import MatrixTest
@@ -103,6 +108,10 @@ class MainWindow(QMainWindow):
                         (self.apc_rt, "APC/RT Settings"), (self.dks, "DKS Settings"), (self.snaptap, "Snap Tap Settings"), (self.misc, "Misc settings"),
                         (self.rgb_strip, "RGB Led Strips"), (self.animation, "Animations"), (self.rgb_matrix, "RGB Matrix")]
 
+        # editors which show settings loaded by the background reload stages
+        self.background_editors = [self.apc_rt, self.dks, self.snaptap, self.misc, self.rgb_strip, self.animation,
+                                   self.rgb_matrix]
+
         Unlocker.global_layout_editor = self.layout_editor
         Unlocker.global_main_window = self
 
@@ -134,16 +143,27 @@ class MainWindow(QMainWindow):
         w.setLayout(layout)
         self.setCentralWidget(w)
 
+        self.hid_metrics_panel = HidMetricsPanel(self)
+        self.addDockWidget(Qt.BottomDockWidgetArea, self.hid_metrics_panel)
+        self.hid_metrics_panel.hide()
+
         self.init_menu()
 
         self.autorefresh = Autorefresh()
         self.autorefresh.devices_updated.connect(self.on_devices_updated)
+        self.autorefresh.reload_progress.connect(self.on_reload_progress)
+        self.autorefresh.write_failed.connect(self.on_write_failed)
+        self.write_failure_pending = False
 
         # cache for via definition files
         self.cache_path = QStandardPaths.writableLocation(QStandardPaths.CacheLocation)
         if not os.path.exists(self.cache_path):
             os.makedirs(self.cache_path)
 
+        # parsed keyboard layouts are kept across restarts
+        LayoutCache.get().directory = os.path.join(
+            QStandardPaths.writableLocation(QStandardPaths.AppLocalDataLocation), "layouts")
+
         # check if the via defitions already exist
         if os.path.isfile(os.path.join(self.cache_path, "via_keyboards.json")):
             with open(os.path.join(self.cache_path, "via_keyboards.json")) as vf:
@@ -176,6 +196,9 @@ class MainWindow(QMainWindow):
         download_via_stack_act = QAction(tr("MenuFile", "Download VIA definitions"), self)
         download_via_stack_act.triggered.connect(self.load_via_stack_json)
 
+        refresh_definition_act = QAction(tr("MenuFile", "Reload keyboard definition"), self)
+        refresh_definition_act.triggered.connect(self.on_refresh_definition)
+
         load_dummy_act = QAction(tr("MenuFile", "Load dummy JSON..."), self)
         load_dummy_act.triggered.connect(self.on_load_dummy)
 
@@ -190,6 +213,7 @@ class MainWindow(QMainWindow):
             file_menu.addSeparator()
             file_menu.addAction(sideload_json_act)
             file_menu.addAction(download_via_stack_act)
+            file_menu.addAction(refresh_definition_act)
             file_menu.addAction(load_dummy_act)
             file_menu.addSeparator()
             file_menu.addAction(exit_act)
@@ -243,6 +267,24 @@ class MainWindow(QMainWindow):
             if theme_group.checkedAction() is None:
                 theme_group.actions()[0].setChecked(True)
 
+        if sys.platform != "emscripten":
+            profile_reload_act = QAction(tr("MenuDebug", "Profile keyboard reload..."), self)
+            profile_reload_act.triggered.connect(self.on_profile_reload)
+
+            trace_packets_act = QAction(tr("MenuDebug", "Trace HID packets"), self)
+            trace_packets_act.setCheckable(True)
+            trace_packets_act.toggled.connect(self.on_trace_packets)
+
+            save_packet_trace_act = QAction(tr("MenuDebug", "Save packet trace..."), self)
+            save_packet_trace_act.triggered.connect(self.on_save_packet_trace)
+
+            self.debug_menu = self.menuBar().addMenu(tr("Menu", "Debug"))
+            self.debug_menu.addAction(profile_reload_act)
+            self.debug_menu.addAction(self.hid_metrics_panel.toggleViewAction())
+            self.debug_menu.addSeparator()
+            self.debug_menu.addAction(trace_packets_act)
+            self.debug_menu.addAction(save_packet_trace_act)
+
         about_vial_act = QAction(tr("MenuAbout", "About Vial..."), self)
         about_vial_act.triggered.connect(self.about_vial)
         self.about_keyboard_act = QAction("", self)
@@ -332,14 +374,59 @@ class MainWindow(QMainWindow):
                   self.rgb_strip, self.animation, self.rgb_matrix]:
             e.rebuild(self.autorefresh.current_device)
 
-    def refresh_tabs(self):
+    def on_reload_progress(self, device, stage, done, total):
+        if device is not self.autorefresh.current_device:
+            return
+
+        if done < total:
+            self.statusBar().showMessage(tr("MainWindow", "Loading keyboard settings ({}/{})...").format(done, total))
+        else:
+            self.statusBar().clearMessage()
+
+        if stage == "verify":
+            keyboard = device.keyboard
+            if keyboard.snapshot_stale:
+                # keyboard was reconfigured since the snapshot was taken, load it from scratch
+                self.on_device_selected()
+                return
+            if keyboard.snapshot_changes:
+                self.rebuild()
+                self.refresh_tabs(keep_current=True)
+
+        # tabs for settings that were still loading become available as their stage completes
+        changed = False
+        for e in self.background_editors:
+            if not e.valid():
+                e.rebuild(device)
+                changed = changed or e.valid()
+        if changed:
+            self.refresh_tabs(keep_current=True)
+
+    def on_write_failed(self, device, e):
+        if device is not self.autorefresh.current_device or self.write_failure_pending:
+            return
+        # what the editors show may not be on the keyboard, load it again once the failed writes are all in
+        logging.warning("write to the keyboard failed: {}".format(e))
+        self.write_failure_pending = True
+        QTimer.singleShot(0, self.on_write_failures)
+
+    def on_write_failures(self):
+        self.write_failure_pending = False
+        self.on_device_selected()
+        self.statusBar().showMessage(tr("MainWindow", "Writing to the keyboard failed, reloaded its settings."),
+                                     10000)
+
+    def refresh_tabs(self, keep_current=False):
+        current = self.current_tab.editor if keep_current and self.current_tab is not None else None
         self.tabs.clear()
         for container, lbl in self.editors:
             if not container.valid():
                 continue
 
             c = EditorContainer(container)
-            self.tabs.addTab(c, tr("MainWindow", lbl))
+            idx = self.tabs.addTab(c, tr("MainWindow", lbl))
+            if container is current:
+                self.tabs.setCurrentIndex(idx)
 
     def load_via_stack_json(self):
         from urllib.request import urlopen
@@ -361,6 +448,40 @@ class MainWindow(QMainWindow):
                 data = inf.read()
             self.autorefresh.sideload_via_json(data)
 
+    def on_refresh_definition(self):
+        """ Drops the cached definition of the current keyboard and downloads it again """
+        if isinstance(self.autorefresh.current_device, VialKeyboard) and not self.autorefresh.current_device.sideload:
+            cache = DefinitionCache.default()
+            if cache is not None:
+                cache.invalidate(self.autorefresh.current_device.keyboard.keyboard_id)
+            self.on_device_selected()
+
+    def on_profile_reload(self):
+        """ Reconnects the current keyboard with ReloadProfiler attached, saving a Chrome trace and a summary """
+        if not isinstance(self.autorefresh.current_device, VialKeyboard):
+            return
+        dialog = QFileDialog()
+        dialog.setDefaultSuffix("json")
+        dialog.setAcceptMode(QFileDialog.AcceptSave)
+        dialog.setNameFilters(["Chrome trace (*.json)"])
+        if dialog.exec_() == QDialog.Accepted:
+            ReloadProfiler.arm(dialog.selectedFiles()[0])
+            self.on_device_selected()
+
+    def on_trace_packets(self, checked):
+        if checked:
+            PacketTracer.get().enable()
+        else:
+            PacketTracer.get().disable()
+
+    def on_save_packet_trace(self):
+        dialog = QFileDialog()
+        dialog.setDefaultSuffix("pcapng")
+        dialog.setAcceptMode(QFileDialog.AcceptSave)
+        dialog.setNameFilters(["pcapng (*.pcapng)", "JSON lines (*.jsonl)"])
+        if dialog.exec_() == QDialog.Accepted:
+            PacketTracer.get().save(dialog.selectedFiles()[0])
+
     def on_load_dummy(self):
         dialog = QFileDialog()
         dialog.setDefaultSuffix("json")
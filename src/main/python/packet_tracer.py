@@ -0,0 +1,144 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+import json
+import struct
+import threading
+import time
+
+
+class PacketTracer:
+    """
+    Keeps the last `capacity` raw HID packets in a ring buffer, for debugging slow or flaky keyboards.
+
+    The buffer is a single bytearray allocated when tracing is enabled; each record is a fixed-size
+    slot holding a monotonic timestamp, direction, interface, original length and the first SNAPLEN
+    bytes of the packet, so recording never allocates. While disabled, call sites only check `enabled`.
+
+    The trace can be exported as pcapng (one Enhanced Packet Block per packet, direction in epb_flags)
+    or as JSON lines.
+    """
+
+    OUT = 0
+    IN = 1
+
+    # raw HID endpoint used by hid_send, and the AMK vendor endpoint used for animation uploads
+    IFACE_RAWHID = 0
+    IFACE_AMK_FAST = 1
+    INTERFACES = ["rawhid", "amk-fast"]
+
+    SNAPLEN = 64
+    HEADER = struct.Struct("<dBBH")
+    RECORD = HEADER.size + SNAPLEN
+
+    # pcapng
+    LINKTYPE_USER0 = 147
+
+    instance = None
+
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.buffer = None
+        self.head = 0
+        self.count = 0
+        # maps monotonic timestamps to wall clock time for the export
+        self.epoch = time.time() - time.monotonic()
+
+    @classmethod
+    def get(cls):
+        if cls.instance is None:
+            cls.instance = cls()
+        return cls.instance
+
+    def enable(self, capacity=None):
+        with self.lock:
+            if capacity is not None and capacity != self.capacity:
+                self.capacity = capacity
+                self.buffer = None
+            if self.buffer is None:
+                self.buffer = bytearray(self.capacity * self.RECORD)
+                self.head = self.count = 0
+            self.enabled = True
+
+    def disable(self):
+        """ Stops recording, packets recorded so far can still be exported """
+        self.enabled = False
+
+    def clear(self):
+        with self.lock:
+            self.head = self.count = 0
+
+    def record(self, direction, data, iface=IFACE_RAWHID):
+        if not self.enabled:
+            return
+        size = min(len(data), self.SNAPLEN)
+        with self.lock:
+            if self.buffer is None:
+                return
+            offset = self.head * self.RECORD
+            self.HEADER.pack_into(self.buffer, offset, time.monotonic(), direction, iface, len(data))
+            offset += self.HEADER.size
+            self.buffer[offset:offset + size] = memoryview(data)[:size]
+            self.head = (self.head + 1) % self.capacity
+            self.count = min(self.count + 1, self.capacity)
+
+    def packets(self):
+        """ List of (timestamp, direction, iface, original length, captured bytes), oldest first """
+        with self.lock:
+            if self.buffer is None:
+                return []
+            out = []
+            start = (self.head - self.count) % self.capacity
+            for n in range(self.count):
+                offset = ((start + n) % self.capacity) * self.RECORD
+                ts, direction, iface, length = self.HEADER.unpack_from(self.buffer, offset)
+                offset += self.HEADER.size
+                out.append((ts, direction, iface, length,
+                            bytes(self.buffer[offset:offset + min(length, self.SNAPLEN)])))
+            return out
+
+    def to_jsonl(self):
+        lines = []
+        for ts, direction, iface, length, data in self.packets():
+            lines.append(json.dumps({
+                "time": round(self.epoch + ts, 6),
+                "dir": "out" if direction == self.OUT else "in",
+                "iface": self.INTERFACES[iface],
+                "len": length,
+                "data": data.hex(),
+            }))
+        return "".join(line + "\n" for line in lines)
+
+    @staticmethod
+    def pcapng_block(block_type, body):
+        body += b"\x00" * (-len(body) % 4)
+        length = len(body) + 12
+        return struct.pack("<II", block_type, length) + body + struct.pack("<I", length)
+
+    @staticmethod
+    def pcapng_option(code, value):
+        return struct.pack("<HH", code, len(value)) + value + b"\x00" * (-len(value) % 4)
+
+    def to_pcapng(self):
+        end_of_options = b"\x00\x00\x00\x00"
+        out = [self.pcapng_block(0x0A0D0D0A, struct.pack("<IHHq", 0x1A2B3C4D, 1, 0, -1) + end_of_options)]
+        for name in self.INTERFACES:
+            out.append(self.pcapng_block(1, struct.pack("<HHI", self.LINKTYPE_USER0, 0, self.SNAPLEN)
+                                         + self.pcapng_option(2, name.encode()) + end_of_options))
+        for ts, direction, iface, length, data in self.packets():
+            us = int((self.epoch + ts) * 1000000)
+            # epb_flags direction: 1 inbound, 2 outbound
+            flags = self.pcapng_option(2, struct.pack("<I", 1 if direction == self.IN else 2))
+            body = struct.pack("<IIIII", iface, us >> 32, us & 0xFFFFFFFF, len(data), length)
+            body += data + b"\x00" * (-len(data) % 4)
+            out.append(self.pcapng_block(6, body + flags + end_of_options))
+        return b"".join(out)
+
+    def save(self, path):
+        """ Exports to pcapng, or to JSON lines if the path ends with .jsonl """
+        if path.endswith(".jsonl"):
+            with open(path, "w") as outf:
+                outf.write(self.to_jsonl())
+        else:
+            with open(path, "wb") as outf:
+                outf.write(self.to_pcapng())
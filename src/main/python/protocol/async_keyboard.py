@@ -0,0 +1,232 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+import asyncio
+import threading
+import time
+from concurrent.futures import Future
+
+from hid_metrics import HidMetrics
+from packet_tracer import PacketTracer
+from protocol.keyboard_comm import Keyboard
+from retry_policy import RetryPolicy
+from util import MSG_LEN, ResponseReader
+
+
+class AsyncHidTransport:
+    """
+    Talks to a hidapi device without blocking the event loop: the device is switched to
+    non-blocking mode and responses are polled for, so any number of devices can share one loop.
+    """
+
+    def __init__(self, dev, policy=None, poll_interval=0.001):
+        self.dev = dev
+        self.policy = policy if policy is not None else RetryPolicy()
+        self.poll_interval = poll_interval
+        # created by attach(), on 3.6 a lock belongs to the loop that was current when it was created
+        self.lock = None
+        self.loop = None
+
+        set_nonblocking = getattr(dev, "set_nonblocking", None)
+        if set_nonblocking is not None:
+            set_nonblocking(1)
+
+    def attach(self):
+        # inside a coroutine get_event_loop() returns the running loop
+        loop = asyncio.get_event_loop()
+        if loop is not self.loop:
+            self.loop = loop
+            self.lock = asyncio.Lock()
+
+    async def read(self, timeout):
+        """ Waits up to `timeout` seconds for a response, returns b"" if none arrived """
+        end = time.monotonic() + timeout
+        while True:
+            data = bytes(self.dev.read(MSG_LEN))
+            if data or time.monotonic() >= end:
+                return data
+            await asyncio.sleep(self.poll_interval)
+
+    async def read_response(self, msg, deadline):
+        """ Async version of util.hid_read_response """
+        reader = ResponseReader(msg)
+        while True:
+            data = reader.feed(await self.read(self.policy.timeout_ms(deadline) / 1000))
+            if data is not None:
+                return data
+
+    async def drain(self, timeout_ms):
+        try:
+            while await self.read(timeout_ms / 1000):
+                pass
+        except OSError:
+            pass
+
+    async def send(self, msg, retries=1):
+        """ Same semantics as util.hid_send """
+        if len(msg) > MSG_LEN:
+            raise RuntimeError("message must be less than 32 bytes")
+        msg += b"\x00" * (MSG_LEN - len(msg))
+
+        self.attach()
+        policy = self.policy
+        # one request in flight per device, responses carry no sequence number
+        async with self.lock:
+            if policy.stale and policy.drain_stale:
+                await self.drain(policy.drain_timeout_ms())
+            policy.stale = False
+
+            data = b""
+            deadline = policy.start()
+            attempt = timeouts = 0
+            started = time.monotonic()
+
+            while attempt < retries:
+                if attempt > 0:
+                    delay = policy.backoff(attempt)
+                    if policy.expired(deadline, delay):
+                        break
+                    await asyncio.sleep(delay)
+                attempt += 1
+                try:
+                    # add 00 at start for hidapi report id
+                    if self.dev.write(b"\x00" + msg) != MSG_LEN + 1:
+                        continue
+                    PacketTracer.get().record(PacketTracer.OUT, msg)
+
+                    sent_at = time.monotonic()
+                    data = await self.read_response(msg, deadline)
+                    if not data:
+                        timeouts += 1
+                        policy.on_timeout()
+                        continue
+                    policy.observe(time.monotonic() - sent_at)
+                except OSError:
+                    continue
+                break
+
+            HidMetrics.get().record(msg, latency=time.monotonic() - started, retries=max(0, attempt - 1),
+                                    timeouts=timeouts, bytes_out=attempt * MSG_LEN, bytes_in=len(data),
+                                    ok=bool(data))
+            if not data:
+                raise RuntimeError("failed to communicate with the device")
+            return data
+
+    async def send_many(self, msgs, retries=1):
+        return [await self.send(msg, retries=retries) for msg in msgs]
+
+
+class AsyncKeyboard:
+    """
+    asyncio front-end for Keyboard, meant for driving keyboards from scripts without Qt.
+
+    Setters which only write to the device (set_key, combo_set, set_macro, the AMK apply_* calls...)
+    run on the event loop itself: the packets they produce are collected and then sent through
+    the non-blocking transport. Calls which need responses (reload, or anything through call())
+    run the protocol code in the loop's default executor while the HID traffic itself is still
+    performed by the event loop.
+
+        async with AsyncKeyboard(dev) as kb:
+            await kb.reload()
+            await kb.set_key(0, 0, 0, "KC_A")
+    """
+
+    WRITE_METHODS = [
+        "set_key", "set_encoder", "set_layout_options", "qmk_settings_set", "qmk_settings_reset",
+        "combo_set", "tap_dance_set", "key_override_set", "set_macro",
+        "apply_apc", "apply_rt", "apply_dks", "apply_poll_rate", "apply_debounce", "apply_nkro",
+        "apply_pole", "apply_profile", "apply_dks_disable", "apply_rt_sensitivity",
+        "apply_top_sensitivity", "apply_btm_sensitivity", "apply_apc_sensitivity",
+        "apply_noise_sensitivity", "apply_rgb_strip_led", "apply_rgb_strip_mode",
+        "apply_rgb_indicator", "apply_rgb_matrix_led", "apply_rgb_matrix_mode",
+    ]
+
+    def __init__(self, dev, retry_policy=None, poll_interval=0.001, keyboard_cls=Keyboard):
+        self.dev = dev
+        self.transport = AsyncHidTransport(dev, retry_policy, poll_interval)
+        self.keyboard = keyboard_cls(dev, usb_send=self.bridge_send, usb_send_many=self.bridge_send_many)
+        self.keyboard.usb_post = self.post
+        # see AsyncHidTransport.attach()
+        self.lock = None
+        self.loop = None
+        self.loop_thread = None
+        # packets produced by a write-only setter running on the event loop
+        self.pending = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.dev.close()
+
+    def on_loop_thread(self):
+        return threading.current_thread() is self.loop_thread
+
+    def attach(self):
+        # asyncio.get_running_loop() is 3.7+, inside a coroutine get_event_loop() returns the running loop
+        loop = asyncio.get_event_loop()
+        if loop is not self.loop:
+            self.loop = loop
+            self.lock = asyncio.Lock()
+        self.loop_thread = threading.current_thread()
+        self.transport.attach()
+
+    def bridge_send(self, dev, msg, retries=1):
+        if self.loop is None or self.on_loop_thread():
+            raise RuntimeError("this call needs a response from the device, use AsyncKeyboard.call()")
+        return asyncio.run_coroutine_threadsafe(self.transport.send(msg, retries=retries), self.loop).result()
+
+    def bridge_send_many(self, dev, msgs, retries=1):
+        if self.loop is None or self.on_loop_thread():
+            raise RuntimeError("this call needs a response from the device, use AsyncKeyboard.call()")
+        return asyncio.run_coroutine_threadsafe(self.transport.send_many(msgs, retries=retries), self.loop).result()
+
+    def post(self, dev, msg, retries=1):
+        if self.pending is not None:
+            future = Future()
+            self.pending.append((future, msg, retries))
+            return future
+        # posted from protocol code running in the executor, e.g. restore_layout()
+        future = Future()
+        future.set_result(self.bridge_send(dev, msg, retries=retries))
+        return future
+
+    async def call(self, name, *args, **kwargs):
+        """ Runs any Keyboard method, off the event loop, and returns its result """
+        self.attach()
+        async with self.lock:
+            return await self.loop.run_in_executor(None, lambda: getattr(self.keyboard, name)(*args, **kwargs))
+
+    async def write(self, name, *args, **kwargs):
+        """ Runs a write-only Keyboard method and sends the packets it produced """
+        self.attach()
+        async with self.lock:
+            self.pending = []
+            try:
+                ret = getattr(self.keyboard, name)(*args, **kwargs)
+            finally:
+                pending, self.pending = self.pending, None
+            for future, msg, retries in pending:
+                try:
+                    future.set_result(await self.transport.send(msg, retries=retries))
+                except Exception as e:
+                    future.set_exception(e)
+                    raise
+            return ret
+
+    async def reload(self, override_json=None):
+        await self.call("reload", override_json)
+
+
+def _write_method(name):
+    async def method(self, *args, **kwargs):
+        return await self.write(name, *args, **kwargs)
+
+    method.__name__ = method.__qualname__ = name
+    method.__doc__ = "Async version of Keyboard.{}".format(name)
+    return method
+
+
+for _name in AsyncKeyboard.WRITE_METHODS:
+    setattr(AsyncKeyboard, _name, _write_method(_name))
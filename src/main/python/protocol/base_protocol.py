@@ -7,6 +7,9 @@ from protocol.constants import CMD_VIA_VIAL_PREFIX, CMD_VIAL_DYNAMIC_ENTRY_OP
 class BaseProtocol:
     vial_protocol = None
     usb_send = NotImplemented
+    usb_send_many = NotImplemented
+    usb_post = NotImplemented
+    worker = None
     dev = None
 
     macro_count = 0
@@ -15,12 +18,12 @@ class BaseProtocol:
 
     def _retrieve_dynamic_entries(self, cmd, count, fmt):
         out = []
-        for x in range(count):
-            data = self.usb_send(
-                self.dev,
-                struct.pack("BBBB", CMD_VIA_VIAL_PREFIX, CMD_VIAL_DYNAMIC_ENTRY_OP, cmd, x),
-                retries=20
-            )
+        responses = self.usb_send_many(
+            self.dev,
+            [struct.pack("BBBB", CMD_VIA_VIAL_PREFIX, CMD_VIAL_DYNAMIC_ENTRY_OP, cmd, x) for x in range(count)],
+            retries=20
+        )
+        for x, data in enumerate(responses):
             if data[0] != 0:
                 raise RuntimeError("failed retrieving dynamic={} entry {} from the device".format(cmd, x))
             out.append(struct.unpack(fmt, data[1:1 + struct.calcsize(fmt)]))
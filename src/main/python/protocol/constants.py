@@ -14,6 +14,9 @@ CMD_VIA_MACRO_GET_BUFFER = 0x0E
 CMD_VIA_MACRO_SET_BUFFER = 0x0F
 CMD_VIA_GET_LAYER_COUNT = 0x11
 CMD_VIA_KEYMAP_GET_BUFFER = 0x12
+CMD_VIA_KEYMAP_SET_BUFFER = 0x13
+# first byte of the response to a command the firmware doesn't implement
+CMD_VIA_UNHANDLED = 0xFF
 CMD_VIA_VIAL_PREFIX = 0xFE
 VIA_LAYOUT_OPTIONS = 0x02
 VIA_SWITCH_MATRIX_STATE = 0x03
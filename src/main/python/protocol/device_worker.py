@@ -0,0 +1,149 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+import logging
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import Future
+
+
+class DeviceWorker:
+    """
+    Owns a device handle and performs all I/O on it from a single dedicated thread.
+
+    Requests are queued in order: call() blocks until its request is done, while post()
+    returns a Future right away so that writes issued from the GUI thread do not stall painting.
+    """
+
+    def __init__(self, name="device"):
+        self.name = name
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name="{} I/O".format(name), daemon=True)
+        self.running = True
+
+        # how much time the GUI thread spent waiting on I/O, versus how much I/O it
+        # handed off to this thread which would otherwise have blocked it
+        self.gui_blocked = 0.0
+        self.gui_offloaded = 0.0
+        self.gui_blocking_calls = self.gui_posted_calls = 0
+
+        self.thread.start()
+
+    def run(self):
+        while True:
+            item = self.requests.get()
+            if item is None:
+                break
+            future, fn, args, kwargs, from_gui = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            started = time.monotonic()
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+            if from_gui:
+                self.gui_offloaded += time.monotonic() - started
+
+    def on_worker_thread(self):
+        return threading.current_thread() is self.thread
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        if not self.running:
+            future.set_exception(RuntimeError("{} I/O worker is stopped".format(self.name)))
+            return future
+        if self.on_worker_thread():
+            # nested request made by a request which is already executing here
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        from_gui = threading.current_thread() is threading.main_thread()
+        self.requests.put((future, fn, args, kwargs, from_gui))
+        return future
+
+    def call(self, fn, *args, **kwargs):
+        """ Runs fn on the worker thread and waits for its result """
+        if self.on_worker_thread():
+            return fn(*args, **kwargs)
+        from_gui = threading.current_thread() is threading.main_thread()
+        started = time.monotonic()
+        future = Future()
+        if self.running:
+            self.requests.put((future, fn, args, kwargs, False))
+        else:
+            future.set_exception(RuntimeError("{} I/O worker is stopped".format(self.name)))
+        try:
+            return future.result()
+        finally:
+            if from_gui:
+                self.gui_blocked += time.monotonic() - started
+                self.gui_blocking_calls += 1
+
+    def post(self, fn, *args, **kwargs):
+        """ Queues fn to run on the worker thread, failures are logged unless the caller checks the Future """
+        if threading.current_thread() is threading.main_thread():
+            self.gui_posted_calls += 1
+        future = self.submit(fn, *args, **kwargs)
+        future.add_done_callback(self.log_failure)
+        return future
+
+    def log_failure(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            logging.warning("{}: queued request failed: {}".format(self.name, future.exception()))
+
+    def stats(self):
+        return {
+            "gui_blocked": self.gui_blocked,
+            "gui_blocking_calls": self.gui_blocking_calls,
+            "gui_offloaded": self.gui_offloaded,
+            "gui_posted_calls": self.gui_posted_calls,
+        }
+
+    def stop(self):
+        """ Finishes all queued requests and stops the thread """
+        if not self.running:
+            return
+        self.running = False
+        self.requests.put(None)
+        if not self.on_worker_thread():
+            self.thread.join()
+        logging.info("{}: GUI thread blocked on I/O for {:.3f}s over {} calls, {:.3f}s of I/O over {} calls "
+                     "queued without blocking".format(self.name, self.gui_blocked, self.gui_blocking_calls,
+                                                      self.gui_offloaded, self.gui_posted_calls))
+
+
+class InlineWorker:
+    """ Same interface as DeviceWorker but executes everything on the calling thread """
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def call(self, fn, *args, **kwargs):
+        return fn(*args, **kwargs)
+
+    def post(self, fn, *args, **kwargs):
+        future = self.submit(fn, *args, **kwargs)
+        # without a worker thread the caller is still synchronous, so keep raising errors in place
+        future.result()
+        return future
+
+    def stats(self):
+        return {}
+
+    def stop(self):
+        pass
+
+
+def create_worker(name="device"):
+    # webassembly builds have no threads
+    if sys.platform == "emscripten":
+        return InlineWorker()
+    return DeviceWorker(name)
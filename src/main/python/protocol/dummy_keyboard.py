@@ -29,6 +29,9 @@ class DummyKeyboard(Keyboard):
     def set_key(self, layer, row, col, code):
         self.layout[(layer, row, col)] = code
 
+    def set_keys(self, keys):
+        self.layout.update(keys)
+
     def set_encoder(self, layer, index, direction, code):
         self.encoder_layout[(layer, index, direction)] = code
 
@@ -0,0 +1,724 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+import json
+import lzma
+import struct
+import threading
+import time
+from collections import deque
+
+from amk.protocol import AMK_PROTOCOL_PREFIX, AMK_PROTOCOL_OK, AMK_PROTOCOL_GET_VERSION, AMK_PROTOCOL_GET_APC, \
+    AMK_PROTOCOL_SET_APC, AMK_PROTOCOL_GET_RT, AMK_PROTOCOL_SET_RT, AMK_PROTOCOL_GET_DKS, AMK_PROTOCOL_SET_DKS, \
+    AMK_PROTOCOL_GET_POLL_RATE, AMK_PROTOCOL_GET_DOWN_DEBOUNCE, AMK_PROTOCOL_GET_UP_DEBOUNCE, AMK_PROTOCOL_GET_NKRO, \
+    AMK_PROTOCOL_GET_MS_CONFIG, AMK_PROTOCOL_GET_RT_SENS, AMK_PROTOCOL_GET_TOP_SENS, AMK_PROTOCOL_GET_BTM_SENS, \
+    AMK_PROTOCOL_GET_APC_SENS, AMK_PROTOCOL_GET_NOISE_SENS, AMK_PROTOCOL_GET_RGB_STRIP_COUNT, \
+    AMK_PROTOCOL_GET_RGB_STRIP_PARAM, AMK_PROTOCOL_GET_RGB_STRIP_LED, AMK_PROTOCOL_SET_RGB_STRIP_LED, \
+    AMK_PROTOCOL_GET_RGB_STRIP_MODE, AMK_PROTOCOL_SET_RGB_STRIP_MODE, AMK_PROTOCOL_GET_RGB_INDICATOR_LED, \
+    AMK_PROTOCOL_SET_RGB_INDICATOR_LED, AMK_PROTOCOL_GET_FILE_SYSTEM_INFO, AMK_PROTOCOL_GET_FILE_INFO, \
+    AMK_PROTOCOL_OPEN_FILE, AMK_PROTOCOL_WRITE_FILE, AMK_PROTOCOL_READ_FILE, AMK_PROTOCOL_CLOSE_FILE, \
+    AMK_PROTOCOL_DELETE_FILE, AMK_PROTOCOL_DISPLAY_CONTROL, AMK_PROTOCOL_GET_RGB_MATRIX_INFO, \
+    AMK_PROTOCOL_GET_RGB_MATRIX_ROW_INFO, AMK_PROTOCOL_GET_RGB_MATRIX_MODE, AMK_PROTOCOL_SET_RGB_MATRIX_MODE, \
+    AMK_PROTOCOL_GET_RGB_MATRIX_LED, AMK_PROTOCOL_SET_RGB_MATRIX_LED, AMK_PROTOCOL_GET_SNAPTAP, \
+    AMK_PROTOCOL_SET_SNAPTAP, AMK_PROTOCOL_GET_SNAPTAP_COUNT, AMK_PROTOCOL_GET_SNAPTAP_CONFIG, \
+    AMK_PROTOCOL_SET_DATETIME, AMK_PROTOCOL_GET_DATETIME
+from protocol.constants import CMD_VIA_GET_PROTOCOL_VERSION, CMD_VIA_GET_KEYBOARD_VALUE, CMD_VIA_SET_KEYBOARD_VALUE, \
+    CMD_VIA_GET_KEYCODE, CMD_VIA_SET_KEYCODE, CMD_VIA_LIGHTING_SET_VALUE, CMD_VIA_LIGHTING_GET_VALUE, \
+    CMD_VIA_LIGHTING_SAVE, CMD_VIA_MACRO_GET_COUNT, CMD_VIA_MACRO_GET_BUFFER_SIZE, CMD_VIA_MACRO_GET_BUFFER, \
+    CMD_VIA_MACRO_SET_BUFFER, CMD_VIA_GET_LAYER_COUNT, CMD_VIA_KEYMAP_GET_BUFFER, CMD_VIA_KEYMAP_SET_BUFFER, \
+    CMD_VIA_VIAL_PREFIX, \
+    VIA_LAYOUT_OPTIONS, VIA_SWITCH_MATRIX_STATE, VIALRGB_GET_INFO, VIALRGB_GET_SUPPORTED, \
+    CMD_VIAL_GET_KEYBOARD_ID, CMD_VIAL_GET_SIZE, CMD_VIAL_GET_DEFINITION, CMD_VIAL_GET_ENCODER, \
+    CMD_VIAL_SET_ENCODER, CMD_VIAL_GET_UNLOCK_STATUS, CMD_VIAL_UNLOCK_START, CMD_VIAL_UNLOCK_POLL, CMD_VIAL_LOCK, \
+    CMD_VIAL_QMK_SETTINGS_QUERY, CMD_VIAL_QMK_SETTINGS_GET, CMD_VIAL_QMK_SETTINGS_SET, CMD_VIAL_QMK_SETTINGS_RESET, \
+    CMD_VIAL_DYNAMIC_ENTRY_OP, DYNAMIC_VIAL_GET_NUMBER_OF_ENTRIES, DYNAMIC_VIAL_TAP_DANCE_GET, \
+    DYNAMIC_VIAL_TAP_DANCE_SET, DYNAMIC_VIAL_COMBO_GET, DYNAMIC_VIAL_COMBO_SET, DYNAMIC_VIAL_KEY_OVERRIDE_GET, \
+    DYNAMIC_VIAL_KEY_OVERRIDE_SET
+from util import MSG_LEN
+
+CMD_VIA_RESET = 0x0B
+
+# the AMK vendor endpoint used for fast animation transfers
+FAST_PACKET_LEN = 64
+FAST_HEADER_LEN = 8
+
+# name field of AMK_PROTOCOL_GET_FILE_INFO
+FILE_NAME_LEN = 13
+
+
+class KeyboardEmulator:
+    """
+    A keyboard in software: keeps the state a Vial/VIA firmware with the AMK extensions would
+    (keymap, encoders, macros, dynamic entries, QMK settings, lighting, per-key APC/RT/DKS,
+    RGB strips and matrix, animation files) and answers requests from it.
+
+    It can be used as the usb_send function, which answers one request at a time, or as the
+    hidapi device itself so that batches of requests are pipelined like with real hardware:
+
+        emu = KeyboardEmulator(layers=32, combo_count=255, latency=0.001)
+        kb = Keyboard(emu, usb_send=emu.usb_send)
+        kb = Keyboard(emu)
+
+    Every packet takes `latency` seconds to be answered. Unless a definition is passed, a
+    keyboard with one key per matrix position is made up; `keyboard_type` ("ms", "ms_v2",
+    "ec", "mx") makes it an AMK keyboard with the animation and RGB matrix features.
+    keymap_set_buffer=False emulates firmware without the keymap set-buffer command.
+    """
+
+    # qsids of qmk_settings.json
+    DEFAULT_QMK_SETTINGS = tuple(range(1, 22))
+
+    def __init__(self, definition=None, rows=6, cols=16, layers=4, macro_count=16, macro_memory=900,
+                 tap_dance_count=8, combo_count=8, key_override_count=8, qmk_settings=DEFAULT_QMK_SETTINGS,
+                 keyboard_type="", rgb_strips=(), rgb_matrix_leds=0, snaptap_count=0,
+                 file_system_size=16 * 1024 * 1024, latency=0, keyboard_id=0x1E3A7C0FFEE5D00D, via_protocol=9,
+                 vial_protocol=6, locked=False, unlock_keys=((0, 0),), keymap_set_buffer=True):
+        if definition is None:
+            definition = self.make_definition(rows, cols, keyboard_type, rgb_strips, rgb_matrix_leds, snaptap_count)
+        self.definition = definition
+        self.compressed_definition = lzma.compress(json.dumps(definition).encode("utf-8"))
+        self.rows = definition["matrix"]["rows"]
+        self.cols = definition["matrix"]["cols"]
+        self.layers = layers
+        self.keyboard_id = keyboard_id
+        self.via_protocol = via_protocol
+        self.vial_protocol = vial_protocol
+        self.latency = latency
+        self.lock = threading.RLock()
+
+        # big-endian u16 per key, layer by layer, as returned by CMD_VIA_KEYMAP_GET_BUFFER
+        self.keymap = bytearray(layers * self.rows * self.cols * 2)
+        self.encoders = dict()
+        self.layout_options = 0
+        self.matrix_state = bytearray(MSG_LEN - 2)
+
+        self.macro_count = macro_count
+        self.macro = bytearray(macro_memory)
+
+        self.tap_dance = [bytes(10)] * tap_dance_count
+        self.combo = [bytes(10)] * combo_count
+        self.key_override = [bytes(10)] * key_override_count
+
+        self.qmk_settings_supported = sorted(qmk_settings)
+        self.qmk_settings = dict()
+
+        self.lighting = dict()
+        self.lighting_saved = 0
+        self.vialrgb_effects = list(range(4))
+
+        self.unlocked = not locked
+        self.unlock_counter = 0
+        self.unlock_keys = list(unlock_keys)[:15]
+
+        # AMK per-key tables, by (profile, row, col) for APC/RT and (row, col) for DKS
+        self.apc = dict()
+        self.rt = dict()
+        self.dks = dict()
+        self.amk_values = {
+            AMK_PROTOCOL_GET_POLL_RATE: 0,
+            AMK_PROTOCOL_GET_DOWN_DEBOUNCE: 0,
+            AMK_PROTOCOL_GET_UP_DEBOUNCE: 5,
+            AMK_PROTOCOL_GET_NKRO: 1,
+            AMK_PROTOCOL_GET_MS_CONFIG: 0,
+            AMK_PROTOCOL_GET_RT_SENS: 80,
+            AMK_PROTOCOL_GET_TOP_SENS: 100,
+            AMK_PROTOCOL_GET_BTM_SENS: 150,
+            AMK_PROTOCOL_GET_APC_SENS: 80,
+            AMK_PROTOCOL_GET_NOISE_SENS: 50,
+            AMK_PROTOCOL_GET_SNAPTAP_CONFIG: 0,
+        }
+        self.datetime = bytes(8)
+
+        # [index, config, start, count, mode] for each strip given as (config, start, count),
+        # LEDs are kept as hue, sat, val, param by their global index
+        self.rgb_strips = [[x, config, start, count, 0] for x, (config, start, count) in enumerate(rgb_strips)]
+        matrix = definition.get("amk_rgb_matrix", {"start": 0, "count": 0})
+        self.rgb_matrix_start = matrix["start"]
+        self.rgb_matrix_count = matrix["count"]
+        self.rgb_matrix_mode = [0, 0, 1, 0]
+        self.rgb_leds = dict()
+        self.snaptap = [bytes(5)] * snaptap_count
+
+        self.file_system_size = file_system_size
+        self.files = []
+        self.open_files = dict()
+        self.playing = 0
+
+        self.requests = 0
+        self.in_flight = deque()
+        self.nonblocking = False
+
+        self.handlers = {
+            CMD_VIA_GET_PROTOCOL_VERSION: self.on_protocol_version,
+            CMD_VIA_GET_KEYBOARD_VALUE: self.on_get_keyboard_value,
+            CMD_VIA_SET_KEYBOARD_VALUE: self.on_set_keyboard_value,
+            CMD_VIA_GET_KEYCODE: self.on_get_keycode,
+            CMD_VIA_SET_KEYCODE: self.on_set_keycode,
+            CMD_VIA_RESET: self.on_echo,
+            CMD_VIA_LIGHTING_SET_VALUE: self.on_lighting_set,
+            CMD_VIA_LIGHTING_GET_VALUE: self.on_lighting_get,
+            CMD_VIA_LIGHTING_SAVE: self.on_lighting_save,
+            CMD_VIA_MACRO_GET_COUNT: self.on_macro_count,
+            CMD_VIA_MACRO_GET_BUFFER_SIZE: self.on_macro_size,
+            CMD_VIA_MACRO_GET_BUFFER: self.on_macro_get,
+            CMD_VIA_MACRO_SET_BUFFER: self.on_macro_set,
+            CMD_VIA_GET_LAYER_COUNT: self.on_layer_count,
+            CMD_VIA_KEYMAP_GET_BUFFER: self.on_keymap_get,
+            CMD_VIA_KEYMAP_SET_BUFFER: self.on_keymap_set,
+            CMD_VIA_VIAL_PREFIX: self.on_vial,
+            AMK_PROTOCOL_PREFIX: self.on_amk,
+        }
+        if not keymap_set_buffer:
+            # like firmware predating the command, it then answers as an unhandled one
+            del self.handlers[CMD_VIA_KEYMAP_SET_BUFFER]
+        self.vial_handlers = {
+            CMD_VIAL_GET_KEYBOARD_ID: self.on_keyboard_id,
+            CMD_VIAL_GET_SIZE: self.on_definition_size,
+            CMD_VIAL_GET_DEFINITION: self.on_definition,
+            CMD_VIAL_GET_ENCODER: self.on_get_encoder,
+            CMD_VIAL_SET_ENCODER: self.on_set_encoder,
+            CMD_VIAL_GET_UNLOCK_STATUS: self.on_unlock_status,
+            CMD_VIAL_UNLOCK_START: self.on_unlock_start,
+            CMD_VIAL_UNLOCK_POLL: self.on_unlock_poll,
+            CMD_VIAL_LOCK: self.on_lock,
+            CMD_VIAL_QMK_SETTINGS_QUERY: self.on_settings_query,
+            CMD_VIAL_QMK_SETTINGS_GET: self.on_settings_get,
+            CMD_VIAL_QMK_SETTINGS_SET: self.on_settings_set,
+            CMD_VIAL_QMK_SETTINGS_RESET: self.on_settings_reset,
+            CMD_VIAL_DYNAMIC_ENTRY_OP: self.on_dynamic,
+        }
+        self.amk_handlers = {
+            AMK_PROTOCOL_GET_VERSION: self.on_amk_version,
+            AMK_PROTOCOL_GET_APC: self.on_get_apc,
+            AMK_PROTOCOL_SET_APC: self.on_set_apc,
+            AMK_PROTOCOL_GET_RT: self.on_get_rt,
+            AMK_PROTOCOL_SET_RT: self.on_set_rt,
+            AMK_PROTOCOL_GET_DKS: self.on_get_dks,
+            AMK_PROTOCOL_SET_DKS: self.on_set_dks,
+            AMK_PROTOCOL_GET_RGB_STRIP_COUNT: self.on_strip_count,
+            AMK_PROTOCOL_GET_RGB_STRIP_PARAM: self.on_strip_param,
+            AMK_PROTOCOL_GET_RGB_STRIP_MODE: self.on_get_strip_mode,
+            AMK_PROTOCOL_SET_RGB_STRIP_MODE: self.on_set_strip_mode,
+            AMK_PROTOCOL_GET_RGB_STRIP_LED: self.on_get_led,
+            AMK_PROTOCOL_SET_RGB_STRIP_LED: self.on_set_led,
+            AMK_PROTOCOL_GET_RGB_INDICATOR_LED: self.on_get_indicator,
+            AMK_PROTOCOL_SET_RGB_INDICATOR_LED: self.on_set_indicator,
+            AMK_PROTOCOL_GET_RGB_MATRIX_INFO: self.on_matrix_info,
+            AMK_PROTOCOL_GET_RGB_MATRIX_ROW_INFO: self.on_matrix_row_info,
+            AMK_PROTOCOL_GET_RGB_MATRIX_MODE: self.on_get_matrix_mode,
+            AMK_PROTOCOL_SET_RGB_MATRIX_MODE: self.on_set_matrix_mode,
+            AMK_PROTOCOL_GET_RGB_MATRIX_LED: self.on_get_led,
+            AMK_PROTOCOL_SET_RGB_MATRIX_LED: self.on_set_led,
+            AMK_PROTOCOL_GET_SNAPTAP_COUNT: self.on_snaptap_count,
+            AMK_PROTOCOL_GET_SNAPTAP: self.on_get_snaptap,
+            AMK_PROTOCOL_SET_SNAPTAP: self.on_set_snaptap,
+            AMK_PROTOCOL_GET_DATETIME: self.on_get_datetime,
+            AMK_PROTOCOL_SET_DATETIME: self.on_set_datetime,
+            AMK_PROTOCOL_GET_FILE_SYSTEM_INFO: self.on_file_system_info,
+            AMK_PROTOCOL_GET_FILE_INFO: self.on_file_info,
+            AMK_PROTOCOL_OPEN_FILE: self.on_open_file,
+            AMK_PROTOCOL_WRITE_FILE: self.on_write_file,
+            AMK_PROTOCOL_READ_FILE: self.on_read_file,
+            AMK_PROTOCOL_CLOSE_FILE: self.on_close_file,
+            AMK_PROTOCOL_DELETE_FILE: self.on_delete_file,
+            AMK_PROTOCOL_DISPLAY_CONTROL: self.on_display_control,
+        }
+        # the remaining AMK settings are single bytes, each SET command directly follows its GET
+        for cmd in self.amk_values:
+            self.amk_handlers[cmd] = self.on_get_amk_value
+            self.amk_handlers[cmd + 1] = self.on_set_amk_value
+
+    @staticmethod
+    def make_definition(rows, cols, keyboard_type="", rgb_strips=(), rgb_matrix_leds=0, snaptap_count=0):
+        """ Definition of a keyboard with one key per matrix position """
+        definition = {
+            "name": "Emulated keyboard",
+            "matrix": {"rows": rows, "cols": cols},
+            "layouts": {"keymap": [["{},{}".format(row, col) for col in range(cols)] for row in range(rows)]},
+        }
+        if keyboard_type:
+            definition["keyboardType"] = keyboard_type
+            definition["keyboardSpeed"] = "hs"
+            definition["animation"] = {"format": [{"name": "Animation", "mode": 0, "suffix": "anim"}]}
+            if rgb_strips:
+                definition["lighting"] = "amk_rgblight"
+            if rgb_matrix_leds:
+                definition["amk_rgb_matrix"] = {"start": 0, "count": rgb_matrix_leds}
+            if snaptap_count:
+                definition["amkFeature"] = ["snaptap"]
+        return definition
+
+    def handle(self, msg, length=MSG_LEN):
+        """ Returns the response to one request """
+        with self.lock:
+            self.requests += 1
+            out = bytearray(length)
+            handler = self.handlers.get(msg[0])
+            if handler is None:
+                out[0] = 0xFF
+            else:
+                handler(bytes(msg), out)
+            return bytes(out)
+
+    def usb_send(self, dev, msg, retries=1):
+        """ Drop-in for hid_send """
+        if len(msg) > MSG_LEN:
+            raise RuntimeError("message must be less than 32 bytes")
+        if self.latency:
+            time.sleep(self.latency)
+        return self.handle(msg + b"\x00" * (MSG_LEN - len(msg)))
+
+    # hidapi device interface; responses become readable `latency` seconds after their request
+
+    def write(self, data):
+        # strip the hidapi report id
+        response = self.handle(bytes(data[1:MSG_LEN + 1]))
+        self.in_flight.append((response, time.monotonic() + self.latency))
+        return len(data)
+
+    def read(self, length, timeout_ms=0):
+        if not self.in_flight:
+            if timeout_ms > 0 and not self.nonblocking:
+                time.sleep(timeout_ms / 1000)
+            return b""
+        response, ready_at = self.in_flight[0]
+        delay = ready_at - time.monotonic()
+        if delay > 0:
+            if self.nonblocking:
+                return b""
+            if timeout_ms > 0 and delay > timeout_ms / 1000:
+                time.sleep(timeout_ms / 1000)
+                return b""
+            time.sleep(delay)
+        self.in_flight.popleft()
+        return response[:length]
+
+    def set_nonblocking(self, nonblocking):
+        self.nonblocking = bool(nonblocking)
+
+    def close(self):
+        pass
+
+    def press(self, row, col, pressed=True):
+        """ Changes the switch matrix state reported to the matrix tester """
+        with self.lock:
+            row_size = (self.cols + 7) // 8
+            offset = row * row_size + row_size - 1 - col // 8
+            if pressed:
+                self.matrix_state[offset] |= 1 << (col % 8)
+            else:
+                self.matrix_state[offset] &= ~(1 << (col % 8)) & 0xFF
+
+    def fast_device(self):
+        """ Stand-in for the pyusb device used for fast animation transfers """
+        return EmulatorFastDevice(self)
+
+    # VIA
+
+    @staticmethod
+    def on_echo(msg, out):
+        out[:] = msg[:len(out)]
+
+    def on_protocol_version(self, msg, out):
+        struct.pack_into(">BH", out, 0, msg[0], self.via_protocol)
+
+    def on_get_keyboard_value(self, msg, out):
+        out[0:2] = msg[0:2]
+        if msg[1] == VIA_LAYOUT_OPTIONS:
+            struct.pack_into(">I", out, 2, self.layout_options)
+        elif msg[1] == VIA_SWITCH_MATRIX_STATE:
+            out[2:MSG_LEN] = self.matrix_state
+        else:
+            out[0] = 0xFF
+
+    def on_set_keyboard_value(self, msg, out):
+        self.on_echo(msg, out)
+        if msg[1] == VIA_LAYOUT_OPTIONS:
+            self.layout_options = struct.unpack_from(">I", msg, 2)[0]
+
+    def keycode_offset(self, layer, row, col):
+        return (layer * self.rows * self.cols + row * self.cols + col) * 2
+
+    def on_get_keycode(self, msg, out):
+        layer, row, col = msg[1:4]
+        out[0:4] = msg[0:4]
+        offset = self.keycode_offset(layer, row, col)
+        out[4:6] = self.keymap[offset:offset + 2]
+
+    def on_set_keycode(self, msg, out):
+        self.on_echo(msg, out)
+        layer, row, col = msg[1:4]
+        if layer < self.layers and row < self.rows and col < self.cols:
+            offset = self.keycode_offset(layer, row, col)
+            self.keymap[offset:offset + 2] = msg[4:6]
+
+    def on_layer_count(self, msg, out):
+        out[0] = msg[0]
+        out[1] = self.layers
+
+    @staticmethod
+    def buffer_get(buffer, msg, out):
+        offset, size = struct.unpack_from(">HB", msg, 1)
+        size = min(size, len(out) - 4)
+        out[0:4] = msg[0:4]
+        chunk = buffer[offset:offset + size]
+        out[4:4 + len(chunk)] = chunk
+
+    @staticmethod
+    def buffer_set(buffer, msg, out):
+        offset, size = struct.unpack_from(">HB", msg, 1)
+        KeyboardEmulator.on_echo(msg, out)
+        size = max(0, min(size, len(msg) - 4, len(buffer) - offset))
+        buffer[offset:offset + size] = msg[4:4 + size]
+
+    def on_keymap_get(self, msg, out):
+        self.buffer_get(self.keymap, msg, out)
+
+    def on_keymap_set(self, msg, out):
+        self.buffer_set(self.keymap, msg, out)
+
+    def on_lighting_set(self, msg, out):
+        self.on_echo(msg, out)
+        self.lighting[msg[1]] = msg[2:]
+
+    def on_lighting_get(self, msg, out):
+        out[0:2] = msg[0:2]
+        if msg[1] == VIALRGB_GET_INFO:
+            # protocol version 1, maximum brightness
+            struct.pack_into("<HB", out, 2, 1, 255)
+        elif msg[1] == VIALRGB_GET_SUPPORTED:
+            start = struct.unpack_from("<H", msg, 2)[0]
+            effects = [x for x in self.vialrgb_effects if x > start][:(len(out) - 2) // 2]
+            effects += [0xFFFF] * ((len(out) - 2) // 2 - len(effects))
+            struct.pack_into("<{}H".format(len(effects)), out, 2, *effects)
+        else:
+            value = self.lighting.get(msg[1], b"")
+            out[2:2 + len(value)] = value
+
+    def on_lighting_save(self, msg, out):
+        self.on_echo(msg, out)
+        self.lighting_saved += 1
+
+    def on_macro_count(self, msg, out):
+        out[0] = msg[0]
+        out[1] = self.macro_count
+
+    def on_macro_size(self, msg, out):
+        struct.pack_into(">BH", out, 0, msg[0], len(self.macro))
+
+    def on_macro_get(self, msg, out):
+        self.buffer_get(self.macro, msg, out)
+
+    def on_macro_set(self, msg, out):
+        self.buffer_set(self.macro, msg, out)
+
+    # Vial
+
+    def on_vial(self, msg, out):
+        handler = self.vial_handlers.get(msg[1])
+        if handler is None:
+            out[0] = 0xFF
+        else:
+            handler(msg, out)
+
+    def on_keyboard_id(self, msg, out):
+        struct.pack_into("<IQ", out, 0, self.vial_protocol, self.keyboard_id)
+
+    def on_definition_size(self, msg, out):
+        struct.pack_into("<I", out, 0, len(self.compressed_definition))
+
+    def on_definition(self, msg, out):
+        block = struct.unpack_from("<I", msg, 2)[0]
+        chunk = self.compressed_definition[block * MSG_LEN:(block + 1) * MSG_LEN]
+        out[0:len(chunk)] = chunk
+
+    def on_get_encoder(self, msg, out):
+        layer, idx = msg[2:4]
+        struct.pack_into(">HH", out, 0, self.encoders.get((layer, idx, 0), 0), self.encoders.get((layer, idx, 1), 0))
+
+    def on_set_encoder(self, msg, out):
+        self.on_echo(msg, out)
+        layer, idx, direction, code = struct.unpack_from(">BBBH", msg, 2)
+        self.encoders[(layer, idx, direction)] = code
+
+    def on_unlock_status(self, msg, out):
+        out[0] = int(self.unlocked)
+        out[1] = int(self.unlock_counter > 0)
+        out[2:MSG_LEN] = b"\xFF" * (MSG_LEN - 2)
+        for x, (row, col) in enumerate(self.unlock_keys):
+            out[2 + x * 2] = row
+            out[3 + x * 2] = col
+
+    def on_unlock_start(self, msg, out):
+        self.unlock_counter = 50
+
+    def on_unlock_poll(self, msg, out):
+        # as if the unlock keys were being held down
+        if self.unlock_counter > 0:
+            self.unlock_counter -= 1
+            if self.unlock_counter == 0:
+                self.unlocked = True
+        out[0] = int(self.unlocked)
+        out[1] = int(self.unlock_counter > 0)
+        out[2] = self.unlock_counter
+
+    def on_lock(self, msg, out):
+        self.unlocked = False
+
+    def on_settings_query(self, msg, out):
+        start = struct.unpack_from("<H", msg, 2)[0]
+        qsids = [x for x in self.qmk_settings_supported if x > start][:len(out) // 2]
+        qsids += [0xFFFF] * (len(out) // 2 - len(qsids))
+        struct.pack_into("<{}H".format(len(qsids)), out, 0, *qsids)
+
+    def on_settings_get(self, msg, out):
+        qsid = struct.unpack_from("<H", msg, 2)[0]
+        if qsid not in self.qmk_settings_supported:
+            out[0] = 1
+            return
+        value = self.qmk_settings.get(qsid, b"")
+        out[1:1 + len(value)] = value
+
+    def on_settings_set(self, msg, out):
+        qsid = struct.unpack_from("<H", msg, 2)[0]
+        if qsid not in self.qmk_settings_supported:
+            out[0] = 1
+            return
+        self.qmk_settings[qsid] = msg[4:]
+
+    def on_settings_reset(self, msg, out):
+        self.qmk_settings.clear()
+
+    def on_dynamic(self, msg, out):
+        op = msg[2]
+        if op == DYNAMIC_VIAL_GET_NUMBER_OF_ENTRIES:
+            out[0:3] = bytes([len(self.tap_dance), len(self.combo), len(self.key_override)])
+            return
+        entries = {
+            DYNAMIC_VIAL_TAP_DANCE_GET: self.tap_dance, DYNAMIC_VIAL_TAP_DANCE_SET: self.tap_dance,
+            DYNAMIC_VIAL_COMBO_GET: self.combo, DYNAMIC_VIAL_COMBO_SET: self.combo,
+            DYNAMIC_VIAL_KEY_OVERRIDE_GET: self.key_override, DYNAMIC_VIAL_KEY_OVERRIDE_SET: self.key_override,
+        }.get(op)
+        idx = msg[3]
+        if entries is None or idx >= len(entries):
+            out[0] = 1
+        elif op in (DYNAMIC_VIAL_TAP_DANCE_GET, DYNAMIC_VIAL_COMBO_GET, DYNAMIC_VIAL_KEY_OVERRIDE_GET):
+            out[1:1 + len(entries[idx])] = entries[idx]
+        else:
+            entries[idx] = msg[4:4 + len(entries[idx])]
+
+    # AMK, responses repeat the command and carry AMK_PROTOCOL_OK in the third byte
+
+    def on_amk(self, msg, out):
+        out[0:2] = msg[0:2]
+        handler = self.amk_handlers.get(msg[1])
+        if handler is None:
+            out[2] = 0
+        else:
+            out[2] = AMK_PROTOCOL_OK
+            handler(msg, out)
+
+    @staticmethod
+    def on_amk_version(msg, out):
+        out[2] = 1
+
+    def on_get_amk_value(self, msg, out):
+        out[3] = self.amk_values[msg[1]]
+
+    def on_set_amk_value(self, msg, out):
+        self.amk_values[msg[1] - 1] = msg[2]
+
+    def on_get_apc(self, msg, out):
+        row, col, profile = msg[2:5]
+        struct.pack_into(">H", out, 3, self.apc.get((profile, row, col), 150))
+
+    def on_set_apc(self, msg, out):
+        row, col, value, profile = struct.unpack_from(">BBHB", msg, 2)
+        self.apc[(profile, row, col)] = value
+
+    def on_get_rt(self, msg, out):
+        row, col, profile = msg[2:5]
+        struct.pack_into(">H", out, 3, self.rt.get((profile, row, col), 0))
+
+    def on_set_rt(self, msg, out):
+        row, col, value, profile = struct.unpack_from(">BBHB", msg, 2)
+        self.rt[(profile, row, col)] = value
+
+    def on_get_dks(self, msg, out):
+        out[3:15] = self.dks.get((msg[2], msg[3]), bytes(12))
+
+    def on_set_dks(self, msg, out):
+        self.dks[(msg[2], msg[3])] = msg[4:16]
+
+    def on_strip_count(self, msg, out):
+        out[3] = len(self.rgb_strips)
+
+    def on_strip_param(self, msg, out):
+        if msg[2] >= len(self.rgb_strips):
+            out[2] = 0
+            return
+        out[3:7] = bytes(self.rgb_strips[msg[2]][:4])
+
+    def on_get_strip_mode(self, msg, out):
+        if msg[2] >= len(self.rgb_strips):
+            out[2] = 0
+            return
+        out[3] = msg[2]
+        out[4] = self.rgb_strips[msg[2]][4]
+
+    def on_set_strip_mode(self, msg, out):
+        if msg[2] < len(self.rgb_strips):
+            self.rgb_strips[msg[2]][4] = msg[3]
+
+    def on_get_led(self, msg, out):
+        out[3] = msg[2]
+        out[4:8] = self.rgb_leds.get(msg[2], bytes(4))
+
+    def on_set_led(self, msg, out):
+        self.rgb_leds[msg[2]] = msg[3:7]
+
+    def on_get_indicator(self, msg, out):
+        out[3] = msg[2]
+        out[4:8] = self.rgb_leds.get(("indicator", msg[2]), bytes(4))
+
+    def on_set_indicator(self, msg, out):
+        self.rgb_leds[("indicator", msg[2])] = msg[3:7]
+
+    def on_matrix_info(self, msg, out):
+        out[3] = self.rgb_matrix_start
+        out[4] = self.rgb_matrix_count
+
+    def on_matrix_row_info(self, msg, out):
+        row = msg[3]
+        out[3] = row
+        for col in range(min(self.cols, len(out) - 4)):
+            index = row * self.cols + col
+            out[4 + col] = self.rgb_matrix_start + index if index < self.rgb_matrix_count else 0xFF
+
+    def on_get_matrix_mode(self, msg, out):
+        out[3:7] = bytes(self.rgb_matrix_mode)
+
+    def on_set_matrix_mode(self, msg, out):
+        self.rgb_matrix_mode[0] = msg[3]
+
+    def on_snaptap_count(self, msg, out):
+        out[3] = len(self.snaptap)
+
+    def on_get_snaptap(self, msg, out):
+        if msg[2] >= len(self.snaptap):
+            out[2] = 0
+            return
+        out[3:8] = self.snaptap[msg[2]]
+
+    def on_set_snaptap(self, msg, out):
+        if msg[2] >= len(self.snaptap):
+            out[2] = 0
+            return
+        self.snaptap[msg[2]] = msg[3:8]
+
+    def on_get_datetime(self, msg, out):
+        out[3:11] = self.datetime
+
+    def on_set_datetime(self, msg, out):
+        self.datetime = msg[2:10]
+
+    # animation file system
+
+    def free_space(self):
+        return self.file_system_size - sum(len(data) for name, data in self.files)
+
+    def on_file_system_info(self, msg, out):
+        struct.pack_into("<BII", out, 3, len(self.files), self.free_space(), self.file_system_size)
+
+    def on_file_info(self, msg, out):
+        if msg[2] >= len(self.files):
+            out[2] = 0
+            return
+        name, data = self.files[msg[2]]
+        out[3:3 + FILE_NAME_LEN] = name.encode("utf-8")[:FILE_NAME_LEN - 1].ljust(FILE_NAME_LEN, b"\x00")
+        struct.pack_into("<I", out, 16, len(data))
+
+    def on_open_file(self, msg, out):
+        index, read = msg[2:4]
+        if read:
+            if index >= len(self.files):
+                out[2] = 0
+                return
+        else:
+            name = msg[4:].split(b"\x00")[0].decode("utf-8", errors="replace")
+            names = [n for n, data in self.files]
+            if name in names:
+                index = names.index(name)
+                self.files[index] = (name, bytearray())
+            else:
+                index = len(self.files)
+                self.files.append((name, bytearray()))
+        self.open_files[index] = bool(read)
+        out[3] = index
+
+    def on_write_file(self, msg, out):
+        index, size, offset = struct.unpack_from("<BBI", msg, 2)
+        if self.open_files.get(index) is not False:
+            out[2] = 0
+            return
+        data = self.files[index][1]
+        size = min(size, len(msg) - FAST_HEADER_LEN)
+        if offset + size - len(data) > self.free_space():
+            out[2] = 0
+            return
+        if offset > len(data):
+            data.extend(bytes(offset - len(data)))
+        data[offset:offset + size] = msg[FAST_HEADER_LEN:FAST_HEADER_LEN + size]
+
+    def on_read_file(self, msg, out):
+        index, size, offset = struct.unpack_from("<BBI", msg, 2)
+        if self.open_files.get(index) is not True:
+            out[2] = 0
+            return
+        chunk = self.files[index][1][offset:offset + min(size, len(out) - FAST_HEADER_LEN)]
+        out[3] = len(chunk)
+        out[FAST_HEADER_LEN:FAST_HEADER_LEN + len(chunk)] = chunk
+
+    def on_close_file(self, msg, out):
+        if self.open_files.pop(msg[2], None) is None:
+            out[2] = 0
+
+    def on_delete_file(self, msg, out):
+        if msg[2] >= len(self.files):
+            out[2] = 0
+            return
+        del self.files[msg[2]]
+        self.open_files.pop(msg[2], None)
+
+    def on_display_control(self, msg, out):
+        self.playing = msg[2]
+
+
+class EmulatorFastDevice:
+    """
+    pyusb-like device for the AMK vendor endpoint of a KeyboardEmulator. A transfer holds either a
+    single 64-byte command or a batch of file writes; only the response to the last command is kept
+    for the next read, batched writes aren't answered individually.
+    """
+
+    def __init__(self, emulator):
+        self.emulator = emulator
+        self.response = None
+
+    def write(self, endpoint, data):
+        data = bytes(data)
+        offset = 0
+        while offset < len(data) and data[offset] == AMK_PROTOCOL_PREFIX:
+            size = FAST_PACKET_LEN
+            if data[offset + 1] == AMK_PROTOCOL_WRITE_FILE:
+                size = FAST_HEADER_LEN + data[offset + 3]
+            packet = data[offset:offset + size]
+            self.response = self.emulator.handle(packet + bytes(FAST_PACKET_LEN - len(packet)), FAST_PACKET_LEN)
+            offset += size
+        if self.emulator.latency:
+            time.sleep(self.emulator.latency)
+        return len(data)
+
+    def read(self, endpoint, size, timeout=None):
+        response, self.response = self.response, None
+        if response is None:
+            raise OSError("timed out")
+        return response[:size]
@@ -99,7 +99,7 @@ class ProtocolKeyOverride(BaseProtocol):
                 Unlocker.unlock(self)
 
             self.key_override_entries[idx] = entry
-            self.usb_send(self.dev, struct.pack("BBBB", CMD_VIA_VIAL_PREFIX, CMD_VIAL_DYNAMIC_ENTRY_OP,
+            self.usb_post(self.dev, struct.pack("BBBB", CMD_VIA_VIAL_PREFIX, CMD_VIAL_DYNAMIC_ENTRY_OP,
                                                 DYNAMIC_VIAL_KEY_OVERRIDE_SET, idx) + entry.serialize())
 
     def save_key_override(self):
@@ -1,28 +1,40 @@
 # SPDX-License-Identifier: GPL-2.0-or-later
+import logging
 import struct
 import json
 import lzma
 from collections import OrderedDict
+from concurrent.futures import Future, CancelledError
+from copy import copy
+from functools import partial
 
 from keycodes.keycodes import RESET_KEYCODE, Keycode, recreate_keyboard_keycodes
-from kle_serial import Serial as KleSerial
 from protocol.combo import ProtocolCombo
 from protocol.constants import CMD_VIA_GET_PROTOCOL_VERSION, CMD_VIA_GET_KEYBOARD_VALUE, CMD_VIA_SET_KEYBOARD_VALUE, \
     CMD_VIA_SET_KEYCODE, CMD_VIA_LIGHTING_SET_VALUE, CMD_VIA_LIGHTING_GET_VALUE, CMD_VIA_LIGHTING_SAVE, \
-    CMD_VIA_GET_LAYER_COUNT, CMD_VIA_KEYMAP_GET_BUFFER, CMD_VIA_VIAL_PREFIX, VIA_LAYOUT_OPTIONS, \
+    CMD_VIA_GET_LAYER_COUNT, CMD_VIA_KEYMAP_GET_BUFFER, CMD_VIA_KEYMAP_SET_BUFFER, CMD_VIA_UNHANDLED, \
+    CMD_VIA_VIAL_PREFIX, VIA_LAYOUT_OPTIONS, \
     VIA_SWITCH_MATRIX_STATE, QMK_BACKLIGHT_BRIGHTNESS, QMK_BACKLIGHT_EFFECT, QMK_RGBLIGHT_BRIGHTNESS, \
     QMK_RGBLIGHT_EFFECT, QMK_RGBLIGHT_EFFECT_SPEED, QMK_RGBLIGHT_COLOR, VIALRGB_GET_INFO, VIALRGB_GET_MODE, \
     VIALRGB_GET_SUPPORTED, VIALRGB_SET_MODE, CMD_VIAL_GET_KEYBOARD_ID, CMD_VIAL_GET_SIZE, CMD_VIAL_GET_DEFINITION, \
     CMD_VIAL_GET_ENCODER, CMD_VIAL_SET_ENCODER, CMD_VIAL_GET_UNLOCK_STATUS, CMD_VIAL_UNLOCK_START, CMD_VIAL_UNLOCK_POLL, \
     CMD_VIAL_LOCK, CMD_VIAL_QMK_SETTINGS_QUERY, CMD_VIAL_QMK_SETTINGS_GET, CMD_VIAL_QMK_SETTINGS_SET, \
     CMD_VIAL_QMK_SETTINGS_RESET, BUFFER_FETCH_CHUNK, VIAL_PROTOCOL_QMK_SETTINGS
+from protocol.device_worker import InlineWorker
 from protocol.dynamic import ProtocolDynamic
 from protocol.key_override import ProtocolKeyOverride
+from protocol.keymap_store import KeymapStore
 from protocol.macro import ProtocolMacro
+from protocol.snapshot import KeyboardSnapshot
+from protocol.reload_graph import ReloadGraph, ReloadStage, ReloadCancelled
+from protocol.restore_plan import RestorePlanner
 from protocol.tap_dance import ProtocolTapDance
 from amk.protocol import ProtocolAmk
+from layout_cache import LayoutCache
+from retry_policy import RetryPolicy
 from unlocker import Unlocker
-from util import MSG_LEN, hid_send
+from util import MSG_LEN, EXAMPLE_KEYBOARDS, EXAMPLE_KEYBOARD_PREFIX, hid_send, hid_send_many, \
+    sequential_send_many, dirty_spans
 
 SUPPORTED_VIA_PROTOCOL = [-1, 9]
 SUPPORTED_VIAL_PROTOCOL = [-1, 0, 1, 2, 3, 4, 5, 6]
@@ -35,16 +47,50 @@ class ProtocolError(Exception):
 class Keyboard(ProtocolMacro, ProtocolDynamic, ProtocolTapDance, ProtocolCombo, ProtocolKeyOverride, ProtocolAmk):
     """ Low-level communication with a vial-enabled keyboard """
 
-    def __init__(self, dev, usb_send=hid_send):
+    def __init__(self, dev, usb_send=hid_send, usb_send_many=None, retry_policy=None, worker=None,
+                 definition_cache=None, snapshot_store=None):
         self.dev = dev
+        # when a snapshot of this keyboard is available, the UI starts from it and the keyboard is
+        # read in the background; snapshot_changes lists what that verification had to update
+        self.snapshot_store = snapshot_store
+        self.warm_snapshot = None
+        self.snapshot_changes = []
+        self.snapshot_stale = False
+        # compressed definitions are cached on disk across sessions, set refresh_definition
+        # to ignore the cached copy on the next reload
+        self.definition_cache = definition_cache
+        self.refresh_definition = False
+        # timeouts and retries adapt to the latency of this particular device,
+        # pass RetryPolicy.legacy() to get the old fixed 500ms timeout / 0.5s retry behaviour
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        # batches of independent requests are pipelined when talking to real hardware,
+        # a custom usb_send (e.g. simulated device in tests) falls back to one request at a time
+        if usb_send is hid_send:
+            usb_send = partial(hid_send, policy=self.retry_policy)
+            if usb_send_many is None:
+                usb_send_many = partial(hid_send_many, policy=self.retry_policy)
+        elif usb_send_many is None:
+            usb_send_many = sequential_send_many(usb_send)
+        # when a worker thread owns the device, every request is executed there in order;
+        # usb_post queues writes whose response we don't need without waiting for them
+        self.worker = worker if worker is not None else InlineWorker()
+        if worker is not None:
+            usb_send = partial(worker.call, usb_send)
+            usb_send_many = partial(worker.call, usb_send_many)
         self.usb_send = usb_send
+        self.usb_send_many = usb_send_many
+        self.usb_post = partial(self.post_write, usb_send)
+        # called with the exception from the I/O thread when a queued write fails, the keyboard then
+        # doesn't have what this object thinks it has and should be reloaded
+        self.write_failed = None
         self.definition = None
+        self.reload_graph = None
 
         # n.b. using OrderedDict here to make order of layout requests consistent for tests
         self.rowcol = OrderedDict()
         self.encoderpos = OrderedDict()
         self.encoder_count = 0
-        self.layout = dict()
+        self.layout = KeymapStore()
         self.encoder_layout = dict()
         self.rows = self.cols = self.layers = 0
         self.layout_labels = None
@@ -68,37 +114,134 @@ class Keyboard(ProtocolMacro, ProtocolDynamic, ProtocolTapDance, ProtocolCombo,
         self.rgb_supported_effects = set()
 
         self.via_protocol = self.vial_protocol = self.keyboard_id = -1
+        # whether the firmware accepts CMD_VIA_KEYMAP_SET_BUFFER, None until it is first used
+        self.keymap_set_buffer = None
 
         self.lighting_amk_rgblight = False
 
-    def reload(self, sideload_json=None):
+    def reload(self, sideload_json=None, progress=None):
         """ Load information about the keyboard: number of layers, physical key layout """
 
+        self.reload_foreground(sideload_json, progress)
+        self.reload_background(progress)
+
+    def reload_foreground(self, sideload_json=None, progress=None):
+        """ Runs the reload stages needed by the keymap editor, reload_background() must follow """
+
+        self.cancel_reload()
         self.rowcol = OrderedDict()
         self.encoderpos = OrderedDict()
-        self.layout = dict()
+        self.layout = KeymapStore()
         self.encoder_layout = dict()
 
-        self.reload_layout(sideload_json)
-        self.reload_layers()
-
-        self.reload_macros_early()
+        self.reload_graph = ReloadGraph(self.reload_stages(sideload_json))
+        self.reload_graph.run(background=False, progress=progress)
+
+    def reload_background(self, progress=None):
+        """ Runs the remaining (AMK) reload stages on the device I/O thread """
+        try:
+            self.worker.call(self.reload_graph.run, background=True, progress=progress)
+        except ReloadCancelled:
+            pass
+
+    def cancel_reload(self):
+        if self.reload_graph is not None:
+            self.reload_graph.cancel()
+
+    def stage_loaded(self, name):
+        return self.reload_graph is not None and name in self.reload_graph.done
+
+    def reload_stages(self, sideload_json=None):
+        cold = self.unless_warm
+        return [
+            ReloadStage("layout", lambda: self.reload_layout(sideload_json)),
+            ReloadStage("warm_start", self.reload_warm_start, ["layout"]),
+            ReloadStage("layers", cold(self.reload_layers), ["warm_start"]),
+            ReloadStage("macros_early", cold(self.reload_macros_early), ["warm_start"]),
+            ReloadStage("rgb", cold(self.reload_rgb_stage), ["warm_start"]),
+            ReloadStage("settings", cold(self.reload_settings), ["warm_start"]),
+            ReloadStage("dynamic", cold(self.reload_dynamic), ["warm_start"]),
+            # based on the number of macros, tapdance, etc, this will generate global keycode arrays
+            ReloadStage("keycodes", lambda: recreate_keyboard_keycodes(self), ["macros_early", "dynamic"]),
+            # at this stage we have correct keycode info and can reload everything that depends on keycodes
+            ReloadStage("keymap", cold(self.reload_keymap), ["layers", "keycodes"]),
+            ReloadStage("macros", cold(self.reload_macros_late), ["keycodes"]),
+            ReloadStage("tap_dance", cold(self.reload_tap_dance), ["keycodes"]),
+            ReloadStage("combo", cold(self.reload_combo), ["keycodes"]),
+            ReloadStage("key_override", cold(self.reload_key_override), ["keycodes"]),
+
+            ReloadStage("verify", self.reload_verify,
+                        ["rgb", "settings", "keymap", "macros", "tap_dance", "combo", "key_override"],
+                        background=True),
+            ReloadStage("amk_misc", self.reload_amk_misc, ["layout"], background=True),
+            ReloadStage("amk_apcrt", self.reload_amk_apcrt, ["layout"], background=True),
+            ReloadStage("amk_rgb", self.reload_amk_rgb, ["rgb"], background=True),
+            ReloadStage("amk_animation", self.reload_amk_animation, ["layout"], background=True),
+        ]
+
+    def unless_warm(self, fn):
+        """ Wraps a reload stage so that it is skipped when the state was restored from a snapshot """
+        def stage():
+            if self.warm_snapshot is None:
+                fn()
+        return stage
+
+    def snapshot_usable(self):
+        return self.snapshot_store is not None and not self.sideload and self.definition_cacheable_id()
+
+    def reload_warm_start(self):
+        self.warm_snapshot = None
+        self.snapshot_changes = []
+        self.snapshot_stale = False
+        if not self.snapshot_usable():
+            return
+        state = self.snapshot_store.load(self.keyboard_id, self.definition, self.via_protocol, self.vial_protocol)
+        if state is None:
+            return
+        try:
+            KeyboardSnapshot.apply(self, state)
+            self.layout = self.keymap_store(self.layout)
+        except (KeyError, TypeError, ValueError) as e:
+            logging.warning("Keyboard snapshot is invalid, reading the keyboard: %s", e)
+            self.snapshot_store.remove(self.keyboard_id)
+            return
+        self.warm_snapshot = state
+
+    def reload_verify(self):
+        """ Reads the keyboard state after a warm start and merges in whatever changed since the snapshot """
+        if self.warm_snapshot is not None:
+            device = copy(self)
+            device.layout = KeymapStore()
+            device.encoder_layout = dict()
+            device.reload_layers()
+            device.reload_macros_early()
+            device.reload_dynamic()
+            if not KeyboardSnapshot.same_structure(self, device):
+                # keycode tables depend on these, so the keyboard has to be loaded from scratch
+                self.snapshot_stale = True
+                self.snapshot_store.remove(self.keyboard_id)
+                return
+            device.reload_rgb_stage()
+            device.reload_settings()
+            device.reload_keymap()
+            device.reload_macros_late()
+            device.reload_tap_dance()
+            device.reload_combo()
+            device.reload_key_override()
+            self.snapshot_changes = KeyboardSnapshot.merge(self, self.warm_snapshot,
+                                                           KeyboardSnapshot.capture(device))
+        self.save_snapshot()
+
+    def save_snapshot(self):
+        if self.snapshot_usable() and not self.snapshot_stale and self.stage_loaded("key_override"):
+            self.snapshot_store.save(self.keyboard_id, self.definition, self.via_protocol, self.vial_protocol,
+                                     KeyboardSnapshot.capture(self))
+
+    def reload_rgb_stage(self):
         self.reload_persistent_rgb()
         self.reload_rgb()
-        self.reload_settings()
-
-        self.reload_dynamic()
-
-        # based on the number of macros, tapdance, etc, this will generate global keycode arrays
-        recreate_keyboard_keycodes(self)
-
-        # at this stage we have correct keycode info and can reload everything that depends on keycodes
-        self.reload_keymap()
-        self.reload_macros_late()
-        self.reload_tap_dance()
-        self.reload_combo()
-        self.reload_key_override()
 
+    def reload_amk_misc(self):
         #reload nkro
         self.amk_nkro = False
         self.reload_nkro()
@@ -109,6 +252,16 @@ class Keyboard(ProtocolMacro, ProtocolDynamic, ProtocolTapDance, ProtocolCombo,
                 if feature == "datetime":
                     self.amk_datetime = True
 
+        #reload keyboard misc settings
+        if self.keyboard_speed == "hs":
+            self.amk_poll_rate = 0
+            self.reload_poll_rate()
+            if self.keyboard_type == "mx":
+                self.amk_down_debounce = 0
+                self.amk_up_debounce = 5
+                self.reload_debounce()
+
+    def reload_amk_apcrt(self):
         #reload apc/rt/dks/sensitivity
         if self.keyboard_type.startswith("ms") or self.keyboard_type == "ec":
             self.amk_pole = False
@@ -128,14 +281,16 @@ class Keyboard(ProtocolMacro, ProtocolDynamic, ProtocolTapDance, ProtocolCombo,
                     if isinstance(feature, dict):
                         self.amk_apcrt_scale = feature.get("apcrtScale", 10)
                         self.amk_apcrt_version = 2
-                    print("APCRT SCALE:{}, Version:{}".format(self.amk_apcrt_scale, self.amk_apcrt_version))
+                    logging.debug("APCRT SCALE:%s, Version:%s", self.amk_apcrt_scale, self.amk_apcrt_version)
 
+            # per-key APC/RT/DKS take a packet per key and profile, they are loaded on demand by ensure_amk_keys()
             self.amk_apc = [dict(), dict(), dict(), dict()]
             self.amk_rt = [dict(), dict(), dict(), dict()]
             self.amk_profile_count = 4 if self.keyboard_type == "ms_v2" else 1
-            for i in range(self.amk_profile_count):
-                self.reload_apc(i)
-                self.reload_rt(i)
+            self.amk_apcrt_loaded = set()
+            self.amk_dks = dict()
+            self.amk_dks_loaded = False
+            self.amk_prefetch_started = False
 
             #self.dump_apcrt()
             
@@ -145,9 +300,6 @@ class Keyboard(ProtocolMacro, ProtocolDynamic, ProtocolTapDance, ProtocolCombo,
             if self.amk_snaptap:
                 self.reload_snaptap()
 
-            self.amk_dks = dict()
-            self.reload_dks()
-
             self.amk_rt_sens = 80
             self.reload_rt_sensitivity()
 
@@ -163,15 +315,7 @@ class Keyboard(ProtocolMacro, ProtocolDynamic, ProtocolTapDance, ProtocolCombo,
             self.amk_noise_sens = 50
             self.reload_noise_sensitivity()
 
-        #reload keyboard misc settings
-        if self.keyboard_speed == "hs":
-            self.amk_poll_rate = 0
-            self.reload_poll_rate()
-            if self.keyboard_type == "mx":
-                self.amk_down_debounce = 0
-                self.amk_up_debounce = 5
-                self.reload_debounce()
-
+    def reload_amk_rgb(self):
         #print("amk: rgb light", self.lighting_amk_rgblight)
         if self.lighting_amk_rgblight:
             self.amk_rgb_strip_count = 0
@@ -183,6 +327,13 @@ class Keyboard(ProtocolMacro, ProtocolDynamic, ProtocolTapDance, ProtocolCombo,
         self.rgb_indicators = {}
         self.reload_rgb_indicators()
 
+        self.amk_rgb_matrix = {}
+        if "amk_rgb_matrix" in self.definition:
+            self.amk_rgb_matrix["start"] = self.definition["amk_rgb_matrix"]["start"]
+            self.amk_rgb_matrix["count"] = self.definition["amk_rgb_matrix"]["count"]
+            self.reload_amk_rgb_matrix()
+
+    def reload_amk_animation(self):
         #animation
         self.animations = {"format":[], "file":{}, "disk":{}, "transfer":""}
         if "animation" in self.definition:
@@ -193,12 +344,6 @@ class Keyboard(ProtocolMacro, ProtocolDynamic, ProtocolTapDance, ProtocolCombo,
                 self.animations["transfer"] = transfer
 
             self.reload_anim_file_list()
-        
-        self.amk_rgb_matrix = {}
-        if "amk_rgb_matrix" in self.definition:
-            self.amk_rgb_matrix["start"] = self.definition["amk_rgb_matrix"]["start"]
-            self.amk_rgb_matrix["count"] = self.definition["amk_rgb_matrix"]["count"]
-            self.reload_amk_rgb_matrix()
 
     def reload_layers(self):
         """ Get how many layers the keyboard has """
@@ -213,6 +358,45 @@ class Keyboard(ProtocolMacro, ProtocolDynamic, ProtocolTapDance, ProtocolCombo,
         if self.via_protocol not in SUPPORTED_VIA_PROTOCOL or self.vial_protocol not in SUPPORTED_VIAL_PROTOCOL:
             raise ProtocolError()
 
+    def definition_cacheable_id(self):
+        # example UIDs are shared by unrelated keyboards, so nothing can be cached by them
+        return self.keyboard_id not in EXAMPLE_KEYBOARDS and (self.keyboard_id & 0xFFFFFFFFFFFFFF) != EXAMPLE_KEYBOARD_PREFIX
+
+    def definition_cacheable(self):
+        return self.definition_cache is not None and self.definition_cacheable_id()
+
+    def load_cached_definition(self, sz):
+        """ Returns the parsed definition from the on-disk cache, or None on a miss """
+        if not self.definition_cacheable():
+            return None
+        if self.refresh_definition:
+            self.refresh_definition = False
+            self.definition_cache.invalidate(self.keyboard_id)
+            return None
+        compressed = self.definition_cache.get(self.keyboard_id, sz, self.via_protocol, self.vial_protocol)
+        if compressed is None:
+            return None
+        try:
+            return json.loads(lzma.decompress(compressed))
+        except (lzma.LZMAError, ValueError) as e:
+            logging.warning("Cached definition failed to load, downloading it again: %s", e)
+            self.definition_cache.invalidate(self.keyboard_id)
+            return None
+
+    def download_definition(self, sz):
+        """ Downloads the compressed definition from the keyboard, 32 bytes at a time """
+        payload = b""
+        block = 0
+        while sz > 0:
+            data = self.usb_send(self.dev, struct.pack("<BBI", CMD_VIA_VIAL_PREFIX, CMD_VIAL_GET_DEFINITION, block),
+                                 retries=20)
+            if sz < MSG_LEN:
+                data = data[:sz]
+            payload += data
+            block += 1
+            sz -= MSG_LEN
+        return payload
+
     def reload_layout(self, sideload_json=None):
         """ Requests layout data from the current device """
 
@@ -231,19 +415,12 @@ class Keyboard(ProtocolMacro, ProtocolDynamic, ProtocolTapDance, ProtocolCombo,
             data = self.usb_send(self.dev, struct.pack("BB", CMD_VIA_VIAL_PREFIX, CMD_VIAL_GET_SIZE), retries=20)
             sz = struct.unpack("<I", data[0:4])[0]
 
-            # get the payload
-            payload = b""
-            block = 0
-            while sz > 0:
-                data = self.usb_send(self.dev, struct.pack("<BBI", CMD_VIA_VIAL_PREFIX, CMD_VIAL_GET_DEFINITION, block),
-                                     retries=20)
-                if sz < MSG_LEN:
-                    data = data[:sz]
-                payload += data
-                block += 1
-                sz -= MSG_LEN
-
-            payload = json.loads(lzma.decompress(payload))
+            payload = self.load_cached_definition(sz)
+            if payload is None:
+                compressed = self.download_definition(sz)
+                payload = json.loads(lzma.decompress(compressed))
+                if self.definition_cacheable():
+                    self.definition_cache.put(self.keyboard_id, sz, self.via_protocol, self.vial_protocol, compressed)
 
         self.check_protocol_version()
 
@@ -263,39 +440,16 @@ class Keyboard(ProtocolMacro, ProtocolDynamic, ProtocolTapDance, ProtocolCombo,
         self.keyboard_type = payload.get("keyboardType", "")
         self.keyboard_speed = payload.get("keyboardSpeed", None)
 
-        serial = KleSerial()
-        kb = serial.deserialize(payload["layouts"]["keymap"])
+        # parsing the KLE layout is memoized by its contents, keys are shared and must not be modified
+        parsed = LayoutCache.get().parse(payload["layouts"]["keymap"])
 
-        self.keys = []
-        self.encoders = []
-
-        for key in kb.keys:
-            key.row = key.col = None
-            key.encoder_idx = key.encoder_dir = None
-            if key.labels[4] == "e":
-                idx, direction = key.labels[0].split(",")
-                idx, direction = int(idx), int(direction)
-                key.encoder_idx = idx
-                key.encoder_dir = direction
-                self.encoderpos[idx] = True
-                self.encoder_count = max(self.encoder_count, idx + 1)
-                self.encoders.append(key)
-            elif key.decal or (key.labels[0] and "," in key.labels[0]):
-                row, col = 0, 0
-                if key.labels[0] and "," in key.labels[0]:
-                    row, col = key.labels[0].split(",")
-                    row, col = int(row), int(col)
-                key.row = row
-                key.col = col
-                self.rowcol[(row, col)] = True
-                self.keys.append(key)
-
-            # bottom right corner determines layout index and option in this layout
-            key.layout_index = -1
-            key.layout_option = -1
-            if key.labels[8]:
-                idx, opt = key.labels[8].split(",")
-                key.layout_index, key.layout_option = int(idx), int(opt)
+        self.keys = parsed.keys
+        self.encoders = parsed.encoders
+        for pos in parsed.rowcol:
+            self.rowcol[pos] = True
+        for idx in parsed.encoderpos:
+            self.encoderpos[idx] = True
+        self.encoder_count = max(self.encoder_count, parsed.encoder_count)
 
     def reload_keymap(self):
         """ Load current key mapping from the keyboard """
@@ -303,28 +457,29 @@ class Keyboard(ProtocolMacro, ProtocolDynamic, ProtocolTapDance, ProtocolCombo,
         keymap = b""
         # calculate what the size of keymap will be and retrieve the entire binary buffer
         size = self.layers * self.rows * self.cols * 2
-        for x in range(0, size, BUFFER_FETCH_CHUNK):
-            offset = x
+        requests = []
+        for offset in range(0, size, BUFFER_FETCH_CHUNK):
             sz = min(size - offset, BUFFER_FETCH_CHUNK)
-            data = self.usb_send(self.dev, struct.pack(">BHB", CMD_VIA_KEYMAP_GET_BUFFER, offset, sz), retries=20)
+            requests.append(struct.pack(">BHB", CMD_VIA_KEYMAP_GET_BUFFER, offset, sz))
+        for req, data in zip(requests, self.usb_send_many(self.dev, requests, retries=20)):
+            sz = req[3]
             keymap += data[4:4+sz]
 
-        for layer in range(self.layers):
-            for row, col in self.rowcol.keys():
-                if row >= self.rows or col >= self.cols:
-                    raise RuntimeError("malformed vial.json, key references {},{} but matrix declares rows={} cols={}"
-                                       .format(row, col, self.rows, self.cols))
-                # determine where this (layer, row, col) will be located in keymap array
-                offset = layer * self.rows * self.cols * 2 + row * self.cols * 2 + col * 2
-                keycode = Keycode.serialize(struct.unpack(">H", keymap[offset:offset+2])[0])
-                self.layout[(layer, row, col)] = keycode
-
-        for layer in range(self.layers):
-            for idx in self.encoderpos:
-                data = self.usb_send(self.dev, struct.pack("BBBB", CMD_VIA_VIAL_PREFIX, CMD_VIAL_GET_ENCODER, layer, idx),
-                                     retries=20)
-                self.encoder_layout[(layer, idx, 0)] = Keycode.serialize(struct.unpack(">H", data[0:2])[0])
-                self.encoder_layout[(layer, idx, 1)] = Keycode.serialize(struct.unpack(">H", data[2:4])[0])
+        for row, col in self.rowcol.keys():
+            if row >= self.rows or col >= self.cols:
+                raise RuntimeError("malformed vial.json, key references {},{} but matrix declares rows={} cols={}"
+                                   .format(row, col, self.rows, self.cols))
+        self.layout = self.keymap_store()
+        self.layout.load(keymap, self.rowcol.keys())
+
+        positions = [(layer, idx) for layer in range(self.layers) for idx in self.encoderpos]
+        responses = self.usb_send_many(
+            self.dev,
+            [struct.pack("BBBB", CMD_VIA_VIAL_PREFIX, CMD_VIAL_GET_ENCODER, layer, idx) for layer, idx in positions],
+            retries=20)
+        for (layer, idx), data in zip(positions, responses):
+            self.encoder_layout[(layer, idx, 0)] = Keycode.serialize(struct.unpack(">H", data[0:2])[0])
+            self.encoder_layout[(layer, idx, 1)] = Keycode.serialize(struct.unpack(">H", data[2:4])[0])
 
         if self.layout_labels:
             data = self.usb_send(self.dev, struct.pack("BB", CMD_VIA_GET_KEYBOARD_VALUE, VIA_LAYOUT_OPTIONS),
@@ -416,77 +571,128 @@ class Keyboard(ProtocolMacro, ProtocolDynamic, ProtocolTapDance, ProtocolCombo,
             if data[0] == 0:
                 self.settings[qsid] = QmkSettings.qsid_deserialize(qsid, data[1:])
 
+    def keymap_store(self, keys=()):
+        """ An empty KeymapStore sized for this keyboard, filled with `keys` """
+        store = KeymapStore(self.layers, self.rows, self.cols)
+        store.update(keys)
+        return store
+
+    def keymap_offset(self, layer, row, col):
+        """ Where the keycode of (layer, row, col) is located in the keymap buffer """
+        return layer * self.rows * self.cols * 2 + row * self.cols * 2 + col * 2
+
+    def keymap_position(self, offset):
+        layer, pos = divmod(offset // 2, self.rows * self.cols)
+        return (layer,) + divmod(pos, self.cols)
+
     def set_key(self, layer, row, col, code):
         key = (layer, row, col)
         if self.layout[key] != code:
             if code == RESET_KEYCODE:
                 Unlocker.unlock(self)
 
-            self.usb_send(self.dev, struct.pack(">BBBBH", CMD_VIA_SET_KEYCODE, layer, row, col,
-                                                Keycode.deserialize(code)), retries=20)
+            self.post_key(layer, row, col, code)
             self.layout[key] = code
 
+    def post_key(self, layer, row, col, code):
+        self.usb_post(self.dev, struct.pack(">BBBBH", CMD_VIA_SET_KEYCODE, layer, row, col,
+                                            Keycode.deserialize(code)), retries=20)
+
+    def set_keys(self, keys):
+        """
+        Changes many keys at once, `keys` maps (layer, row, col) to keycodes. The changed keys are
+        written through the keymap buffer, BUFFER_FETCH_CHUNK bytes per packet, or one packet per
+        key on firmware which doesn't support writing the buffer.
+        """
+        changed = {key: code for key, code in keys.items() if self.layout[key] != code}
+        if not changed:
+            return
+        if RESET_KEYCODE in changed.values():
+            Unlocker.unlock(self)
+        self.layout.update(changed)
+
+        if self.keymap_set_buffer is not False and self.write_keymap_spans(self.keymap_dirty_spans(changed)):
+            return
+        for (layer, row, col), code in sorted(changed.items()):
+            self.post_key(layer, row, col, code)
+
+    def keymap_dirty_spans(self, keys):
+        """ Groups the keys into (offset, size) spans of the keymap buffer, see util.dirty_spans """
+        return dirty_spans([self.keymap_offset(*key) for key in keys], 2, BUFFER_FETCH_CHUNK,
+                           lambda offset: self.keymap_position(offset) in self.layout)
+
+    def write_keymap_spans(self, spans):
+        """ Writes spans of the keymap buffer from self.layout, returns False if the firmware rejected it """
+        packets = []
+        for start, size in spans:
+            data = self.layout.buffer(start, start + size)
+            for x in range(0, size, BUFFER_FETCH_CHUNK):
+                chunk = data[x:x + BUFFER_FETCH_CHUNK]
+                packets.append(struct.pack(">BHB", CMD_VIA_KEYMAP_SET_BUFFER, start + x, len(chunk)) + chunk)
+
+        if self.keymap_set_buffer is None:
+            # the first write tells whether the firmware implements the command
+            data = self.usb_send(self.dev, packets[0], retries=20)
+            self.keymap_set_buffer = data[0] != CMD_VIA_UNHANDLED
+            if not self.keymap_set_buffer:
+                return False
+            packets = packets[1:]
+        for packet in packets:
+            self.usb_post(self.dev, packet, retries=20)
+        return True
+
     def set_encoder(self, layer, index, direction, code):
         key = (layer, index, direction)
         if self.encoder_layout[key] != code:
             if code == RESET_KEYCODE:
                 Unlocker.unlock(self)
 
-            self.usb_send(self.dev, struct.pack(">BBBBBH", CMD_VIA_VIAL_PREFIX, CMD_VIAL_SET_ENCODER,
+            self.usb_post(self.dev, struct.pack(">BBBBBH", CMD_VIA_VIAL_PREFIX, CMD_VIAL_SET_ENCODER,
                                                 layer, index, direction, Keycode.deserialize(code)), retries=20)
             self.encoder_layout[key] = code
 
     def set_layout_options(self, options):
         if self.layout_options != -1 and self.layout_options != options:
             self.layout_options = options
-            self.usb_send(self.dev, struct.pack(">BBI", CMD_VIA_SET_KEYBOARD_VALUE, VIA_LAYOUT_OPTIONS, options),
+            self.usb_post(self.dev, struct.pack(">BBI", CMD_VIA_SET_KEYBOARD_VALUE, VIA_LAYOUT_OPTIONS, options),
                           retries=20)
 
     def set_qmk_rgblight_brightness(self, value):
         self.underglow_brightness = value
-        self.usb_send(self.dev, struct.pack(">BBB", CMD_VIA_LIGHTING_SET_VALUE, QMK_RGBLIGHT_BRIGHTNESS, value),
+        self.usb_post(self.dev, struct.pack(">BBB", CMD_VIA_LIGHTING_SET_VALUE, QMK_RGBLIGHT_BRIGHTNESS, value),
                       retries=20)
 
     def set_qmk_rgblight_effect(self, index):
         self.underglow_effect = index
-        self.usb_send(self.dev, struct.pack(">BBB", CMD_VIA_LIGHTING_SET_VALUE, QMK_RGBLIGHT_EFFECT, index),
+        self.usb_post(self.dev, struct.pack(">BBB", CMD_VIA_LIGHTING_SET_VALUE, QMK_RGBLIGHT_EFFECT, index),
                       retries=20)
 
     def set_qmk_rgblight_effect_speed(self, value):
         self.underglow_effect_speed = value
-        self.usb_send(self.dev, struct.pack(">BBB", CMD_VIA_LIGHTING_SET_VALUE, QMK_RGBLIGHT_EFFECT_SPEED, value),
+        self.usb_post(self.dev, struct.pack(">BBB", CMD_VIA_LIGHTING_SET_VALUE, QMK_RGBLIGHT_EFFECT_SPEED, value),
                       retries=20)
 
     def set_qmk_rgblight_color(self, h, s, v):
         self.set_qmk_rgblight_brightness(v)
-        self.usb_send(self.dev, struct.pack(">BBBB", CMD_VIA_LIGHTING_SET_VALUE, QMK_RGBLIGHT_COLOR, h, s))
+        self.usb_post(self.dev, struct.pack(">BBBB", CMD_VIA_LIGHTING_SET_VALUE, QMK_RGBLIGHT_COLOR, h, s))
 
     def set_qmk_backlight_brightness(self, value):
         self.backlight_brightness = value
-        self.usb_send(self.dev, struct.pack(">BBB", CMD_VIA_LIGHTING_SET_VALUE, QMK_BACKLIGHT_BRIGHTNESS, value))
+        self.usb_post(self.dev, struct.pack(">BBB", CMD_VIA_LIGHTING_SET_VALUE, QMK_BACKLIGHT_BRIGHTNESS, value))
 
     def set_qmk_backlight_effect(self, value):
         self.backlight_effect = value
-        self.usb_send(self.dev, struct.pack(">BBB", CMD_VIA_LIGHTING_SET_VALUE, QMK_BACKLIGHT_EFFECT, value))
+        self.usb_post(self.dev, struct.pack(">BBB", CMD_VIA_LIGHTING_SET_VALUE, QMK_BACKLIGHT_EFFECT, value))
 
     def save_rgb(self):
-        self.usb_send(self.dev, struct.pack(">B", CMD_VIA_LIGHTING_SAVE), retries=20)
+        self.usb_post(self.dev, struct.pack(">B", CMD_VIA_LIGHTING_SAVE), retries=20)
 
     def save_layout(self):
         """ Serializes current layout to a binary """
 
         data = {"version": 1, "uid": self.keyboard_id}
 
-        layout = []
-        for l in range(self.layers):
-            layer = []
-            layout.append(layer)
-            for r in range(self.rows):
-                row = []
-                layer.append(row)
-                for c in range(self.cols):
-                    val = self.layout.get((l, r, c), -1)
-                    row.append(val)
+        layout = self.layout.grid(self.layers, self.rows, self.cols, -1)
 
         encoder_layout = []
         for l in range(self.layers):
@@ -511,37 +717,13 @@ class Keyboard(ProtocolMacro, ProtocolDynamic, ProtocolTapDance, ProtocolCombo,
 
         return json.dumps(data).encode("utf-8")
 
+    def plan_restore(self, data):
+        """ Plans the writes restoring a saved layout, without performing them """
+        return RestorePlanner(self).plan(data)
+
     def restore_layout(self, data):
         """ Restores saved layout """
-
-        data = json.loads(data.decode("utf-8"))
-
-        # restore keymap
-        for l, layer in enumerate(data["layout"]):
-            for r, row in enumerate(layer):
-                for c, code in enumerate(row):
-                    if (l, r, c) in self.layout:
-                        self.set_key(l, r, c, Keycode.serialize(Keycode.deserialize(code)))
-
-        # restore encoders
-        for l, layer in enumerate(data["encoder_layout"]):
-            for e, encoder in enumerate(layer):
-                self.set_encoder(l, e, 0, Keycode.serialize(Keycode.deserialize(encoder[0])))
-                self.set_encoder(l, e, 1, Keycode.serialize(Keycode.deserialize(encoder[1])))
-
-        self.set_layout_options(data["layout_options"])
-        self.restore_macros(data.get("macro"))
-
-        self.restore_tap_dance(data.get("tap_dance", []))
-        self.restore_combo(data.get("combo", []))
-        self.restore_key_override(data.get("key_override", []))
-
-        for qsid, value in data.get("settings", dict()).items():
-            from editor.qmk_settings import QmkSettings
-
-            qsid = int(qsid)
-            if QmkSettings.is_qsid_supported(qsid):
-                self.qmk_settings_set(qsid, value)
+        self.plan_restore(data).execute()
 
     def reset(self):
         self.usb_send(self.dev, struct.pack("B", 0xB))
@@ -613,19 +795,68 @@ class Keyboard(ProtocolMacro, ProtocolDynamic, ProtocolTapDance, ProtocolCombo,
                              retries=3)
         return data
 
+    def post_write(self, usb_send, *args, **kwargs):
+        """ Queues a write on the I/O thread, see write_failed for what happens when it fails """
+        return self.worker.post(self.send_write, usb_send, *args, **kwargs)
+
+    def send_write(self, usb_send, *args, **kwargs):
+        # notify before the Future completes, so that whoever waits on it already sees the failure reported
+        try:
+            return usb_send(*args, **kwargs)
+        except Exception as e:
+            self.notify_write_failed(e)
+            raise
+
+    def notify_write_failed(self, e):
+        if self.write_failed is not None:
+            self.write_failed(e)
+
     def qmk_settings_set(self, qsid, value):
+        """
+        Queues the write and returns a Future of the firmware's status byte, 0 when the setting was
+        applied (this used to be returned directly). Unless it's 0, self.settings goes back to the
+        previous value and write_failed is notified.
+        """
         from editor.qmk_settings import QmkSettings
+        previous = self.settings.get(qsid)
         self.settings[qsid] = value
-        data = self.usb_send(self.dev, struct.pack("<BBH", CMD_VIA_VIAL_PREFIX, CMD_VIAL_QMK_SETTINGS_SET, qsid)
-                             + QmkSettings.qsid_serialize(qsid, value),
-                             retries=20)
-        return data[0]
+        status = Future()
+        try:
+            sent = self.usb_post(self.dev, struct.pack("<BBH", CMD_VIA_VIAL_PREFIX, CMD_VIAL_QMK_SETTINGS_SET, qsid)
+                                 + QmkSettings.qsid_serialize(qsid, value), retries=20)
+        except Exception:
+            # InlineWorker raises in place
+            self.qmk_settings_revert(qsid, value, previous)
+            raise
+        sent.add_done_callback(partial(self.on_qmk_settings_sent, qsid, value, previous, status))
+        return status
+
+    def on_qmk_settings_sent(self, qsid, value, previous, status, sent):
+        # usb_post has already reported a failed send to write_failed
+        e = CancelledError() if sent.cancelled() else sent.exception()
+        if e is not None:
+            self.qmk_settings_revert(qsid, value, previous)
+            status.set_exception(e)
+            return
+        data = sent.result()
+        if data[0] != 0:
+            self.qmk_settings_revert(qsid, value, previous)
+            self.notify_write_failed(ProtocolError("QMK setting {} was rejected with status {}".format(qsid, data[0])))
+        status.set_result(data[0])
+
+    def qmk_settings_revert(self, qsid, value, previous):
+        # unless it was set to something else meanwhile
+        if self.settings.get(qsid) == value:
+            if previous is None:
+                del self.settings[qsid]
+            else:
+                self.settings[qsid] = previous
 
     def qmk_settings_reset(self):
-        self.usb_send(self.dev, struct.pack("BB", CMD_VIA_VIAL_PREFIX, CMD_VIAL_QMK_SETTINGS_RESET))
+        self.usb_post(self.dev, struct.pack("BB", CMD_VIA_VIAL_PREFIX, CMD_VIAL_QMK_SETTINGS_RESET))
 
     def _vialrgb_set_mode(self):
-        self.usb_send(self.dev, struct.pack("BBHBBBB", CMD_VIA_LIGHTING_SET_VALUE, VIALRGB_SET_MODE,
+        self.usb_post(self.dev, struct.pack("BBHBBBB", CMD_VIA_LIGHTING_SET_VALUE, VIALRGB_SET_MODE,
                                             self.rgb_mode, self.rgb_speed,
                                             self.rgb_hsv[0], self.rgb_hsv[1], self.rgb_hsv[2]))
 
@@ -0,0 +1,162 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+import sys
+from array import array
+from collections.abc import MutableMapping
+
+from keycodes.keycodes import Keycode
+
+
+class KeymapStore(MutableMapping):
+    """
+    The keymap of a keyboard as raw 16-bit keycodes, laid out like the firmware's keymap buffer:
+    (layer, row, col) is at index layer*rows*cols + row*cols + col.
+
+    It is read and written like the dict of (layer, row, col) -> qmk_id it replaces. Only the
+    positions which are present in the layout are keys of it; qmk_ids are made from the raw codes
+    when they are asked for, and cached until the keycode tables are recreated. Setting a key
+    outside of the dimensions grows them.
+    """
+
+    def __init__(self, layers=0, rows=0, cols=0):
+        self.layers, self.rows, self.cols = layers, rows, cols
+        self.codes = array("H", bytes(2 * layers * rows * cols))
+        # 1 where a key of the layout is
+        self.present = bytearray(layers * rows * cols)
+        self.count = 0
+        # raw code -> qmk_id, only valid for Keycode.generation == self.generation
+        self.names = dict()
+        self.generation = Keycode.generation
+
+    def index(self, key):
+        layer, row, col = key
+        if not (0 <= layer < self.layers and 0 <= row < self.rows and 0 <= col < self.cols):
+            raise KeyError(key)
+        return (layer * self.rows + row) * self.cols + col
+
+    def position(self, index):
+        layer, pos = divmod(index, self.rows * self.cols)
+        return (layer,) + divmod(pos, self.cols)
+
+    def load(self, buffer, rowcol):
+        """ Takes the keymap buffer as read from the keyboard, `rowcol` are the (row, col) in the layout """
+        codes = array("H", buffer)
+        if sys.byteorder == "little":
+            codes.byteswap()
+        if len(codes) != len(self.codes):
+            raise ValueError("keymap buffer has {} keycodes, expected {}".format(len(codes), len(self.codes)))
+        self.codes = codes
+
+        layer_size = self.rows * self.cols
+        layer = bytearray(layer_size)
+        for row, col in rowcol:
+            layer[row * self.cols + col] = 1
+        self.present = layer * self.layers
+        self.count = sum(layer) * self.layers
+
+    def name(self, code):
+        name = self.current_names().get(code)
+        if name is None:
+            name = self.names[code] = Keycode.serialize(code)
+        return name
+
+    def current_names(self):
+        if self.generation != Keycode.generation:
+            self.names.clear()
+            self.generation = Keycode.generation
+        return self.names
+
+    def grid(self, layers, rows, cols, default=None):
+        """ qmk_ids as [layer][row][col] lists, `default` where there is no key """
+        if (layers, rows, cols) != (self.layers, self.rows, self.cols):
+            return [[[self.get((l, r, c), default) for c in range(cols)] for r in range(rows)] for l in range(layers)]
+        codes, present = self.codes, self.present
+        names = self.current_names()
+        for code in set(codes) - names.keys():
+            self.name(code)
+        lookup = names.__getitem__
+        result = []
+        idx = 0
+        for l in range(layers):
+            layer = []
+            for r in range(rows):
+                row = list(map(lookup, codes[idx:idx + cols]))
+                if present.find(0, idx, idx + cols) != -1:
+                    row = [name if present[idx + c] else default for c, name in enumerate(row)]
+                layer.append(row)
+                idx += cols
+            result.append(layer)
+        return result
+
+    def raw(self, key):
+        """ The keycode of `key` as an integer """
+        idx = self.index(key)
+        if not self.present[idx]:
+            raise KeyError(key)
+        return self.codes[idx]
+
+    def resize(self, layers, rows, cols):
+        """ Changes the dimensions, keeping the keys which still fit """
+        keys = [(key, self.codes[self.index(key)]) for key in self
+                if key[0] < layers and key[1] < rows and key[2] < cols]
+        self.__init__(layers, rows, cols)
+        for key, code in keys:
+            self.set_raw(key, code)
+
+    def set_raw(self, key, code):
+        layer, row, col = key
+        if layer >= self.layers or row >= self.rows or col >= self.cols:
+            # only happens when keys are added before the store was sized for the keyboard
+            self.resize(max(self.layers, layer + 1), max(self.rows, row + 1), max(self.cols, col + 1))
+        idx = self.index(key)
+        if not self.present[idx]:
+            self.present[idx] = 1
+            self.count += 1
+        self.codes[idx] = code
+
+    def buffer(self, start=0, end=None):
+        """ Bytes of the keymap buffer between the two byte offsets, as the firmware stores it """
+        codes = self.codes[start // 2:None if end is None else end // 2]
+        if sys.byteorder == "little":
+            codes.byteswap()
+        return codes.tobytes()
+
+    def __getitem__(self, key):
+        return self.name(self.raw(key))
+
+    def get(self, key, default=None):
+        try:
+            idx = self.index(key)
+        except (KeyError, TypeError, ValueError):
+            return default
+        if not self.present[idx]:
+            return default
+        return self.name(self.codes[idx])
+
+    def __contains__(self, key):
+        try:
+            return self.present[self.index(key)] == 1
+        except (KeyError, TypeError, ValueError):
+            return False
+
+    def __setitem__(self, key, code):
+        self.set_raw(key, Keycode.deserialize(code))
+
+    def __delitem__(self, key):
+        idx = self.index(key)
+        if not self.present[idx]:
+            raise KeyError(key)
+        self.present[idx] = 0
+        self.count -= 1
+        self.codes[idx] = 0
+
+    def __iter__(self):
+        present = self.present
+        for idx in range(len(present)):
+            if present[idx]:
+                yield self.position(idx)
+
+    def __len__(self):
+        return self.count
+
+    def __repr__(self):
+        return "KeymapStore({})".format(dict(self.items()))
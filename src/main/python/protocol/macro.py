@@ -171,7 +171,7 @@ class ProtocolMacro(BaseProtocol):
 
         for x, chunk in enumerate(chunks(data, BUFFER_FETCH_CHUNK)):
             off = x * BUFFER_FETCH_CHUNK
-            self.usb_send(self.dev, struct.pack(">BHB", CMD_VIA_MACRO_SET_BUFFER, off, len(chunk)) + chunk,
+            self.usb_post(self.dev, struct.pack(">BHB", CMD_VIA_MACRO_SET_BUFFER, off, len(chunk)) + chunk,
                           retries=20)
         self.macro = data
 
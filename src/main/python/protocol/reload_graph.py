@@ -0,0 +1,81 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+
+class ReloadCancelled(Exception):
+    pass
+
+
+class ReloadStage:
+    """ One step of Keyboard.reload, runs after all of the stages it depends on """
+
+    def __init__(self, name, fn, deps=(), background=False):
+        self.name = name
+        self.fn = fn
+        self.deps = list(deps)
+        # background stages aren't needed by the keymap editor and can finish after the UI is shown
+        self.background = background
+
+
+class ReloadGraph:
+    """
+    Orders reload stages by their dependencies and runs them, reporting progress after each one.
+
+    All stages talk to the same device so they run one at a time; the graph only decides the order
+    and allows the foreground part to be run first and the background part later.
+    """
+
+    def __init__(self, stages):
+        self.stages = self.sort(stages)
+        self.done = set()
+        self.cancelled = False
+
+        # a foreground stage can't wait for a background one
+        background = set(s.name for s in self.stages if s.background)
+        for stage in self.stages:
+            if not stage.background and background.intersection(stage.deps):
+                raise ValueError("foreground stage {} depends on a background stage".format(stage.name))
+
+    @staticmethod
+    def sort(stages):
+        by_name = {s.name: s for s in stages}
+        out = []
+        state = dict()
+
+        def visit(stage):
+            if state.get(stage.name) == "done":
+                return
+            if state.get(stage.name) == "visiting":
+                raise ValueError("reload stages have a dependency cycle at {}".format(stage.name))
+            state[stage.name] = "visiting"
+            for dep in stage.deps:
+                if dep not in by_name:
+                    raise ValueError("reload stage {} depends on unknown stage {}".format(stage.name, dep))
+                visit(by_name[dep])
+            state[stage.name] = "done"
+            out.append(stage)
+
+        # stable: stages without ordering constraints keep the order they were declared in
+        for stage in stages:
+            visit(stage)
+        return out
+
+    def run(self, background=None, progress=None):
+        """
+        Runs stages which haven't run yet; only foreground or only background ones if `background` is set.
+        progress(stage_name, done, total) is called after every stage.
+        """
+        for stage in self.stages:
+            if stage.name in self.done or (background is not None and stage.background != background):
+                continue
+            if self.cancelled:
+                raise ReloadCancelled()
+            stage.fn()
+            self.done.add(stage.name)
+            if progress is not None:
+                progress(stage.name, len(self.done), len(self.stages))
+
+    def cancel(self):
+        self.cancelled = True
+
+    def finished(self):
+        return len(self.done) == len(self.stages)
@@ -0,0 +1,218 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+class CountingDevice:
+    """ Passes everything through to a hidapi device, counting the packets and bytes that go over the wire """
+
+    def __init__(self, dev, profiler):
+        self.dev = dev
+        self.profiler = profiler
+
+    def write(self, data):
+        ret = self.dev.write(data)
+        self.profiler.count(packets=1, bytes=len(data))
+        return ret
+
+    def read(self, *args, **kwargs):
+        data = self.dev.read(*args, **kwargs)
+        self.profiler.count(bytes=len(data))
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.dev, name)
+
+
+class ReloadProfiler:
+    """
+    Opt-in instrumentation of Keyboard.reload: every reload* method of the keyboard is timed, along with
+    the requests, packets, bytes and retries it caused. Results are exported as a Chrome trace_event
+    JSON file (chrome://tracing, Perfetto) and a plain-text summary.
+
+    Counts are inclusive, a span includes the traffic of every span nested in it. Retries are the
+    packets written beyond one per request, so they are only known when talking to a hidapi device.
+
+        profiler = ReloadProfiler()
+        profiler.attach(keyboard)
+        keyboard.reload()
+        profiler.save("reload.json")
+    """
+
+    COUNTERS = ["requests", "packets", "bytes"]
+
+    # armed by --profile-reload or the debug menu, picked up by the next keyboard that is opened
+    armed_path = None
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.totals = dict.fromkeys(self.COUNTERS, 0)
+        self.events = []
+        self.threads = dict()
+        self.stacks = threading.local()
+        self.started = time.monotonic()
+        self.running = True
+        self.keyboard = None
+        self.direct_io = False
+
+    @classmethod
+    def arm(cls, path):
+        cls.armed_path = path
+
+    @classmethod
+    def take_armed(cls):
+        """ Returns the path armed for the next reload and disarms it """
+        path, cls.armed_path = cls.armed_path, None
+        return path
+
+    def count(self, **counts):
+        if not self.running:
+            return
+        with self.lock:
+            for name, value in counts.items():
+                self.totals[name] += value
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.totals)
+
+    def attach(self, keyboard):
+        """ Instruments a Keyboard instance; copies of it made during the reload are instrumented too """
+        self.keyboard = keyboard
+        if keyboard.dev is not None:
+            keyboard.dev = CountingDevice(keyboard.dev, self)
+            self.direct_io = True
+
+        usb_send, usb_send_many, usb_post = keyboard.usb_send, keyboard.usb_send_many, keyboard.usb_post
+
+        def counted_send(dev, msg, *args, **kwargs):
+            self.count(requests=1)
+            return usb_send(dev, msg, *args, **kwargs)
+
+        def counted_send_many(dev, msgs, *args, **kwargs):
+            self.count(requests=len(msgs))
+            return usb_send_many(dev, msgs, *args, **kwargs)
+
+        def counted_post(dev, msg, *args, **kwargs):
+            self.count(requests=1)
+            return usb_post(dev, msg, *args, **kwargs)
+
+        keyboard.usb_send, keyboard.usb_send_many, keyboard.usb_post = counted_send, counted_send_many, counted_post
+
+        # reload stages are also run on copies of the keyboard, so patch the class rather than the instance
+        cls = type(keyboard)
+        methods = dict()
+        for name in dir(cls):
+            if name.startswith("reload") and callable(getattr(cls, name)):
+                methods[name] = self.instrument(name, getattr(cls, name))
+        keyboard.__class__ = type("Profiled" + cls.__name__, (cls,), methods)
+
+    def instrument(self, name, fn):
+        profiler = self
+
+        def method(keyboard, *args, **kwargs):
+            if not profiler.running:
+                return fn(keyboard, *args, **kwargs)
+            with profiler.span(name):
+                return fn(keyboard, *args, **kwargs)
+
+        method.__name__ = method.__qualname__ = name
+        method.__doc__ = fn.__doc__
+        return method
+
+    @contextmanager
+    def span(self, name):
+        depth = getattr(self.stacks, "depth", 0)
+        self.stacks.depth = depth + 1
+        before = self.snapshot()
+        start = time.monotonic()
+        error = None
+        try:
+            yield
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            end = time.monotonic()
+            self.stacks.depth = depth
+            self.record(name, start, end, depth, before, self.snapshot(), error)
+
+    def record(self, name, start, end, depth, before, after, error):
+        thread = threading.current_thread()
+        event = {
+            "name": name,
+            "start": start - self.started,
+            "duration": end - start,
+            "depth": depth,
+            "thread": thread.ident,
+        }
+        for counter in self.COUNTERS:
+            event[counter] = after[counter] - before[counter]
+        event["retries"] = max(0, event["packets"] - event["requests"]) if self.direct_io else 0
+        if error is not None:
+            event["error"] = error
+        with self.lock:
+            self.threads[thread.ident] = thread.name
+            self.events.append(event)
+
+    def stop(self):
+        self.running = False
+
+    def finish(self, path):
+        self.stop()
+        try:
+            self.save(path)
+        except OSError as e:
+            logging.warning("Failed to save reload profile: %s", e)
+            return
+        logging.info("Reload profile saved to %s", path)
+
+    def trace(self):
+        """ Chrome trace_event JSON object """
+        pid = os.getpid()
+        events = []
+        for ident, name in self.threads.items():
+            events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": ident, "args": {"name": name}})
+        for e in sorted(self.events, key=lambda e: e["start"]):
+            args = {k: e[k] for k in self.COUNTERS + ["retries"]}
+            if "error" in e:
+                args["error"] = e["error"]
+            events.append({
+                "name": e["name"], "cat": "reload", "ph": "X", "pid": pid, "tid": e["thread"],
+                "ts": round(e["start"] * 1e6, 1), "dur": round(e["duration"] * 1e6, 1), "args": args,
+            })
+        out = {"traceEvents": events, "displayTimeUnit": "ms"}
+        if self.keyboard is not None:
+            out["otherData"] = {
+                "keyboard_id": "{:016X}".format(self.keyboard.keyboard_id & 0xFFFFFFFFFFFFFFFF),
+                "via_protocol": self.keyboard.via_protocol,
+                "vial_protocol": self.keyboard.vial_protocol,
+            }
+        return out
+
+    def summary(self):
+        """ Plain-text table of every span, nested spans indented under their parent """
+        lines = ["{:<40} {:>10} {:>8} {:>8} {:>8} {:>8}".format(
+            "stage", "wall ms", "requests", "packets", "bytes", "retries")]
+        # spans are recorded when they end, list them in the order they started
+        for e in sorted(self.events, key=lambda e: e["start"]):
+            name = "  " * e["depth"] + e["name"] + (" !" if "error" in e else "")
+            lines.append("{:<40} {:>10.1f} {:>8} {:>8} {:>8} {:>8}".format(
+                name, e["duration"] * 1000, e["requests"], e["packets"], e["bytes"], e["retries"]))
+        totals = self.snapshot()
+        lines.append("")
+        lines.append("total: {} requests, {} packets, {} bytes".format(
+            totals["requests"], totals["packets"], totals["bytes"]))
+        return "\n".join(lines) + "\n"
+
+    def save(self, path):
+        """ Writes the trace to `path` and the summary next to it, with a .txt extension """
+        with open(path, "w") as outf:
+            json.dump(self.trace(), outf, indent=1)
+        with open(os.path.splitext(path)[0] + ".txt", "w") as outf:
+            outf.write(self.summary())
+
@@ -0,0 +1,309 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+import json
+import struct
+
+from hid_metrics import HidMetrics
+from keycodes.keycodes import Keycode, RESET_KEYCODE
+from macro.macro_action_ui import tag_to_action
+from protocol.constants import CMD_VIA_SET_KEYCODE, CMD_VIA_KEYMAP_SET_BUFFER, CMD_VIA_UNHANDLED, \
+    CMD_VIA_SET_KEYBOARD_VALUE, VIA_LAYOUT_OPTIONS, CMD_VIA_MACRO_SET_BUFFER, CMD_VIA_VIAL_PREFIX, \
+    CMD_VIAL_SET_ENCODER, CMD_VIAL_QMK_SETTINGS_SET, CMD_VIAL_DYNAMIC_ENTRY_OP, DYNAMIC_VIAL_TAP_DANCE_SET, \
+    DYNAMIC_VIAL_COMBO_SET, DYNAMIC_VIAL_KEY_OVERRIDE_SET, BUFFER_FETCH_CHUNK
+from protocol.key_override import KeyOverrideEntry
+from unlocker import Unlocker
+from util import dirty_spans
+
+
+class RestoreCancelled(Exception):
+    pass
+
+
+class RestoreStep:
+    """ One packet of a restore plan, `commit` updates the in-memory keyboard state once it was sent """
+
+    def __init__(self, section, description, packet, commit, fallback=None):
+        self.section = section
+        self.description = description
+        self.packet = packet
+        self.commit = commit
+        # makes the per-key steps replacing a keymap buffer write on firmware which doesn't support it
+        self.fallback = fallback
+
+
+class RestorePlan:
+    """
+    The packets needed to bring a keyboard to the state saved in a .vil layout file.
+
+    Only what differs from the current state of the keyboard is written: keymap changes as spans
+    of the keymap buffer, macros as the byte ranges of the macro buffer which changed, and only the
+    encoders, dynamic entries and QMK settings which changed. Macros, dynamic entries and settings
+    are written before the keymap and encoders, so that keys come into effect with what they
+    refer to already in place.
+
+    Building a plan doesn't talk to the keyboard, so it doubles as a dry run:
+
+        plan = keyboard.plan_restore(data)
+        print("\\n".join(plan.describe()), plan.estimate())
+        plan.execute(progress=lambda done, total: ..., cancelled=lambda: ...)
+    """
+
+    SECTIONS = ["settings", "layout_options", "macro", "tap_dance", "combo", "key_override", "encoder", "keymap"]
+
+    # assumed round trip of a packet to a keyboard which wasn't talked to yet, in seconds
+    DEFAULT_LATENCY = 0.004
+
+    def __init__(self, keyboard, steps, unlock=False):
+        self.keyboard = keyboard
+        self.steps = sorted(steps, key=lambda step: self.SECTIONS.index(step.section))
+        # whether the keyboard has to be unlocked first: changing macros or writing QK_BOOT anywhere
+        self.unlock = unlock
+        self.done = 0
+
+    def __len__(self):
+        return len(self.steps)
+
+    def summary(self):
+        """ Number of packets per section """
+        out = dict()
+        for step in self.steps:
+            out[step.section] = out.get(step.section, 0) + 1
+        return out
+
+    def describe(self):
+        """ What executing the plan would do, one line per packet """
+        return ["{}: {}".format(step.section, step.description) for step in self.steps]
+
+    def latency(self, packet):
+        latency = HidMetrics.get().mean_latency(packet)
+        if latency is None:
+            latency = self.keyboard.retry_policy.srtt
+        return latency if latency is not None else self.DEFAULT_LATENCY
+
+    def estimate(self):
+        """ Seconds the remaining steps should take, from the latencies measured on this device so far """
+        return sum(self.latency(step.packet) for step in self.steps[self.done:])
+
+    def execute(self, progress=None, cancelled=None):
+        """
+        Sends the remaining steps one at a time; progress(done, total) is called after each of them.
+        Raises RestoreCancelled as soon as cancelled() returns True, the keyboard state then reflects
+        the steps which were sent and execute() can be called again to finish the rest.
+        """
+        if self.unlock and self.done < len(self.steps):
+            Unlocker.unlock(self.keyboard)
+            self.unlock = False
+
+        while self.done < len(self.steps):
+            if cancelled is not None and cancelled():
+                raise RestoreCancelled()
+            step = self.steps[self.done]
+            data = self.keyboard.usb_send(self.keyboard.dev, step.packet, retries=20)
+            if step.fallback is not None and data[0] == CMD_VIA_UNHANDLED:
+                self.keyboard.keymap_set_buffer = False
+                self.use_fallback()
+                continue
+            if step.fallback is not None:
+                self.keyboard.keymap_set_buffer = True
+            step.commit()
+            self.done += 1
+            if progress is not None:
+                progress(self.done, len(self.steps))
+
+    def use_fallback(self):
+        """ Replaces the remaining keymap buffer writes with per-key writes """
+        steps = self.steps[:self.done]
+        for step in self.steps[self.done:]:
+            steps += step.fallback() if step.fallback is not None else [step]
+        self.steps = steps
+
+
+class RestorePlanner:
+    """ Diffs a .vil layout file against the state of a Keyboard and builds a RestorePlan """
+
+    def __init__(self, keyboard):
+        self.keyboard = keyboard
+        self.steps = []
+        self.unlock = False
+
+    def plan(self, data):
+        data = json.loads(data.decode("utf-8"))
+        self.steps = []
+        self.unlock = False
+
+        self.plan_settings(data.get("settings", dict()))
+        self.plan_layout_options(data.get("layout_options", -1))
+        self.plan_macros(data.get("macro"))
+        self.plan_tap_dance(data.get("tap_dance", []))
+        self.plan_combo(data.get("combo", []))
+        self.plan_key_override(data.get("key_override", []))
+        self.plan_encoders(data.get("encoder_layout", []))
+        self.plan_keymap(data.get("layout", []))
+        return RestorePlan(self.keyboard, self.steps, self.unlock)
+
+    def add(self, section, description, packet, commit, fallback=None):
+        self.steps.append(RestoreStep(section, description, packet, commit, fallback))
+
+    @staticmethod
+    def normalize(code):
+        return Keycode.serialize(Keycode.deserialize(code))
+
+    def plan_settings(self, settings):
+        from editor.qmk_settings import QmkSettings
+
+        kb = self.keyboard
+        for qsid, value in settings.items():
+            qsid = int(qsid)
+            if not QmkSettings.is_qsid_supported(qsid) or kb.settings.get(qsid) == value:
+                continue
+            packet = struct.pack("<BBH", CMD_VIA_VIAL_PREFIX, CMD_VIAL_QMK_SETTINGS_SET, qsid) \
+                + QmkSettings.qsid_serialize(qsid, value)
+
+            def commit(qsid=qsid, value=value):
+                kb.settings[qsid] = value
+            self.add("settings", "setting {} = {}".format(qsid, value), packet, commit)
+
+    def plan_layout_options(self, options):
+        kb = self.keyboard
+        if kb.layout_options == -1 or options == -1 or kb.layout_options == options:
+            return
+
+        def commit():
+            kb.layout_options = options
+        self.add("layout_options", "layout options = {}".format(options),
+                 struct.pack(">BBI", CMD_VIA_SET_KEYBOARD_VALUE, VIA_LAYOUT_OPTIONS, options), commit)
+
+    def plan_macros(self, macros):
+        kb = self.keyboard
+        if not isinstance(macros, list) or not kb.macro_count:
+            return
+
+        full_macro = []
+        for macro in macros[:kb.macro_count]:
+            actions = []
+            for act in macro:
+                if act[0] in tag_to_action:
+                    obj = tag_to_action[act[0]]()
+                    obj.restore(act)
+                    actions.append(obj)
+            full_macro.append(actions)
+        full_macro += [[] for x in range(kb.macro_count - len(full_macro))]
+        data = kb.macros_serialize(full_macro)[0:kb.macro_memory]
+        if data == kb.macro:
+            return
+
+        self.unlock = True
+        changed = [x for x in range(len(data)) if x >= len(kb.macro) or data[x] != kb.macro[x]]
+        for start, size in dirty_spans(changed, 1, BUFFER_FETCH_CHUNK):
+            for off in range(start, start + size, BUFFER_FETCH_CHUNK):
+                chunk = data[off:min(off + BUFFER_FETCH_CHUNK, start + size)]
+
+                def commit(off=off, chunk=chunk):
+                    kb.macro = kb.macro[:off] + chunk + kb.macro[off + len(chunk):]
+                self.add("macro", "macro buffer bytes {}-{}".format(off, off + len(chunk) - 1),
+                         struct.pack(">BHB", CMD_VIA_MACRO_SET_BUFFER, off, len(chunk)) + chunk, commit)
+
+        def commit_last(commit=self.steps[-1].commit):
+            commit()
+            # what is left of longer macros past the new end of the buffer doesn't matter
+            kb.macro = data
+        self.steps[-1].commit = commit_last
+
+    def plan_entries(self, section, entries, current, op, serialize):
+        for idx, entry in enumerate(entries[:len(current)]):
+            if entry == current[idx]:
+                continue
+
+            def commit(idx=idx, entry=entry):
+                current[idx] = entry
+            self.add(section, "{} {}".format(section.replace("_", " "), idx),
+                     struct.pack("BBBB", CMD_VIA_VIAL_PREFIX, CMD_VIAL_DYNAMIC_ENTRY_OP, op, idx) + serialize(entry),
+                     commit)
+
+    def plan_tap_dance(self, entries):
+        entries = [tuple(self.normalize(code) for code in e[:4]) + (e[4],) for e in entries]
+        if any(RESET_KEYCODE in e[:4] for e in entries[:self.keyboard.tap_dance_count]):
+            self.unlock = True
+        self.plan_entries("tap_dance", entries, self.keyboard.tap_dance_entries, DYNAMIC_VIAL_TAP_DANCE_SET,
+                          lambda e: struct.pack("<HHHHH", *[Keycode.deserialize(code) for code in e[:4]], e[4]))
+
+    def plan_combo(self, entries):
+        entries = [tuple(self.normalize(code) for code in e) for e in entries]
+        if any(e[-1] == RESET_KEYCODE for e in entries[:self.keyboard.combo_count]):
+            self.unlock = True
+        self.plan_entries("combo", entries, self.keyboard.combo_entries, DYNAMIC_VIAL_COMBO_SET,
+                          lambda e: struct.pack("<HHHHH", *[Keycode.deserialize(code) for code in e]))
+
+    def plan_key_override(self, entries):
+        restored = []
+        for e in entries:
+            ko = KeyOverrideEntry()
+            ko.restore(e)
+            restored.append(ko)
+        if any(ko.replacement == RESET_KEYCODE for ko in restored[:self.keyboard.key_override_count]):
+            self.unlock = True
+        self.plan_entries("key_override", restored, self.keyboard.key_override_entries,
+                          DYNAMIC_VIAL_KEY_OVERRIDE_SET, lambda ko: ko.serialize())
+
+    def plan_encoders(self, encoder_layout):
+        kb = self.keyboard
+        for l, layer in enumerate(encoder_layout):
+            for e, encoder in enumerate(layer):
+                for direction in range(2):
+                    key = (l, e, direction)
+                    if key not in kb.encoder_layout:
+                        continue
+                    code = self.normalize(encoder[direction])
+                    if kb.encoder_layout[key] == code:
+                        continue
+                    if code == RESET_KEYCODE:
+                        self.unlock = True
+
+                    def commit(key=key, code=code):
+                        kb.encoder_layout[key] = code
+                    self.add("encoder", "encoder {} {} on layer {} = {}".format(
+                        e, "ccw" if direction else "cw", l, code),
+                        struct.pack(">BBBBBH", CMD_VIA_VIAL_PREFIX, CMD_VIAL_SET_ENCODER, l, e, direction,
+                                    Keycode.deserialize(code)), commit)
+
+    def key_step(self, key, code):
+        def commit():
+            self.keyboard.layout[key] = code
+        return RestoreStep("keymap", "key {},{} on layer {} = {}".format(key[1], key[2], key[0], code),
+                           struct.pack(">BBBBH", CMD_VIA_SET_KEYCODE, key[0], key[1], key[2],
+                                       Keycode.deserialize(code)), commit)
+
+    def plan_keymap(self, layout):
+        kb = self.keyboard
+        # compared as raw keycodes, only the changed ones are turned back into qmk_ids
+        changed = dict()
+        for l, layer in enumerate(layout):
+            for r, row in enumerate(layer):
+                for c, code in enumerate(row):
+                    key = (l, r, c)
+                    if key in kb.layout:
+                        code = Keycode.deserialize(code)
+                        if kb.layout.raw(key) != code:
+                            changed[key] = code
+        if Keycode.deserialize(RESET_KEYCODE) in changed.values():
+            self.unlock = True
+
+        if kb.keymap_set_buffer is False:
+            self.steps += [self.key_step(key, Keycode.serialize(code)) for key, code in sorted(changed.items())]
+            return
+
+        for start, size in kb.keymap_dirty_spans(changed):
+            for off in range(start, start + size, BUFFER_FETCH_CHUNK):
+                end = min(off + BUFFER_FETCH_CHUNK, start + size)
+                keys = [kb.keymap_position(x) for x in range(off, end, 2)]
+                codes = {key: changed[key] if key in changed else kb.layout.raw(key) for key in keys}
+                packet = struct.pack(">BHB", CMD_VIA_KEYMAP_SET_BUFFER, off, end - off) + \
+                    struct.pack(">{}H".format(len(keys)), *[codes[key] for key in keys])
+
+                def commit(codes=codes):
+                    for key, code in codes.items():
+                        kb.layout.set_raw(key, code)
+
+                def fallback(keys=keys):
+                    return [self.key_step(key, Keycode.serialize(changed[key])) for key in keys if key in changed]
+                self.add("keymap", "{} keys from {},{} on layer {}".format(
+                    len(keys), keys[0][1], keys[0][2], keys[0][0]), packet, commit, fallback)
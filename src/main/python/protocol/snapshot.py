@@ -0,0 +1,180 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import sys
+from collections.abc import Mapping
+
+from protocol.key_override import KeyOverrideEntry
+
+
+class KeyboardSnapshot:
+    """
+    Last known state of a keyboard (keymap, macros, lighting, QMK settings, dynamic entries)
+    in a JSON-friendly form, so the UI can be shown from it on reconnect before the keyboard is read.
+    """
+
+    VERSION = 1
+
+    # if any of these differ from the keyboard, the keycode tables are wrong and a full reload is needed
+    STRUCTURE = ["layers", "macro_count", "macro_memory", "tap_dance_count", "combo_count", "key_override_count"]
+
+    STATE = STRUCTURE + [
+        "layout", "encoder_layout", "layout_options", "macro",
+        "lighting_qmk_rgblight", "lighting_qmk_backlight", "lighting_vialrgb", "lighting_amk_rgblight",
+        "underglow_brightness", "underglow_effect", "underglow_effect_speed", "underglow_color",
+        "backlight_brightness", "backlight_effect",
+        "rgb_version", "rgb_maximum_brightness", "rgb_supported_effects", "rgb_mode", "rgb_speed", "rgb_hsv",
+        "settings", "supported_settings",
+        "tap_dance_entries", "combo_entries", "key_override_entries",
+    ]
+
+    # merged key by key, everything else is compared as a whole
+    DICTS = ["layout", "encoder_layout", "settings"]
+
+    @classmethod
+    def encode(cls, value):
+        if isinstance(value, tuple):
+            return {"tuple": [cls.encode(v) for v in value]}
+        if isinstance(value, (set, frozenset)):
+            return {"set": sorted(cls.encode(v) for v in value)}
+        if isinstance(value, bytes):
+            return {"bytes": value.hex()}
+        if isinstance(value, KeyOverrideEntry):
+            return {"key_override": value.save()}
+        if isinstance(value, Mapping):
+            return {"dict": [[cls.encode(k), cls.encode(v)] for k, v in value.items()]}
+        if isinstance(value, list):
+            return [cls.encode(v) for v in value]
+        return value
+
+    @classmethod
+    def decode(cls, value):
+        if isinstance(value, list):
+            return [cls.decode(v) for v in value]
+        if not isinstance(value, dict):
+            return value
+        if "tuple" in value:
+            return tuple(cls.decode(v) for v in value["tuple"])
+        if "set" in value:
+            return set(cls.decode(v) for v in value["set"])
+        if "bytes" in value:
+            return bytes.fromhex(value["bytes"])
+        if "key_override" in value:
+            entry = KeyOverrideEntry()
+            entry.restore(value["key_override"])
+            return entry
+        return {cls.decode(k): cls.decode(v) for k, v in value["dict"]}
+
+    @classmethod
+    def capture(cls, keyboard):
+        state = dict()
+        for field in cls.STATE:
+            state[field] = cls.encode(getattr(keyboard, field))
+        return state
+
+    @classmethod
+    def apply(cls, keyboard, state):
+        for field in cls.STATE:
+            setattr(keyboard, field, cls.decode(state[field]))
+
+    @classmethod
+    def same_structure(cls, a, b):
+        return all(getattr(a, field) == getattr(b, field) for field in cls.STRUCTURE)
+
+    @classmethod
+    def merge(cls, keyboard, base, device):
+        """
+        Three-way merge of the state read from the device into the keyboard, where `base` is the
+        snapshot the keyboard was started from. Values changed by the user since then are kept.
+        Returns the names of fields which were updated.
+        """
+        changed = []
+        for field in cls.STATE:
+            if base[field] == device[field]:
+                continue
+            if field in cls.DICTS:
+                live = getattr(keyboard, field)
+                old = dict(cls.decode(base[field]))
+                for key, value in cls.decode(device[field]).items():
+                    if old.get(key) != value and live.get(key) == old.get(key):
+                        live[key] = value
+                        if field not in changed:
+                            changed.append(field)
+            elif cls.encode(getattr(keyboard, field)) == base[field]:
+                setattr(keyboard, field, cls.decode(device[field]))
+                changed.append(field)
+        return changed
+
+    @staticmethod
+    def definition_digest(definition):
+        return hashlib.sha256(json.dumps(definition, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class SnapshotStore:
+    """ Keeps the last KeyboardSnapshot of every keyboard in a directory, one file per keyboard UID """
+
+    instance = None
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    @classmethod
+    def default(cls):
+        if sys.platform == "emscripten":
+            return None
+        if cls.instance is None:
+            from PyQt5.QtCore import QStandardPaths
+
+            directory = QStandardPaths.writableLocation(QStandardPaths.AppLocalDataLocation)
+            cls.instance = cls(os.path.join(directory, "snapshots"))
+        return cls.instance
+
+    def path(self, keyboard_id):
+        return os.path.join(self.directory, "{:016X}.json".format(keyboard_id))
+
+    def load(self, keyboard_id, definition, via_protocol, vial_protocol):
+        """ Returns the saved state if it was taken with the same definition and protocol, otherwise None """
+        try:
+            with open(self.path(keyboard_id), "r") as inf:
+                data = json.load(inf)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logging.warning("Discarding unreadable keyboard snapshot: %s", e)
+            self.remove(keyboard_id)
+            return None
+
+        if data.get("version") != KeyboardSnapshot.VERSION \
+                or data.get("definition") != KeyboardSnapshot.definition_digest(definition) \
+                or data.get("via_protocol") != via_protocol or data.get("vial_protocol") != vial_protocol:
+            return None
+        state = data.get("state")
+        if not isinstance(state, dict) or any(field not in state for field in KeyboardSnapshot.STATE):
+            return None
+        return state
+
+    def save(self, keyboard_id, definition, via_protocol, vial_protocol, state):
+        data = {
+            "version": KeyboardSnapshot.VERSION,
+            "definition": KeyboardSnapshot.definition_digest(definition),
+            "via_protocol": via_protocol,
+            "vial_protocol": vial_protocol,
+            "state": state,
+        }
+        try:
+            pathlib.Path(self.directory).mkdir(parents=True, exist_ok=True)
+            tmp = self.path(keyboard_id) + ".tmp"
+            with open(tmp, "w") as outf:
+                json.dump(data, outf, separators=(",", ":"))
+            os.replace(tmp, self.path(keyboard_id))
+        except OSError as e:
+            logging.warning("Failed to save keyboard snapshot: %s", e)
+
+    def remove(self, keyboard_id):
+        try:
+            os.remove(self.path(keyboard_id))
+        except OSError:
+            pass
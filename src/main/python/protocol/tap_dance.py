@@ -31,7 +31,7 @@ class ProtocolTapDance(BaseProtocol):
         entry = [Keycode.deserialize(entry[0]), Keycode.deserialize(entry[1]), Keycode.deserialize(entry[2]),
                  Keycode.deserialize(entry[3]), entry[4]]
         serialized = struct.pack("<HHHHH", *entry)
-        self.usb_send(self.dev, struct.pack("BBBB", CMD_VIA_VIAL_PREFIX, CMD_VIAL_DYNAMIC_ENTRY_OP,
+        self.usb_post(self.dev, struct.pack("BBBB", CMD_VIA_VIAL_PREFIX, CMD_VIAL_DYNAMIC_ENTRY_OP,
                                             DYNAMIC_VIAL_TAP_DANCE_SET, idx) + serialized, retries=20)
 
     def save_tap_dance(self):
@@ -0,0 +1,98 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+import random
+import time
+
+
+class RetryPolicy:
+    """
+    Decides how hid_send waits for responses and retries failed requests.
+
+    Retries back off exponentially with random jitter, the read timeout adapts to the round-trip
+    latency observed on this device (RFC 6298 style smoothed RTT), and every command is bounded
+    by a deadline so that a dead device fails fast instead of stalling for retries * timeout.
+
+    The timeout never goes below min_timeout even though reads take well under a millisecond:
+    writes which end up in EEPROM (keymap and macro buffers, QMK settings on AVR) can take up to
+    about 100ms, and resending them would only queue up more late responses.
+
+    A policy keeps latency statistics, so each Keyboard should have its own instance.
+    """
+
+    def __init__(self, base_delay=0.005, max_delay=0.25, multiplier=2.0, jitter=0.5,
+                 initial_timeout=0.5, min_timeout=0.25, max_timeout=2.0, deadline=3.0,
+                 adaptive=True, drain_stale=True):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.initial_timeout = initial_timeout
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.deadline = deadline
+        self.adaptive = adaptive
+        self.drain_stale = drain_stale
+
+        self.srtt = None
+        self.rttvar = 0.0
+        self.timeout_backoff = 1
+        # set when a request timed out, the late response may still arrive and must not be
+        # mistaken for the response to the next request
+        self.stale = False
+
+    @classmethod
+    def legacy(cls):
+        """ Behaviour of the original hid_send: fixed 500ms timeout, fixed 0.5s sleep between retries """
+        return cls(base_delay=0.5, max_delay=0.5, multiplier=1.0, jitter=0, initial_timeout=0.5,
+                   min_timeout=0.5, max_timeout=0.5, deadline=None, adaptive=False, drain_stale=False)
+
+    def start(self):
+        """ Returns the absolute deadline (in time.monotonic() terms) for a new command, or None """
+        if self.deadline is None:
+            return None
+        return time.monotonic() + self.deadline
+
+    def expired(self, deadline, delay=0):
+        return deadline is not None and time.monotonic() + delay >= deadline
+
+    def backoff(self, attempt):
+        """ Delay in seconds before retry number `attempt` (1 for the first retry) """
+        delay = min(self.max_delay, self.base_delay * self.multiplier ** (attempt - 1))
+        if self.jitter:
+            delay *= 1 - self.jitter * random.random()
+        return delay
+
+    def timeout(self):
+        """ Read timeout in seconds for the next attempt """
+        if not self.adaptive or self.srtt is None:
+            timeout = self.initial_timeout
+        else:
+            timeout = self.srtt + 4 * self.rttvar
+        timeout *= self.timeout_backoff
+        return max(self.min_timeout, min(self.max_timeout, timeout))
+
+    def timeout_ms(self, deadline=None):
+        timeout = self.timeout()
+        if deadline is not None:
+            timeout = min(timeout, deadline - time.monotonic())
+        return max(1, int(timeout * 1000))
+
+    def drain_timeout_ms(self):
+        """ How long to wait for a late response when draining stale input """
+        if self.srtt is None:
+            return int(self.min_timeout * 1000)
+        return max(2, min(int(self.min_timeout * 1000), int(self.srtt * 2000)))
+
+    def observe(self, rtt):
+        """ Feeds a successful round-trip time (in seconds) into the timeout estimate """
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.timeout_backoff = 1
+
+    def on_timeout(self):
+        if self.adaptive:
+            self.timeout_backoff = min(self.timeout_backoff * 2, 64)
+        self.stale = True
@@ -0,0 +1,103 @@
+import unittest
+
+from amk.protocol import AMK_BATCH_CHUNK
+from protocol.device_worker import DeviceWorker
+from protocol.emulator import KeyboardEmulator
+from test.util import initialize_settings, keyboard
+
+
+class TestAmkBatch(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        initialize_settings()
+
+    @staticmethod
+    def keyboard(emu):
+        kb = keyboard(emu)
+        kb.ensure_all_amk_keys()
+        kb.batches = []
+        send_many = kb.usb_send_many
+
+        def record(dev, msgs, retries=1):
+            kb.batches.append(len(msgs))
+            return send_many(dev, msgs, retries)
+        kb.usb_send_many = record
+        return kb
+
+    @staticmethod
+    def all_keys(kb, val):
+        return [(row, col, val) for row in range(kb.rows) for col in range(kb.cols)]
+
+    def test_apc(self):
+        emu = KeyboardEmulator(keyboard_type="ms_v2", rows=4, cols=16)
+        kb = self.keyboard(emu)
+        kb.amk_profile = 1
+        kb.apply_apc(0, 0, 500)
+
+        progress = []
+        future = kb.apply_apc_batch(self.all_keys(kb, 500), progress=lambda done, total: progress.append(done))
+        # the key which already had the value is skipped, the rest goes out a chunk at a time
+        self.assertEqual(future.result(), 63)
+        self.assertEqual(kb.batches, [AMK_BATCH_CHUNK, 63 - AMK_BATCH_CHUNK])
+        self.assertEqual(progress, [AMK_BATCH_CHUNK, 63])
+
+        kb = self.keyboard(emu)
+        self.assertEqual(set(kb.amk_apc[1].values()), {500})
+        self.assertEqual(set(kb.amk_apc[0].values()), {1500})
+
+        kb.amk_profile = 1
+        kb.apply_apc_batch(self.all_keys(kb, 500))
+        self.assertEqual(kb.batches, [])
+
+    def test_rt(self):
+        emu = KeyboardEmulator(keyboard_type="ms_v2", rows=2, cols=4)
+        kb = self.keyboard(emu)
+        val = {"cont": 1, "down": 20, "up": 30}
+        self.assertEqual(kb.apply_rt_batch(self.all_keys(kb, val)).result(), 8)
+        self.assertEqual(kb.batches, [8])
+        self.assertEqual(kb.amk_rt[0][(1, 3)], val)
+        # the cache doesn't share the caller's dict
+        val["up"] = 40
+        self.assertEqual(kb.amk_rt[0][(1, 2)]["up"], 30)
+
+        # the keyboard ends up like after writing the keys one at a time
+        other = KeyboardEmulator(keyboard_type="ms_v2", rows=2, cols=4)
+        kb = self.keyboard(other)
+        for row, col, val in self.all_keys(kb, {"cont": 1, "down": 20, "up": 30}):
+            kb.apply_rt(row, col, val)
+        self.assertEqual(self.keyboard(emu).amk_rt, self.keyboard(other).amk_rt)
+
+    def test_cancel(self):
+        emu = KeyboardEmulator(keyboard_type="ms_v2", rows=4, cols=16)
+        kb = self.keyboard(emu)
+        progress = []
+        future = kb.apply_apc_batch(self.all_keys(kb, 700), progress=lambda done, total: progress.append(done),
+                                    cancelled=lambda: len(progress) == 1)
+        self.assertEqual(future.result(), AMK_BATCH_CHUNK)
+        # what was written is cached, what wasn't still has its old value
+        self.assertEqual(list(kb.amk_apc[0].values()).count(700), AMK_BATCH_CHUNK)
+        self.assertEqual(self.keyboard(emu).amk_apc[0], kb.amk_apc[0])
+
+        # running it again picks up the rest
+        self.assertEqual(kb.apply_apc_batch(self.all_keys(kb, 700)).result(), 64 - AMK_BATCH_CHUNK)
+
+    def test_queued_batches(self):
+        """ A batch queued behind another one is compared against what that one wrote, not the cache at queue time """
+        emu = KeyboardEmulator(keyboard_type="ms_v2", rows=2, cols=4)
+        worker = DeviceWorker("test")
+        try:
+            kb = keyboard(emu, worker=worker)
+            kb.ensure_all_amk_keys()
+            orig = kb.amk_apc[0][(0, 0)]
+            away = kb.apply_apc_batch(self.all_keys(kb, orig + 100))
+            back = kb.apply_apc_batch(self.all_keys(kb, orig))
+            self.assertEqual((away.result(), back.result()), (8, 8))
+            self.assertEqual(set(kb.amk_apc[0].values()), {orig})
+        finally:
+            worker.stop()
+        self.assertEqual(set(self.keyboard(emu).amk_apc[0].values()), {orig})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,46 @@
+import unittest
+
+from amk.protocol import ProtocolAmk, AMK_PROTOCOL_GET_APC, AMK_PROTOCOL_GET_RT, AMK_PROTOCOL_GET_DKS
+from protocol.device_worker import InlineWorker
+from util import MSG_LEN
+
+
+class FakeAmkKeyboard(ProtocolAmk):
+
+    def __init__(self):
+        self.rowcol = {(0, 0): True, (0, 1): True}
+        self.worker = InlineWorker()
+        self.reload_graph = None
+        self.amk_profile = 1
+        self.amk_profile_count = 4
+        self.amk_apcrt_version = 2
+        self.amk_apcrt_scale = 10
+        self.amk_apc = [dict(), dict(), dict(), dict()]
+        self.amk_rt = [dict(), dict(), dict(), dict()]
+        self.amk_apcrt_loaded = set()
+        self.amk_dks = dict()
+        self.amk_dks_loaded = False
+        self.amk_prefetch_started = False
+        self.batches = []
+
+    def usb_send_many(self, dev, msgs, retries=1):
+        self.batches.append((msgs[0][1], msgs[0][4] if msgs[0][1] != AMK_PROTOCOL_GET_DKS else None))
+        return [msg + b"\x00" * (MSG_LEN - len(msg)) for msg in msgs]
+
+
+class TestAmkLazyKeys(unittest.TestCase):
+
+    def test_active_profile_first(self):
+        kb = FakeAmkKeyboard()
+        self.assertFalse(kb.amk_keys_loaded())
+        kb.ensure_amk_keys()
+        self.assertTrue(all(kb.amk_keys_loaded(p) for p in range(4)))
+        # the profile being edited and DKS are read before prefetching the rest
+        self.assertEqual(kb.batches[:3], [(AMK_PROTOCOL_GET_APC, 1), (AMK_PROTOCOL_GET_RT, 1),
+                                          (AMK_PROTOCOL_GET_DKS, None)])
+        self.assertEqual(len(kb.batches), 9)
+
+        # nothing is read twice
+        kb.ensure_amk_keys(2)
+        kb.ensure_all_amk_keys()
+        self.assertEqual(len(kb.batches), 9)
@@ -0,0 +1,61 @@
+import unittest
+
+from any_keycode import AnyKeycode, KeycodeParser, ParseError, decode
+from keycodes.keycodes import Keycode, recreate_keyboard_keycodes
+
+
+class FakeKeyboard:
+
+    layers = 4
+    macro_count = 16
+    custom_keycodes = None
+    tap_dance_count = 8
+    midi = None
+    vial_protocol = 6
+
+
+class TestAnyKeycode(unittest.TestCase):
+
+    EXPRESSIONS = [
+        "KC_A", "0x7E05", "42", "LCTL(KC_A)", "LCTL_T(KC_A)", "LT(3, KC_SPC)", "LT3(KC_ENTER)",
+        "MT(MOD_LCTL | MOD_LSFT, KC_B)", "HYPR(KC_F1)", "TD(2)", "TO(1)", "OSM(MOD_MEH)", "LM(2, MOD_LALT)", "C(S(KC_Z))",
+        "LSFT(KC_1) | 0x100", "(KC_A + 1) & 0xFF", "KC_A ^ KC_B", "1 << 8 | KC_C", "0x2000 >> 1", "  KC_TAB  ",
+        "LCTL(KC_A) - 1 - 2", "1 | 6 & 3 << 1 + 1 ^ 5", "0x10 >> 1 >> 1",
+    ]
+
+    @classmethod
+    def setUpClass(cls):
+        recreate_keyboard_keycodes(FakeKeyboard())
+
+    def test_same_as_simpleeval(self):
+        anykc = AnyKeycode.get()
+        for s in self.EXPRESSIONS:
+            self.assertEqual(KeycodeParser(anykc.names).parse(s), anykc.decode_simpleeval(s), s)
+
+    def test_fallback(self):
+        anykc = AnyKeycode.get()
+        # not handled by the parser, but simpleeval knows what to do with them
+        for s in ["-1 + 2", "2 * 3", "~0 & 0xFF", "0b101", "1_000"]:
+            with self.assertRaises(ParseError):
+                KeycodeParser(anykc.names).parse(s)
+            self.assertEqual(anykc.decode(s), anykc.decode_simpleeval(s))
+        # and errors are simpleeval's
+        for s in ["KC_NOPE", "NOPE(KC_A)", "LT(1)", "LCTL(KC_A", "012", "KC_A KC_B"]:
+            with self.assertRaises(Exception):
+                anykc.decode(s)
+            self.assertEqual(Keycode.deserialize(s), 0)
+
+    def test_cache(self):
+        decode.cache_clear()
+        self.assertEqual(Keycode.deserialize("LT(2, KC_B)"), Keycode.deserialize("LT2(KC_B)"))
+        Keycode.deserialize("LT(2, KC_B)")
+        self.assertEqual(decode.cache_info().hits, 1)
+
+        # recreating the keycodes starts over
+        recreate_keyboard_keycodes(FakeKeyboard())
+        Keycode.deserialize("LT(2, KC_B)")
+        self.assertEqual(decode.cache_info().hits, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,104 @@
+import asyncio
+import struct
+import unittest
+
+from keycodes.keycodes import Keycode
+from hid_metrics import HidMetrics
+from protocol.async_keyboard import AsyncHidTransport, AsyncKeyboard
+from protocol.constants import CMD_VIA_SET_KEYCODE
+from protocol.emulator import KeyboardEmulator
+from protocol.keyboard_comm import Keyboard
+from test.test_hid_send import FakeHidDevice
+from test.util import initialize_settings
+from util import MSG_LEN
+
+
+class TestAsyncKeyboard(unittest.TestCase):
+
+    @staticmethod
+    def padded(msg):
+        return msg + b"\x00" * (MSG_LEN - len(msg))
+
+    @staticmethod
+    def run_loop(coro):
+        # asyncio.run() is 3.7+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            return loop.run_until_complete(coro)
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+
+    def test_concurrent_writes(self):
+        """ Write-only setters on several keyboards run concurrently on a single event loop """
+        devs = [FakeHidDevice(), FakeHidDevice()]
+
+        async def configure(dev):
+            kb = AsyncKeyboard(dev)
+            kb.keyboard.layout = {(0, 0, 0): "KC_NO", (0, 0, 1): "KC_NO"}
+            await kb.set_key(0, 0, 0, "KC_A")
+            await kb.set_key(0, 0, 1, "KC_B")
+            # unchanged key is not sent again
+            await kb.set_key(0, 0, 1, "KC_B")
+            return kb.keyboard.layout
+
+        async def main():
+            return await asyncio.gather(*[configure(dev) for dev in devs])
+
+        layouts = self.run_loop(main())
+        for dev, layout in zip(devs, layouts):
+            self.assertEqual(layout, {(0, 0, 0): "KC_A", (0, 0, 1): "KC_B"})
+            self.assertEqual(dev.written, [
+                self.padded(struct.pack(">BBBBH", CMD_VIA_SET_KEYCODE, 0, 0, 0, Keycode.deserialize("KC_A"))),
+                self.padded(struct.pack(">BBBBH", CMD_VIA_SET_KEYCODE, 0, 0, 1, Keycode.deserialize("KC_B"))),
+            ])
+
+    def test_call(self):
+        """ Calls which need a response run the protocol code off the loop """
+        dev = FakeHidDevice()
+
+        async def main():
+            kb = AsyncKeyboard(dev)
+            with self.assertRaises(RuntimeError):
+                await kb.write("get_uid")
+            return await kb.call("get_uid")
+
+        self.assertEqual(self.run_loop(main()), b"\x00" * 8)
+
+    def test_skip_stale(self):
+        """ The transport skips late responses to earlier requests like hid_send does """
+        dev = FakeHidDevice()
+        dev.pending.append(self.padded(b"\x13\x00\x1C\x1C"))
+        msg = b"\x13\x00\x38\x1C"
+        try:
+            self.assertEqual(self.run_loop(AsyncHidTransport(dev).send(msg)), self.padded(msg))
+        finally:
+            HidMetrics.get().reset()
+
+    def test_loops(self):
+        """ A keyboard created outside of any loop can be used from one loop after another """
+        kb = AsyncKeyboard(FakeHidDevice())
+        kb.keyboard.layout = {(0, 0, 0): "KC_NO"}
+        self.run_loop(kb.set_key(0, 0, 0, "KC_A"))
+        self.run_loop(kb.set_key(0, 0, 0, "KC_B"))
+        self.assertEqual(kb.keyboard.layout[(0, 0, 0)], "KC_B")
+
+    def test_qmk_settings(self):
+        """ The status check of qmk_settings_set also works when the write is sent by the loop """
+        initialize_settings()
+        emu = KeyboardEmulator()
+
+        async def main():
+            kb = AsyncKeyboard(emu)
+            await kb.reload()
+            applied = await kb.qmk_settings_set(2, 1)
+            emu.qmk_settings_supported.remove(2)
+            rejected = await kb.qmk_settings_set(2, 0)
+            return applied.result(), rejected.result(), kb.keyboard.settings[2]
+
+        self.assertEqual(self.run_loop(main()), (0, 1, 1))
+
+    def test_write_methods(self):
+        for name in AsyncKeyboard.WRITE_METHODS:
+            self.assertTrue(callable(getattr(Keyboard, name, None)), name)
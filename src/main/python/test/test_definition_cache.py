@@ -0,0 +1,54 @@
+import os
+import tempfile
+import time
+import unittest
+
+from definition_cache import DefinitionCache
+
+
+class TestDefinitionCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache = DefinitionCache(os.path.join(self.tmp.name, "definitions"), max_bytes=300)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_roundtrip(self):
+        self.assertIsNone(self.cache.get(0x1234, 3, 9, 6))
+        self.cache.put(0x1234, 3, 9, 6, b"abc")
+        self.assertEqual(self.cache.get(0x1234, 3, 9, 6), b"abc")
+        # different size or protocol version is a different entry
+        self.assertIsNone(self.cache.get(0x1234, 4, 9, 6))
+        self.assertIsNone(self.cache.get(0x1234, 3, 9, 5))
+
+    def test_corrupted(self):
+        self.cache.put(0x1234, 3, 9, 6, b"abc")
+        path = self.cache.path(0x1234, 3, 9, 6)
+        with open(path, "r+b") as f:
+            f.seek(-1, os.SEEK_END)
+            f.write(b"x")
+        self.assertIsNone(self.cache.get(0x1234, 3, 9, 6))
+        self.assertFalse(os.path.exists(path))
+
+    def test_lru(self):
+        now = time.time()
+        self.cache.put(0, 100, 9, 6, bytes(100))
+        self.cache.put(1, 100, 9, 6, bytes(100))
+        # entry 0 was used more recently than entry 1
+        os.utime(self.cache.path(0, 100, 9, 6), (now - 10, now - 10))
+        os.utime(self.cache.path(1, 100, 9, 6), (now - 20, now - 20))
+        self.cache.put(2, 100, 9, 6, bytes(100))
+        self.assertIsNotNone(self.cache.get(0, 100, 9, 6))
+        self.assertIsNone(self.cache.get(1, 100, 9, 6))
+        self.assertIsNotNone(self.cache.get(2, 100, 9, 6))
+
+    def test_invalidate(self):
+        self.cache.put(1, 3, 9, 6, b"abc")
+        self.cache.put(2, 3, 9, 6, b"abc")
+        self.cache.invalidate(1)
+        self.assertIsNone(self.cache.get(1, 3, 9, 6))
+        self.assertIsNotNone(self.cache.get(2, 3, 9, 6))
+        self.cache.invalidate()
+        self.assertIsNone(self.cache.get(2, 3, 9, 6))
@@ -0,0 +1,97 @@
+import threading
+import unittest
+from functools import partial
+
+from protocol.device_worker import DeviceWorker, InlineWorker
+from protocol.emulator import KeyboardEmulator
+from test.util import initialize_settings, keyboard
+
+
+class TestDeviceWorker(unittest.TestCase):
+
+    def setUp(self):
+        self.worker = DeviceWorker("test")
+
+    def tearDown(self):
+        self.worker.stop()
+
+    def test_order(self):
+        """ Posted writes and blocking reads execute in submission order on the worker thread """
+        done = []
+        threads = set()
+
+        def request(x):
+            done.append(x)
+            threads.add(threading.current_thread())
+            return x
+
+        futures = [self.worker.post(request, x) for x in range(10)]
+        self.assertEqual(self.worker.call(request, 10), 10)
+        self.assertEqual(done, list(range(11)))
+        self.assertEqual([f.result() for f in futures], list(range(10)))
+        self.assertEqual(threads, {self.worker.thread})
+        self.assertEqual(self.worker.stats()["gui_posted_calls"], 10)
+        self.assertEqual(self.worker.stats()["gui_blocking_calls"], 1)
+
+    def test_errors(self):
+        def fail():
+            raise RuntimeError("failed")
+
+        future = self.worker.post(fail)
+        with self.assertRaises(RuntimeError):
+            future.result()
+        with self.assertRaises(RuntimeError):
+            self.worker.call(fail)
+
+    def test_stopped(self):
+        self.worker.stop()
+        with self.assertRaises(RuntimeError):
+            self.worker.call(lambda: None)
+
+    def test_inline(self):
+        worker = InlineWorker()
+        self.assertEqual(worker.post(lambda: 1).result(), 1)
+        with self.assertRaises(ZeroDivisionError):
+            worker.post(lambda: 1 / 0)
+
+
+class TestWriteFailures(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        initialize_settings()
+
+    def setUp(self):
+        self.emu = KeyboardEmulator()
+        self.worker = DeviceWorker("test")
+        self.keyboard = keyboard(self.emu, worker=self.worker)
+        self.failures = []
+        self.keyboard.write_failed = self.failures.append
+
+    def tearDown(self):
+        self.worker.stop()
+
+    def test_qmk_settings(self):
+        self.assertEqual(self.keyboard.qmk_settings_set(2, 1).result(), 0)
+        self.assertEqual(self.keyboard.settings[2], 1)
+
+        # the firmware turns it down
+        self.emu.qmk_settings_supported.remove(2)
+        self.assertEqual(self.keyboard.qmk_settings_set(2, 0).result(), 1)
+        self.assertEqual(self.keyboard.settings[2], 1)
+        self.assertEqual(len(self.failures), 1)
+
+    def test_failed_write(self):
+        def fail(dev, msg, retries=1):
+            raise RuntimeError("failed to communicate with the device")
+        self.keyboard.usb_send = partial(self.worker.call, fail)
+        self.keyboard.usb_post = partial(self.keyboard.post_write, fail)
+
+        with self.assertRaises(RuntimeError):
+            self.keyboard.qmk_settings_set(2, 1).result()
+        self.assertNotEqual(self.keyboard.settings.get(2), 1)
+
+        future = self.keyboard.usb_post(self.emu, b"\x03\x02")
+        with self.assertRaises(RuntimeError):
+            future.result()
+        self.assertEqual(len(self.failures), 2)
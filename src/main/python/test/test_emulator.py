@@ -0,0 +1,145 @@
+import struct
+import time
+import unittest
+
+from amk.protocol import AMK_PROTOCOL_PREFIX, AMK_PROTOCOL_WRITE_FILE
+from protocol.emulator import KeyboardEmulator
+from protocol.keyboard_comm import Keyboard
+from test.util import initialize_settings, keyboard
+from util import hid_send_many
+
+
+class TestKeyboardEmulator(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        initialize_settings()
+
+    @staticmethod
+    def keyboard(emu, pipelined=False):
+        if not pipelined:
+            return keyboard(emu)
+        kb = Keyboard(emu)
+        kb.reload()
+        return kb
+
+    def test_reload(self):
+        emu = KeyboardEmulator(rows=4, cols=10, layers=32, combo_count=255, macro_memory=4000)
+        kb = self.keyboard(emu)
+        self.assertEqual((kb.rows, kb.cols, kb.layers), (4, 10, 32))
+        self.assertEqual(len(kb.rowcol), 40)
+        self.assertEqual((kb.tap_dance_count, kb.combo_count, kb.key_override_count), (8, 255, 8))
+        self.assertEqual((kb.macro_count, kb.macro_memory), (16, 4000))
+        self.assertEqual(kb.supported_settings, set(KeyboardEmulator.DEFAULT_QMK_SETTINGS))
+        self.assertEqual(kb.layout[(31, 3, 9)], "KC_NO")
+
+    def test_state(self):
+        emu = KeyboardEmulator(rows=2, cols=3)
+        kb = self.keyboard(emu)
+        kb.set_key(1, 1, 2, "KC_A")
+        kb.set_macro(b"\x01\x01\x04\x00" + b"\x00" * 15)
+        kb.tap_dance_set(2, ("KC_B", "KC_C", "KC_NO", "KC_NO", 250))
+        kb.qmk_settings_set(2, 1)
+
+        # a second connection sees what the first one wrote, with pipelined reads as well
+        kb = self.keyboard(emu, pipelined=True)
+        self.assertEqual(kb.layout[(1, 1, 2)], "KC_A")
+        self.assertEqual(kb.layout[(0, 1, 2)], "KC_NO")
+        self.assertEqual(kb.tap_dance_entries[2], ("KC_B", "KC_C", "KC_NO", "KC_NO", 250))
+        self.assertEqual(kb.settings[2], 1)
+        self.assertTrue(kb.macro.startswith(b"\x01\x01\x04\x00"))
+
+    def test_vialrgb(self):
+        definition = KeyboardEmulator.make_definition(2, 2)
+        definition["lighting"] = "vialrgb"
+        emu = KeyboardEmulator(definition)
+        kb = self.keyboard(emu)
+        self.assertEqual(kb.rgb_version, 1)
+        self.assertEqual(kb.rgb_supported_effects, {0, 1, 2, 3})
+        kb.set_vialrgb_mode(2)
+        kb.set_vialrgb_color(10, 20, 30)
+        kb = self.keyboard(emu)
+        self.assertEqual((kb.rgb_mode, kb.rgb_hsv), (2, (10, 20, 30)))
+
+    def test_unlock(self):
+        emu = KeyboardEmulator(locked=True, unlock_keys=[(0, 1)])
+        kb = self.keyboard(emu)
+        self.assertEqual(kb.get_unlock_status(), 0)
+        self.assertEqual(kb.get_unlock_keys(), [(0, 1)])
+        kb.unlock_start()
+        while kb.unlock_poll()[0] == 0:
+            pass
+        self.assertEqual(kb.get_unlock_status(), 1)
+
+    def test_matrix(self):
+        emu = KeyboardEmulator(rows=2, cols=10)
+        kb = self.keyboard(emu)
+        emu.press(1, 9)
+        # two bytes per row, the byte with the highest columns first
+        self.assertEqual(kb.matrix_poll()[2:6], b"\x00\x00\x02\x00")
+
+    def test_amk(self):
+        emu = KeyboardEmulator(keyboard_type="ms_v2", rgb_matrix_leds=20, snaptap_count=2, rgb_strips=[(0, 0, 4)])
+        kb = self.keyboard(emu)
+        self.assertEqual(kb.amk_profile_count, 4)
+        self.assertEqual(len(kb.amk_rgb_matrix["leds"]), 20)
+        self.assertEqual(kb.amk_rgb_strips[0].get_count(), 4)
+        self.assertEqual(kb.amk_snaptap_count, 2)
+
+        kb.ensure_all_amk_keys()
+        kb.amk_profile = 2
+        kb.apply_apc(1, 3, 500)
+        kb.apply_rt(1, 3, {"cont": 10, "down": 20, "up": 30})
+        kb.apply_rt_sensitivity(42)
+        kb.apply_snaptap(1, {"first_row": 0, "first_col": 1, "second_row": 0, "second_col": 2, "mode": 1})
+
+        kb = self.keyboard(emu)
+        kb.ensure_all_amk_keys()
+        self.assertEqual(kb.amk_apc[2][(1, 3)], 500)
+        self.assertEqual(kb.amk_apc[0][(1, 3)], 1500)
+        self.assertEqual(kb.amk_rt[2][(1, 3)], {"cont": 10, "down": 20, "up": 3})
+        self.assertEqual(kb.amk_rt_sens, 42)
+        self.assertEqual(kb.amk_snaptap_keys[1].get_second_col(), 2)
+
+    def test_files(self):
+        emu = KeyboardEmulator(keyboard_type="ms", file_system_size=1000)
+        kb = self.keyboard(emu)
+        index = kb.open_anim_file("a.anim", False)
+        self.assertTrue(kb.write_anim_file(index, b"\x01" * 24, 0))
+        self.assertTrue(kb.close_anim_file(index))
+
+        # a batch of writes in one transfer over the vendor endpoint, without responses
+        fast = emu.fast_device()
+        index = kb.fastopen_anim_file(fast, "b.anim", False)
+        batch = b"".join(struct.pack("<BBBBI", AMK_PROTOCOL_PREFIX, AMK_PROTOCOL_WRITE_FILE, index, size, offset)
+                         + bytes([offset // 56 + 1]) * size for offset, size in [(0, 56), (56, 56), (112, 10)])
+        kb.fastwrite_anim_file_vendor(fast, batch)
+        self.assertTrue(kb.fastclose_anim_file(fast, index))
+
+        kb.reload_anim_file_list()
+        self.assertEqual(kb.animations["file"], [{"name": "a.anim", "size": 24}, {"name": "b.anim", "size": 122}])
+        self.assertEqual(kb.animations["disk"]["free_space"], 1000 - 24 - 122)
+        index = kb.open_anim_file("", True, 1)
+        self.assertEqual(kb.read_anim_file(index, 50, 20), b"\x01" * 6 + b"\x02" * 14)
+        kb.close_anim_file(index)
+
+        # out of space
+        index = kb.open_anim_file("c.anim", False)
+        self.assertFalse(kb.write_anim_file(index, b"\x00" * 24, 900))
+        self.assertTrue(kb.delete_anim_file(index))
+
+    def test_encoder(self):
+        emu = KeyboardEmulator()
+        emu.usb_send(None, struct.pack(">BBBBBH", 0xFE, 0x04, 3, 1, 1, 0x80))
+        self.assertEqual(emu.usb_send(None, b"\xFE\x03\x03\x01")[0:4], b"\x00\x00\x00\x80")
+
+    def test_latency(self):
+        emu = KeyboardEmulator(latency=0.05)
+        started = time.monotonic()
+        self.assertEqual(hid_send_many(emu, [b"\x11"] * 8, window=8), [b"\x11\x04" + b"\x00" * 30] * 8)
+        # pipelined requests wait for the latency once, not once per request
+        self.assertLess(time.monotonic() - started, 0.3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+import json
+import os
+import tempfile
+import unittest
+
+from hid_metrics import HidMetrics, CommandMetrics
+from retry_policy import RetryPolicy
+from test.test_hid_send import FakeHidDevice
+from util import MSG_LEN, hid_send, hid_send_many
+
+
+class TestHidMetrics(unittest.TestCase):
+
+    def setUp(self):
+        HidMetrics.instance = None
+
+    def tearDown(self):
+        HidMetrics.instance = None
+
+    def command(self, name):
+        for c in HidMetrics.get().to_json()["commands"]:
+            if c["command"].endswith(name):
+                return c
+        return None
+
+    def test_keys(self):
+        self.assertEqual(HidMetrics.key(b"\x05\x00\x01"), (0x05, None))
+        self.assertEqual(HidMetrics.key(b"\xFE\x0D\x01"), (0xFE, 0x0D))
+        self.assertEqual(HidMetrics.key(b"\xFD\x26\x01"), (0xFD, 0x26))
+        metrics = HidMetrics.get()
+        self.assertEqual(metrics.command_name((0x12, None)), "12 KEYMAP_GET_BUFFER")
+        self.assertEqual(metrics.command_name((0xFE, 0x0B)), "FE 0B VIAL_QMK_SETTINGS_SET")
+        self.assertEqual(metrics.command_name((0xFD, 0x26)), "FD 26 AMK_WRITE_FILE")
+        self.assertEqual(metrics.command_name((0xFD, 0xF0)), "FD F0")
+
+    def test_hid_send(self):
+        policy = RetryPolicy(base_delay=0, jitter=0)
+        hid_send(FakeHidDevice(drop=0), b"\xFE\x0B\x01", retries=5, policy=policy)
+        hid_send(FakeHidDevice(), b"\xFE\x0B\x02", policy=policy)
+        with self.assertRaises(RuntimeError):
+            hid_send(FakeHidDevice(silent=True), b"\x11", retries=2, policy=policy)
+
+        c = self.command("VIAL_QMK_SETTINGS_SET")
+        self.assertEqual((c["count"], c["retries"], c["timeouts"], c["failures"]), (2, 1, 1, 0))
+        self.assertEqual((c["bytes_out"], c["bytes_in"]), (3 * MSG_LEN, 2 * MSG_LEN))
+        self.assertEqual(sum(c["latency_ms"]["histogram"]), 2)
+
+        c = self.command("GET_LAYER_COUNT")
+        self.assertEqual((c["count"], c["retries"], c["timeouts"], c["failures"]), (1, 1, 2, 1))
+        self.assertIsNone(c["latency_ms"]["mean"])
+
+    def test_hid_send_many(self):
+        hid_send_many(FakeHidDevice(), [bytes([0x12, x]) for x in range(10)], window=4)
+        c = self.command("KEYMAP_GET_BUFFER")
+        self.assertEqual((c["count"], c["bytes_out"], c["bytes_in"]), (10, 10 * MSG_LEN, 10 * MSG_LEN))
+
+    def test_disabled(self):
+        HidMetrics.get().enabled = False
+        hid_send(FakeHidDevice(), b"\x11")
+        self.assertEqual(HidMetrics.get().to_json(), {"commands": []})
+
+    def test_percentile(self):
+        metrics = CommandMetrics()
+        for latency in [0.1, 0.3, 0.3, 3, 5000]:
+            metrics.observe(latency)
+        self.assertEqual(metrics.percentile(50), 0.5)
+        self.assertEqual(metrics.percentile(80), 4)
+        self.assertEqual(metrics.percentile(100), 5000)
+
+    def test_dump(self):
+        hid_send(FakeHidDevice(), b"\x11")
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "metrics.json")
+            HidMetrics.get().dump(path)
+            with open(path) as inf:
+                data = json.load(inf)
+        self.assertEqual(data["commands"][0]["command"], "11 GET_LAYER_COUNT")
+        self.assertEqual(data["commands"][0]["count"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+import os
+import tempfile
+import time
+import unittest
+
+from hid_replay import HidRecorder, ReplayDevice, ReplayError
+from protocol.keyboard_comm import Keyboard
+from retry_policy import RetryPolicy
+from test.test_hid_send import FakeHidDevice
+from util import MSG_LEN, hid_send, hid_send_many
+
+
+def padded(msg):
+    return msg + b"\x00" * (MSG_LEN - len(msg))
+
+
+class TestHidReplay(unittest.TestCase):
+
+    def record(self):
+        recorder = HidRecorder(FakeHidDevice())
+        hid_send(recorder, b"\x01")
+        hid_send_many(recorder, [bytes([0x12, x]) for x in range(6)], window=3)
+        hid_send(recorder, b"\x05\x00\x01", retries=3)
+        return recorder
+
+    def test_record(self):
+        exchanges = self.record().to_json()["exchanges"]
+        self.assertEqual([e["req"] for e in exchanges], [e["resp"] for e in exchanges])
+        self.assertEqual([bytes.fromhex(e["req"]) for e in exchanges],
+                         [padded(b"\x01")] + [padded(bytes([0x12, x])) for x in range(6)] + [padded(b"\x05\x00\x01")])
+        times = [e["t"] for e in exchanges]
+        self.assertEqual(times, sorted(times))
+
+    def test_record_stale(self):
+        """ Responses go to the request they answer when a response is lost or arrives late """
+        dev = FakeHidDevice()
+        recorder = HidRecorder(dev)
+        # a keymap read whose response never comes, then one whose response comes after a resend
+        recorder.write(b"\x00" + padded(b"\x12\x00\x00\x1C"))
+        dev.pending.clear()
+        recorder.write(b"\x00" + padded(b"\x12\x00\x1C\x1C"))
+        hid_send(recorder, b"\x12\x00\x38\x1C", policy=RetryPolicy())
+        exchanges = recorder.to_json()["exchanges"]
+        self.assertEqual([e["req"] for e in exchanges], [e["resp"] for e in exchanges])
+        self.assertEqual([bytes.fromhex(e["req"]) for e in exchanges],
+                         [padded(b"\x12\x00\x1C\x1C"), padded(b"\x12\x00\x38\x1C")])
+
+    def test_replay(self):
+        recorder = self.record()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "session.json")
+            recorder.save(path)
+            dev = ReplayDevice.load(path, latency=0)
+
+        self.assertEqual(hid_send_many(dev, [bytes([0x12, x]) for x in range(6)], window=4),
+                         [padded(bytes([0x12, x])) for x in range(6)])
+        self.assertEqual(hid_send(dev, b"\x01"), padded(b"\x01"))
+        # recorded responses are repeated once they run out
+        self.assertEqual(hid_send(dev, b"\x01"), padded(b"\x01"))
+        self.assertEqual(dev.requests, 8)
+
+        with self.assertRaises(ReplayError):
+            hid_send(dev, b"\x07")
+
+    def test_echo_unknown(self):
+        dev = ReplayDevice([], latency=0, echo_unknown=True)
+        self.assertEqual(hid_send(dev, b"\x05\x01\x02"), padded(b"\x05\x01\x02"))
+
+    def test_latency(self):
+        dev = ReplayDevice(self.record().to_json()["exchanges"], latency=0.01)
+        started = time.monotonic()
+        for x in range(3):
+            hid_send(dev, b"\x01")
+        self.assertGreaterEqual(time.monotonic() - started, 0.03)
+
+        # a response slower than the read timeout is lost, like on a real device
+        slow = ReplayDevice(self.record().to_json()["exchanges"], latency=0.2)
+        slow.write(b"\x00" + padded(b"\x01"))
+        self.assertEqual(slow.read(MSG_LEN, timeout_ms=5), b"")
+
+    def test_keyboard(self):
+        recorder = HidRecorder(FakeHidDevice())
+        kb = Keyboard(recorder, retry_policy=RetryPolicy.legacy())
+        kb.reload_via_protocol()
+        kb.reload_layers()
+
+        replayed = Keyboard(ReplayDevice(recorder.to_json()["exchanges"], latency=0))
+        replayed.reload_via_protocol()
+        replayed.reload_layers()
+        self.assertEqual((replayed.via_protocol, replayed.layers), (kb.via_protocol, kb.layers))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,126 @@
+import time
+import unittest
+from collections import deque
+
+from hid_metrics import HidMetrics
+from retry_policy import RetryPolicy
+from util import MSG_LEN, hid_send, hid_send_many, response_matches
+
+
+class FakeHidDevice:
+    """ Echoes every request back; optionally drops the response to one of the requests """
+
+    def __init__(self, drop=None, silent=False):
+        self.pending = deque()
+        self.written = []
+        self.max_in_flight = 0
+        self.drop = drop
+        self.silent = silent
+
+    def write(self, data):
+        self.written.append(data[1:])
+        if len(self.written) - 1 != self.drop and not self.silent:
+            self.pending.append(data[1:])
+        self.max_in_flight = max(self.max_in_flight, len(self.pending))
+        return len(data)
+
+    def read(self, length, timeout_ms=0):
+        if self.pending:
+            return self.pending.popleft()[:length]
+        return b""
+
+
+class TestHidSendMany(unittest.TestCase):
+
+    @staticmethod
+    def requests(count):
+        return [bytes([0x12, x]) for x in range(count)]
+
+    @staticmethod
+    def padded(msg):
+        return msg + b"\x00" * (MSG_LEN - len(msg))
+
+    def test_in_order(self):
+        dev = FakeHidDevice()
+        msgs = self.requests(20)
+        out = hid_send_many(dev, msgs, window=4)
+        self.assertEqual(out, [self.padded(m) for m in msgs])
+        self.assertEqual(dev.max_in_flight, 4)
+
+    def test_lost_response(self):
+        """ A lost response falls back to redoing the batch one request at a time """
+        dev = FakeHidDevice(drop=5)
+        msgs = self.requests(10)
+        out = hid_send_many(dev, msgs, window=4)
+        self.assertEqual(out, [self.padded(m) for m in msgs])
+
+
+class TestStaleResponses(unittest.TestCase):
+
+    def tearDown(self):
+        # the latencies of these fake keymap writes would end up in restore estimates
+        HidMetrics.get().reset()
+
+    @staticmethod
+    def padded(msg):
+        return msg + b"\x00" * (MSG_LEN - len(msg))
+
+    def test_skip_stale(self):
+        """ A late response to an earlier request isn't taken for the response to the next one """
+        dev = FakeHidDevice()
+        # an earlier keymap write to another offset timed out, its response arrives now
+        dev.pending.append(self.padded(b"\x13\x00\x1C\x1C"))
+        msg = b"\x13\x00\x38\x1C"
+        self.assertEqual(hid_send(dev, msg, policy=RetryPolicy()), self.padded(msg))
+        self.assertEqual(len(dev.written), 1)
+
+        dev.pending.append(self.padded(b"\x04\x00\x01\x02\x00\x04"))
+        out = hid_send_many(dev, [b"\x12\x00\x00\x1C", b"\x12\x00\x1C\x1C"], window=4, policy=RetryPolicy())
+        self.assertEqual(out, [self.padded(b"\x12\x00\x00\x1C"), self.padded(b"\x12\x00\x1C\x1C")])
+
+    def test_matches(self):
+        msg = self.padded(b"\x05\x01\x02\x03\x00\x04")
+        self.assertTrue(response_matches(msg, msg))
+        self.assertFalse(response_matches(msg, self.padded(b"\x05\x01\x02\x03\x00\x05")))
+        # commands the firmware doesn't know
+        self.assertTrue(response_matches(msg, self.padded(b"\xFF")))
+        # Vial responses don't repeat the request
+        self.assertTrue(response_matches(self.padded(b"\xFE\x00"), self.padded(b"\x06")))
+        self.assertFalse(response_matches(self.padded(b"\xFD\x02"), self.padded(b"\xFD\x01")))
+
+
+class TestRetryPolicy(unittest.TestCase):
+
+    def test_legacy(self):
+        policy = RetryPolicy.legacy()
+        self.assertEqual(policy.timeout_ms(), 500)
+        self.assertEqual(policy.backoff(1), 0.5)
+        self.assertEqual(policy.backoff(10), 0.5)
+        policy.observe(0.001)
+        self.assertEqual(policy.timeout_ms(), 500)
+
+    def test_adaptive_timeout(self):
+        policy = RetryPolicy()
+        for x in range(20):
+            policy.observe(0.002)
+        # no lower than what a slow EEPROM write can take
+        self.assertEqual(policy.timeout_ms(), 250)
+        policy.on_timeout()
+        self.assertEqual(policy.timeout_ms(), 250)
+        policy.observe(0.5)
+        self.assertGreater(policy.timeout_ms(), 500)
+
+    def test_backoff(self):
+        policy = RetryPolicy(jitter=0)
+        self.assertEqual([policy.backoff(x) for x in range(1, 5)], [0.005, 0.01, 0.02, 0.04])
+        self.assertEqual(policy.backoff(20), policy.max_delay)
+
+    def test_deadline(self):
+        """ A dead device fails once the command deadline expires, regardless of the retry count """
+        dev = FakeHidDevice(silent=True)
+        policy = RetryPolicy(deadline=0.1)
+        started = time.monotonic()
+        with self.assertRaises(RuntimeError):
+            hid_send(dev, b"\x01", retries=20, policy=policy)
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertLess(len(dev.written), 20)
@@ -0,0 +1,91 @@
+import unittest
+
+from PyQt5.QtGui import QPalette
+from PyQt5.QtWidgets import QApplication
+
+from keycodes.keycodes import Keycode, recreate_keyboard_keycodes
+from keymaps import KEYMAPS
+from util import KeycodeDisplay
+
+
+class FakeKeyboard:
+
+    layers = 4
+    macro_count = 16
+    custom_keycodes = None
+    tap_dance_count = 8
+    midi = None
+    vial_protocol = 6
+
+
+class FakeWidget:
+
+    masked = False
+    text = mask_text = tooltip = color = mask_color = None
+
+    def setText(self, text):
+        self.text = text
+
+    def setMaskText(self, text):
+        self.mask_text = text
+
+    def setToolTip(self, tooltip):
+        self.tooltip = tooltip
+
+    def setColor(self, color):
+        self.color = color
+
+    def setMaskColor(self, color):
+        self.mask_color = color
+
+
+class TestKeycodeDisplay(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.app = QApplication.instance() or QApplication([])
+        recreate_keyboard_keycodes(FakeKeyboard())
+
+    def tearDown(self):
+        KeycodeDisplay.set_keymap_override(KEYMAPS[0][1])
+
+    def test_record(self):
+        for code in ["KC_A", "LCTL(KC_A)", "LT1(KC_SPACE)", "MO(2)", "KC_NO", "0x7E05"]:
+            record = KeycodeDisplay.record(code)
+            self.assertEqual(record.tooltip, Keycode.tooltip(code))
+            self.assertEqual(record.masked, Keycode.is_mask(code))
+            self.assertEqual(record.text, KeycodeDisplay.get_label(code).split("\n")[0] if record.masked
+                             else KeycodeDisplay.get_label(code))
+            self.assertIs(KeycodeDisplay.record(code), record)
+
+    def test_invalidate(self):
+        record = KeycodeDisplay.record("KC_Z")
+        self.assertFalse(record.overriden)
+
+        override = next(keymap for name, keymap in KEYMAPS if "KC_Z" in keymap)
+        KeycodeDisplay.set_keymap_override(override)
+        record = KeycodeDisplay.record("KC_Z")
+        self.assertTrue(record.overriden)
+        self.assertEqual(record.text, override["KC_Z"])
+        self.assertTrue(KeycodeDisplay.record("LSFT(KC_Z)").mask_overriden)
+
+        recreate_keyboard_keycodes(FakeKeyboard())
+        self.assertIsNot(KeycodeDisplay.record("KC_Z"), record)
+
+    def test_display_keycode(self):
+        widget = FakeWidget()
+        KeycodeDisplay.display_keycode(widget, "LCTL(KC_A)")
+        self.assertTrue(widget.masked)
+        self.assertEqual(widget.mask_text, "A")
+        self.assertEqual(widget.tooltip, Keycode.tooltip("LCTL(KC_A)"))
+        self.assertIsNone(widget.color)
+
+        override = next(keymap for name, keymap in KEYMAPS if "KC_A" in keymap)
+        KeycodeDisplay.set_keymap_override(override)
+        KeycodeDisplay.display_keycode(widget, "LCTL(KC_A)")
+        self.assertEqual(widget.mask_text, override["KC_A"])
+        self.assertEqual(widget.mask_color, QApplication.palette().color(QPalette.Link))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+import unittest
+
+from keycodes.keycodes import Keycode, KeycodeTables, RAWCODES_MAP, recreate_keyboard_keycodes
+from keycodes.keycodes_v5 import keycodes_v5
+from keycodes.keycodes_v6 import keycodes_v6
+
+
+class FakeKeyboard:
+
+    layers = 4
+    macro_count = 16
+    custom_keycodes = None
+    tap_dance_count = 8
+    midi = None
+
+    def __init__(self, vial_protocol):
+        self.vial_protocol = vial_protocol
+
+
+def reference_serialize(code):
+    """ Keycode.serialize as it was before the tables """
+    masked = keycodes_v6.masked if Keycode.protocol == 6 else keycodes_v5.masked
+    if (code & 0xFF00) not in masked:
+        kc = RAWCODES_MAP.get(code)
+        if kc is not None:
+            return kc.qmk_id
+    else:
+        outer = RAWCODES_MAP.get(code & 0xFF00)
+        inner = RAWCODES_MAP.get(code & 0x00FF)
+        if outer is not None and inner is not None:
+            return outer.qmk_id.replace("kc", inner.qmk_id)
+    return hex(code)
+
+
+class TestKeycodeTables(unittest.TestCase):
+
+    def tearDown(self):
+        recreate_keyboard_keycodes(FakeKeyboard(6))
+
+    def check_protocol(self, protocol):
+        recreate_keyboard_keycodes(FakeKeyboard(protocol))
+        for code in range(KeycodeTables.SIZE):
+            name = Keycode.serialize(code)
+            self.assertEqual(name, reference_serialize(code))
+            if name != hex(code):
+                self.assertEqual(Keycode.deserialize(name), code)
+
+        # the table agrees with the expression parser
+        for name in ["LCTL(KC_A)", "LT3(KC_SPACE)", "RSFT(KC_ENTER)", "TD(3)", "MO(2)", "M5", "KC_NO"]:
+            self.assertEqual(Keycode.deserialize(name), Keycode.parse(name), name)
+        # anything else still goes through it
+        self.assertEqual(Keycode.deserialize("LCTL(KC_A) | 0x0100"), Keycode.parse("LCTL(KC_A)") | 0x0100)
+        self.assertEqual(Keycode.deserialize("0x7E05"), 0x7E05)
+        self.assertEqual(Keycode.deserialize("nonsense"), 0)
+
+    def test_v5(self):
+        self.check_protocol(5)
+
+    def test_v6(self):
+        self.check_protocol(6)
+
+    def test_rebuild(self):
+        recreate_keyboard_keycodes(FakeKeyboard(6))
+        tables = KeycodeTables.get()
+        # the same keycodes again don't need new tables
+        recreate_keyboard_keycodes(FakeKeyboard(6))
+        self.assertIs(KeycodeTables.get(), tables)
+
+        recreate_keyboard_keycodes(FakeKeyboard(5))
+        self.assertIsNot(KeycodeTables.get(), tables)
+        self.assertEqual(Keycode.serialize(Keycode.resolve("QK_LCTL") | 0x04), "LCTL(KC_A)")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+import unittest
+
+from PyQt5.QtWidgets import QApplication
+
+from editor.keymap_editor import KeymapEditor
+from editor.layout_editor import LayoutEditor
+from keycodes.keycodes import recreate_keyboard_keycodes
+from protocol.emulator import KeyboardEmulator
+from test.util import initialize_settings, keyboard
+
+
+class TestKeymapEditor(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.app = QApplication.instance() or QApplication([])
+        initialize_settings()
+
+    def setUp(self):
+        emu = KeyboardEmulator(rows=2, cols=3, layers=2)
+        self.keyboard = keyboard(emu)
+        recreate_keyboard_keycodes(self.keyboard)
+
+        self.editor = KeymapEditor(LayoutEditor())
+        self.editor.keyboard = self.keyboard
+        self.editor.rebuild_layers()
+        self.editor.container.set_keys(self.keyboard.keys, self.keyboard.encoders)
+        self.editor.refresh_layer_display()
+
+        self.container = self.editor.container
+        self.updates = []
+        self.container.update = lambda *args: self.updates.append(args)
+
+    def test_set_key(self):
+        first, second = self.container.widgets[:2]
+        self.container.set_active_key(first)
+        self.updates.clear()
+
+        self.editor.set_key("KC_Z")
+        self.assertEqual(self.keyboard.layout[(0, first.desc.row, first.desc.col)], "KC_Z")
+        self.assertEqual(first.text, "Z")
+        self.assertIs(self.container.active_key, second)
+        # the edited key, then the selection moving from it to the next key
+        self.assertEqual(self.updates, [(self.container.key_rect(first),), (self.container.key_rect(first),),
+                                        (self.container.key_rect(second),)])
+
+    def test_key_rect(self):
+        for w in self.container.widgets:
+            rect = self.container.key_rect(w)
+            self.assertTrue(rect.contains(w.polygon.boundingRect().toAlignedRect()))
+            self.assertTrue(self.container.rect().contains(rect))
+
+    def test_switch_layer(self):
+        self.keyboard.set_key(1, 0, 0, "KC_Q")
+        self.editor.switch_layer(1)
+        # every key is shown again
+        self.assertIn((), self.updates)
+        widget = next(w for w in self.container.widgets if (w.desc.row, w.desc.col) == (0, 0))
+        self.assertEqual(widget.text, "Q")
+
+
+if __name__ == "__main__":
+    unittest.main()
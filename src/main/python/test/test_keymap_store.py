@@ -0,0 +1,68 @@
+import struct
+import unittest
+
+from keycodes.keycodes import Keycode, recreate_keycodes
+from protocol.emulator import KeyboardEmulator
+from protocol.keymap_store import KeymapStore
+from test.util import initialize_settings, keyboard
+
+
+class TestKeymapStore(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        initialize_settings()
+
+    def test_load(self):
+        store = KeymapStore(2, 2, 3)
+        codes = list(range(0x04, 0x04 + 12))
+        store.load(struct.pack(">12H", *codes), [(0, 0), (0, 2), (1, 1)])
+        self.assertEqual(len(store), 6)
+        self.assertEqual(list(store), [(0, 0, 0), (0, 0, 2), (0, 1, 1), (1, 0, 0), (1, 0, 2), (1, 1, 1)])
+        self.assertEqual(store[(0, 0, 0)], "KC_A")
+        self.assertEqual(store.raw((1, 1, 1)), 0x04 + 10)
+        # positions which aren't in the layout aren't keys
+        self.assertNotIn((0, 0, 1), store)
+        self.assertIsNone(store.get((0, 0, 1)))
+        self.assertEqual(store.get((5, 0, 0), -1), -1)
+        with self.assertRaises(KeyError):
+            store[(0, 0, 1)]
+
+        store[(1, 0, 2)] = "KC_ENTER"
+        self.assertEqual(store[(1, 0, 2)], "KC_ENTER")
+        self.assertEqual(store.buffer(16, 20), struct.pack(">HH", 0x28, 0x04 + 9))
+        self.assertEqual(store, dict(store.items()))
+        self.assertEqual(store.grid(1, 2, 3, -1), [[["KC_A", -1, "KC_C"], [-1, "KC_E", -1]]])
+
+    def test_dict_interface(self):
+        store = KeymapStore()
+        # grows when filled before it's sized
+        store.update({(0, 0, 0): "KC_A", (1, 2, 3): "KC_B"})
+        self.assertEqual((store.layers, store.rows, store.cols), (2, 3, 4))
+        self.assertEqual(store, {(0, 0, 0): "KC_A", (1, 2, 3): "KC_B"})
+        del store[(0, 0, 0)]
+        self.assertEqual(dict(store), {(1, 2, 3): "KC_B"})
+
+    def test_names_follow_keycodes(self):
+        store = KeymapStore(1, 1, 1)
+        store[(0, 0, 0)] = "KC_A"
+        self.assertEqual(store[(0, 0, 0)], "KC_A")
+        # stale cached names are dropped when the tables change
+        store.names[0x04] = "stale"
+        recreate_keycodes()
+        self.assertEqual(store[(0, 0, 0)], "KC_A")
+
+    def test_keyboard(self):
+        emu = KeyboardEmulator(rows=3, cols=5, layers=4)
+        kb = keyboard(emu)
+        self.assertIsInstance(kb.layout, KeymapStore)
+        self.assertEqual(len(kb.layout), 60)
+        kb.set_key(2, 1, 3, "KC_Z")
+        self.assertEqual(kb.layout.raw((2, 1, 3)), Keycode.deserialize("KC_Z"))
+
+        kb = keyboard(emu)
+        self.assertEqual(kb.layout[(2, 1, 3)], "KC_Z")
+
+
+if __name__ == "__main__":
+    unittest.main()
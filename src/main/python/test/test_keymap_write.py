@@ -0,0 +1,80 @@
+import unittest
+
+from protocol.constants import CMD_VIA_KEYMAP_SET_BUFFER, CMD_VIA_SET_KEYCODE
+from protocol.emulator import KeyboardEmulator
+from test.util import initialize_settings, keyboard
+
+
+class TestKeymapWrite(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        initialize_settings()
+
+    @staticmethod
+    def keyboard(emu):
+        kb = keyboard(emu)
+        kb.sent = []
+        send = kb.usb_send
+
+        def record(dev, msg, retries=1):
+            kb.sent.append(msg[0])
+            return send(dev, msg, retries)
+        kb.usb_send = record
+        kb.usb_post = record
+        return kb
+
+    def test_spans(self):
+        kb = self.keyboard(KeyboardEmulator(rows=2, cols=10))
+        # keys close together are written as one span, including the unchanged ones between them
+        keys = [(0, 0, 0), (0, 0, 2), (0, 1, 9), (1, 0, 0)]
+        self.assertEqual(kb.keymap_dirty_spans(keys), [(0, 6), (38, 4)])
+        self.assertEqual(kb.keymap_dirty_spans([(0, 0, 0), (0, 1, 9)]), [(0, 2), (38, 2)])
+
+    def test_bulk_write(self):
+        emu = KeyboardEmulator(rows=4, cols=10, layers=2)
+        kb = self.keyboard(emu)
+        keys = {(layer, row, col): "KC_A" for layer in range(2) for row in range(4) for col in range(10)}
+        keys[(1, 3, 9)] = "KC_B"
+        kb.set_keys(keys)
+        # 80 keys, 14 per packet
+        self.assertEqual(kb.sent, [CMD_VIA_KEYMAP_SET_BUFFER] * 6)
+        self.assertTrue(kb.keymap_set_buffer)
+        self.assertEqual(self.keyboard(emu).layout, keys)
+
+        kb.sent = []
+        kb.set_keys(keys)
+        self.assertEqual(kb.sent, [])
+
+    def test_fallback(self):
+        emu = KeyboardEmulator(rows=2, cols=10, keymap_set_buffer=False)
+        kb = self.keyboard(emu)
+        kb.set_keys({(0, 0, 1): "KC_A", (0, 0, 2): "KC_B", (1, 1, 1): "KC_C"})
+        self.assertFalse(kb.keymap_set_buffer)
+        self.assertEqual(kb.sent, [CMD_VIA_KEYMAP_SET_BUFFER] + [CMD_VIA_SET_KEYCODE] * 3)
+
+        # not probed again
+        kb.sent = []
+        kb.set_keys({(0, 0, 1): "KC_D"})
+        self.assertEqual(kb.sent, [CMD_VIA_SET_KEYCODE])
+
+        layout = self.keyboard(emu).layout
+        self.assertEqual((layout[(0, 0, 1)], layout[(0, 0, 2)], layout[(1, 1, 1)]), ("KC_D", "KC_B", "KC_C"))
+
+    def test_restore_layout(self):
+        src = self.keyboard(KeyboardEmulator(rows=3, cols=5, layers=4))
+        for layer in range(4):
+            src.set_key(layer, layer % 3, layer, "KC_{}".format(chr(ord("A") + layer)))
+        data = src.save_layout()
+
+        emu = KeyboardEmulator(rows=3, cols=5, layers=4)
+        kb = self.keyboard(emu)
+        kb.restore_layout(data)
+        # the changes on the last two layers are close enough to share a packet
+        self.assertEqual(kb.sent.count(CMD_VIA_KEYMAP_SET_BUFFER), 3)
+        self.assertEqual(kb.sent.count(CMD_VIA_SET_KEYCODE), 0)
+        self.assertEqual(self.keyboard(emu).layout, src.layout)
+
+
+if __name__ == "__main__":
+    unittest.main()
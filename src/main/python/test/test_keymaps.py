@@ -0,0 +1,17 @@
+import unittest
+
+from keycodes.keycodes import Keycode
+from keymaps import KEYMAPS
+
+
+class TestKeymaps(unittest.TestCase):
+
+    def test_qmk_ids(self):
+        # make sure that qmk IDs we used are all correct
+        for name, keymap in KEYMAPS:
+            for qmk_id in keymap.keys():
+                self.assertIsNotNone(Keycode.find_by_qmk_id(qmk_id), "{}: {}".format(name, qmk_id))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,42 @@
+import os
+import tempfile
+import unittest
+
+from layout_cache import LayoutCache, ParsedLayout
+
+KEYMAP = [
+    [{"c": "#777777"}, "0,0", {"c": "#cccccc"}, "0,1", {"w": 2}, "0,2\n\n\n0,0", "0,2\n\n\n0,1"],
+    [{"y": 0.5}, "0,0\n\n\n\n\n\n\n\n\ne", "0,1\n\n\n\n\n\n\n\n\ne", {"d": True}, ""],
+]
+
+
+class TestLayoutCache(unittest.TestCase):
+
+    @staticmethod
+    def describe(layout):
+        return ([vars(k) | {"default": vars(k.default)} for k in layout.keys],
+                [vars(k) | {"default": vars(k.default)} for k in layout.encoders],
+                layout.rowcol, layout.encoderpos, layout.encoder_count)
+
+    def test_parse(self):
+        layout = ParsedLayout.parse(KEYMAP)
+        self.assertEqual(layout.rowcol, [(0, 0), (0, 1), (0, 2)])
+        self.assertEqual(layout.encoderpos, [0])
+        self.assertEqual(layout.encoder_count, 1)
+        self.assertEqual([(k.row, k.col, k.layout_index, k.layout_option) for k in layout.keys],
+                         [(0, 0, -1, -1), (0, 1, -1, -1), (0, 2, 0, 0), (0, 2, 0, 1), (0, 0, -1, -1)])
+        self.assertEqual([(k.encoder_idx, k.encoder_dir) for k in layout.encoders], [(0, 0), (0, 1)])
+
+    def test_memoized(self):
+        cache = LayoutCache()
+        layout = cache.parse(KEYMAP)
+        self.assertIs(cache.parse([list(row) for row in KEYMAP]), layout)
+        self.assertIsNot(cache.parse(KEYMAP[:1]), layout)
+
+    def test_disk(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            layout = LayoutCache(tmp).parse(KEYMAP)
+            self.assertEqual(len(os.listdir(tmp)), 1)
+            restored = LayoutCache(tmp).parse(KEYMAP)
+            self.assertIsNot(restored, layout)
+            self.assertEqual(self.describe(restored), self.describe(layout))
@@ -0,0 +1,98 @@
+import json
+import struct
+import unittest
+
+from packet_tracer import PacketTracer
+from test.test_hid_send import FakeHidDevice
+from util import MSG_LEN, hid_send
+
+
+class TestPacketTracer(unittest.TestCase):
+
+    def setUp(self):
+        PacketTracer.instance = None
+
+    def tearDown(self):
+        PacketTracer.instance = None
+
+    def test_disabled(self):
+        tracer = PacketTracer(capacity=4)
+        tracer.record(PacketTracer.OUT, b"\x01")
+        self.assertIsNone(tracer.buffer)
+        self.assertEqual(tracer.packets(), [])
+
+    def test_ring(self):
+        tracer = PacketTracer(capacity=4)
+        tracer.enable()
+        buffer = tracer.buffer
+        for x in range(6):
+            tracer.record(PacketTracer.OUT if x % 2 == 0 else PacketTracer.IN, bytes([x]) * 3)
+        self.assertIs(tracer.buffer, buffer)
+        self.assertEqual([(p[1], p[3], p[4]) for p in tracer.packets()],
+                         [(PacketTracer.OUT, 3, b"\x02" * 3), (PacketTracer.IN, 3, b"\x03" * 3),
+                          (PacketTracer.OUT, 3, b"\x04" * 3), (PacketTracer.IN, 3, b"\x05" * 3)])
+        timestamps = [p[0] for p in tracer.packets()]
+        self.assertEqual(timestamps, sorted(timestamps))
+
+        # disabling keeps what was recorded
+        tracer.disable()
+        tracer.record(PacketTracer.OUT, b"\x07")
+        self.assertEqual(len(tracer.packets()), 4)
+        tracer.clear()
+        self.assertEqual(tracer.packets(), [])
+
+    def test_truncated(self):
+        tracer = PacketTracer(capacity=2)
+        tracer.enable()
+        tracer.record(PacketTracer.OUT, bytearray(range(200)), PacketTracer.IFACE_AMK_FAST)
+        _, _, iface, length, data = tracer.packets()[0]
+        self.assertEqual((iface, length, data), (PacketTracer.IFACE_AMK_FAST, 200, bytes(range(64))))
+
+    def test_hid_send(self):
+        PacketTracer.get().enable()
+        hid_send(FakeHidDevice(), b"\x12\x00")
+        msg = b"\x12\x00" + b"\x00" * (MSG_LEN - 2)
+        self.assertEqual([(p[1], p[4]) for p in PacketTracer.get().packets()],
+                         [(PacketTracer.OUT, msg), (PacketTracer.IN, msg)])
+
+    def test_jsonl(self):
+        tracer = PacketTracer(capacity=4)
+        tracer.enable()
+        tracer.record(PacketTracer.OUT, b"\xFE\x00")
+        tracer.record(PacketTracer.IN, b"\x01\x02")
+        lines = [json.loads(line) for line in tracer.to_jsonl().splitlines()]
+        self.assertEqual([(e["dir"], e["iface"], e["len"], e["data"]) for e in lines],
+                         [("out", "rawhid", 2, "fe00"), ("in", "rawhid", 2, "0102")])
+
+    def test_pcapng(self):
+        tracer = PacketTracer(capacity=4)
+        tracer.enable()
+        tracer.record(PacketTracer.OUT, b"\xFE\x00\x01")
+        tracer.record(PacketTracer.IN, b"\x01" * 32, PacketTracer.IFACE_AMK_FAST)
+        data = tracer.to_pcapng()
+
+        blocks = []
+        offset = 0
+        while offset < len(data):
+            block_type, length = struct.unpack_from("<II", data, offset)
+            self.assertEqual(length % 4, 0)
+            self.assertEqual(struct.unpack_from("<I", data, offset + length - 4)[0], length)
+            blocks.append((block_type, data[offset + 8:offset + length - 4]))
+            offset += length
+        self.assertEqual(offset, len(data))
+        self.assertEqual([b[0] for b in blocks], [0x0A0D0D0A, 1, 1, 6, 6])
+        self.assertEqual(struct.unpack_from("<I", blocks[0][1])[0], 0x1A2B3C4D)
+        self.assertEqual(struct.unpack_from("<H", blocks[1][1])[0], PacketTracer.LINKTYPE_USER0)
+
+        iface, _, _, captured, length = struct.unpack_from("<IIIII", blocks[3][1])
+        self.assertEqual((iface, captured, length), (0, 3, 3))
+        self.assertEqual(blocks[3][1][20:23], b"\xFE\x00\x01")
+        # epb_flags after the padded packet data: outbound
+        self.assertEqual(struct.unpack_from("<HHI", blocks[3][1], 24), (2, 4, 2))
+        iface, _, _, captured, length = struct.unpack_from("<IIIII", blocks[4][1])
+        self.assertEqual((iface, captured, length), (1, 32, 32))
+        self.assertEqual(struct.unpack_from("<HHI", blocks[4][1], 52), (2, 4, 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
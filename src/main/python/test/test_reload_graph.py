@@ -0,0 +1,50 @@
+import unittest
+
+from protocol.reload_graph import ReloadGraph, ReloadStage, ReloadCancelled
+
+
+class TestReloadGraph(unittest.TestCase):
+
+    def setUp(self):
+        self.ran = []
+
+    def stage(self, name, deps=(), background=False):
+        return ReloadStage(name, lambda: self.ran.append(name), deps, background)
+
+    def test_order(self):
+        graph = ReloadGraph([
+            self.stage("keymap", ["layers", "keycodes"]),
+            self.stage("layout"),
+            self.stage("amk", ["layout"], background=True),
+            self.stage("keycodes", ["layout"]),
+            self.stage("layers", ["layout"]),
+        ])
+        progress = []
+        graph.run(background=False, progress=lambda *args: progress.append(args))
+        self.assertEqual(self.ran, ["layout", "layers", "keycodes", "keymap"])
+        self.assertEqual(progress[-1], ("keymap", 4, 5))
+        self.assertFalse(graph.finished())
+
+        graph.run(background=True, progress=lambda *args: progress.append(args))
+        self.assertEqual(self.ran[-1], "amk")
+        self.assertEqual(progress[-1], ("amk", 5, 5))
+        self.assertTrue(graph.finished())
+
+        # stages don't run twice
+        graph.run()
+        self.assertEqual(len(self.ran), 5)
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            ReloadGraph([self.stage("a", ["b"]), self.stage("b", ["a"])])
+        with self.assertRaises(ValueError):
+            ReloadGraph([self.stage("a", ["missing"])])
+        with self.assertRaises(ValueError):
+            ReloadGraph([self.stage("a", background=True), self.stage("b", ["a"])])
+
+    def test_cancel(self):
+        graph = ReloadGraph([self.stage("a"), ReloadStage("b", lambda: graph.cancel()), self.stage("c")])
+        with self.assertRaises(ReloadCancelled):
+            graph.run()
+        self.assertEqual(self.ran, ["a"])
+        self.assertEqual(graph.done, {"a", "b"})
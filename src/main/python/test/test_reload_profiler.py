@@ -0,0 +1,94 @@
+import json
+import os
+import tempfile
+import unittest
+from copy import copy
+from functools import partial
+
+from protocol.reload_profiler import ReloadProfiler
+from retry_policy import RetryPolicy
+from test.test_hid_send import FakeHidDevice
+from util import MSG_LEN, hid_send, sequential_send_many
+
+
+class FakeKeyboard:
+
+    keyboard_id = 0x1234
+    via_protocol = 9
+    vial_protocol = 6
+
+    def __init__(self, dev):
+        self.dev = dev
+        self.usb_send = partial(hid_send, policy=RetryPolicy(base_delay=0, jitter=0))
+        self.usb_send_many = sequential_send_many(self.usb_send)
+        self.usb_post = self.usb_send
+
+    def reload(self):
+        self.reload_layers()
+        self.reload_keymap()
+
+    def reload_layers(self):
+        self.usb_send(self.dev, b"\x11", retries=5)
+
+    def reload_keymap(self):
+        self.usb_send_many(self.dev, [b"\x12\x00", b"\x12\x01"])
+
+    def set_key(self):
+        self.usb_post(self.dev, b"\x05")
+
+
+class TestReloadProfiler(unittest.TestCase):
+
+    def test_spans(self):
+        kb = FakeKeyboard(FakeHidDevice(drop=0))
+        profiler = ReloadProfiler()
+        profiler.attach(kb)
+        kb.reload()
+        # methods called on copies of the keyboard are profiled as well
+        copy(kb).reload_keymap()
+        kb.set_key()
+        profiler.stop()
+        kb.reload_layers()
+
+        spans = [(e["name"], e["depth"], e["requests"], e["packets"], e["retries"]) for e in
+                 sorted(profiler.events, key=lambda e: e["start"])]
+        self.assertEqual(spans, [("reload", 0, 3, 4, 1), ("reload_layers", 1, 1, 2, 1),
+                                 ("reload_keymap", 1, 2, 2, 0), ("reload_keymap", 0, 2, 2, 0)])
+        self.assertEqual(profiler.snapshot(), {"requests": 6, "packets": 7, "bytes": 7 * (MSG_LEN + 1) + 6 * MSG_LEN})
+
+    def test_error(self):
+        kb = FakeKeyboard(FakeHidDevice(silent=True))
+        profiler = ReloadProfiler()
+        profiler.attach(kb)
+        with self.assertRaises(RuntimeError):
+            kb.reload_layers()
+        self.assertEqual(profiler.events[0]["error"], "RuntimeError")
+
+    def test_save(self):
+        kb = FakeKeyboard(FakeHidDevice())
+        profiler = ReloadProfiler()
+        profiler.attach(kb)
+        kb.reload()
+        with tempfile.TemporaryDirectory() as tmp:
+            profiler.finish(os.path.join(tmp, "reload.json"))
+            with open(os.path.join(tmp, "reload.json")) as inf:
+                trace = json.load(inf)
+            with open(os.path.join(tmp, "reload.txt")) as inf:
+                summary = inf.read()
+
+        spans = [e for e in trace["traceEvents"] if e["ph"] == "X"]
+        self.assertEqual([e["name"] for e in spans], ["reload", "reload_layers", "reload_keymap"])
+        self.assertEqual(spans[0]["args"], {"requests": 3, "packets": 3, "bytes": 3 * (2 * MSG_LEN + 1),
+                                            "retries": 0})
+        self.assertEqual(trace["otherData"]["keyboard_id"], "0000000000001234")
+        self.assertIn("  reload_keymap", summary)
+        self.assertIn("total: 3 requests, 3 packets", summary)
+
+    def test_armed(self):
+        ReloadProfiler.arm("trace.json")
+        self.assertEqual(ReloadProfiler.take_armed(), "trace.json")
+        self.assertIsNone(ReloadProfiler.take_armed())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+import json
+import unittest
+
+from protocol.emulator import KeyboardEmulator
+from protocol.restore_plan import RestoreCancelled, RestorePlan
+from test.util import initialize_settings, keyboard
+
+
+class TestRestorePlan(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        initialize_settings()
+
+    @staticmethod
+    def emulator(**kwargs):
+        definition = KeyboardEmulator.make_definition(3, 5)
+        definition["layouts"]["keymap"].append(["0,0\n\n\n\n\n\n\n\n\ne", "0,1\n\n\n\n\n\n\n\n\ne"])
+        return KeyboardEmulator(definition, **kwargs)
+
+    def saved_layout(self):
+        """ A layout with a few changes in every section, relative to a blank keyboard """
+        kb = keyboard(self.emulator())
+        kb.set_key(0, 0, 1, "KC_A")
+        kb.set_key(3, 2, 4, "KC_B")
+        kb.set_encoder(1, 0, 1, "KC_C")
+        kb.set_macro(kb.macros_serialize([[]] * 3 + [kb.macro_deserialize(b"hello")] + [[]] * 12))
+        kb.tap_dance_set(1, ("KC_D", "KC_E", "KC_NO", "KC_NO", 200))
+        kb.combo_set(0, ("KC_F", "KC_G", "KC_NO", "KC_NO", "KC_H"))
+        kb.qmk_settings_set(2, 1)
+        return kb.save_layout()
+
+    def test_unchanged(self):
+        kb = keyboard(self.emulator())
+        self.assertEqual(len(kb.plan_restore(kb.save_layout())), 0)
+
+    def test_minimal(self):
+        emu = self.emulator()
+        kb = keyboard(emu)
+        data = self.saved_layout()
+        plan = kb.plan_restore(data)
+        self.assertEqual(plan.summary(), {"settings": 1, "macro": 1, "tap_dance": 1, "combo": 1, "encoder": 1,
+                                          "keymap": 2})
+        # what keys refer to first, keys last
+        self.assertEqual([step.section for step in plan.steps],
+                         ["settings", "macro", "tap_dance", "combo", "encoder", "keymap", "keymap"])
+        self.assertTrue(plan.unlock)
+        self.assertAlmostEqual(plan.estimate(), len(plan) * RestorePlan.DEFAULT_LATENCY)
+
+        # planning alone doesn't touch the keyboard
+        requests = emu.requests
+        self.assertEqual(len(plan.describe()), 7)
+        self.assertEqual(emu.requests, requests)
+        self.assertEqual(kb.layout[(0, 0, 1)], "KC_NO")
+
+        done = []
+        plan.execute(progress=lambda n, total: done.append((n, total)))
+        self.assertEqual(done[-1], (7, 7))
+        # and the unlock status query
+        self.assertEqual(emu.requests, requests + 8)
+        self.assertEqual(json.loads(kb.save_layout()), json.loads(data))
+        self.assertEqual(json.loads(keyboard(emu).save_layout()), json.loads(data))
+        self.assertEqual(len(kb.plan_restore(data)), 0)
+
+    def test_macro_ranges(self):
+        kb = keyboard(self.emulator())
+        data = json.loads(kb.save_layout())
+        data["macro"][15] = [["text", "x" * 40]]
+        plan = kb.plan_restore(json.dumps(data).encode("utf-8"))
+        # only the end of the buffer changes: 40 bytes, two packets
+        self.assertEqual([step.packet[1:4] for step in plan.steps], [b"\x00\x0F\x1C", b"\x00\x2B\x0D"])
+        plan.execute()
+        self.assertEqual(kb.macro, b"\x00" * 15 + b"x" * 40 + b"\x00")
+
+    def test_cancel(self):
+        emu = self.emulator()
+        kb = keyboard(emu)
+        data = self.saved_layout()
+        plan = kb.plan_restore(data)
+        with self.assertRaises(RestoreCancelled):
+            plan.execute(cancelled=lambda: plan.done == 3)
+        self.assertEqual(plan.done, 3)
+        self.assertEqual(kb.layout[(0, 0, 1)], "KC_NO")
+        self.assertEqual(keyboard(emu).tap_dance_entries[1], ("KC_D", "KC_E", "KC_NO", "KC_NO", 200))
+
+        plan.execute()
+        self.assertEqual(json.loads(keyboard(emu).save_layout()), json.loads(data))
+
+    def test_fallback(self):
+        emu = self.emulator(keymap_set_buffer=False)
+        kb = keyboard(emu)
+        data = json.loads(kb.save_layout())
+        for layer in range(4):
+            data["layout"][layer][1] = ["KC_Z"] * 5
+        plan = kb.plan_restore(json.dumps(data).encode("utf-8"))
+        # a buffer write per layer
+        self.assertEqual(len(plan), 4)
+        plan.execute()
+        # the first buffer write was rejected, then every key got written on its own
+        self.assertFalse(kb.keymap_set_buffer)
+        self.assertEqual(len(plan), 20)
+        self.assertEqual(keyboard(emu).layout, kb.layout)
+        self.assertEqual(kb.layout[(3, 1, 4)], "KC_Z")
+
+
+if __name__ == "__main__":
+    unittest.main()
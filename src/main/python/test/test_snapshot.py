@@ -0,0 +1,206 @@
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+from protocol.key_override import KeyOverrideEntry
+from protocol.keyboard_comm import Keyboard
+from protocol.snapshot import KeyboardSnapshot, SnapshotStore
+
+DEFINITION = {"matrix": {"rows": 1, "cols": 2}, "layouts": {"keymap": [["0,0", "0,1"]]}}
+
+
+def make_keyboard():
+    kb = SimpleNamespace(
+        layers=2, macro_count=1, macro_memory=100, tap_dance_count=1, combo_count=1, key_override_count=1,
+        layout={(0, 0, 0): "KC_A", (0, 0, 1): "KC_B", (1, 0, 0): "KC_TRNS", (1, 0, 1): "KC_TRNS"},
+        encoder_layout={(0, 0, 0): "KC_VOLU", (0, 0, 1): "KC_VOLD"},
+        layout_options=0, macro=b"\x01\x02\x00",
+        lighting_qmk_rgblight=False, lighting_qmk_backlight=False, lighting_vialrgb=True,
+        lighting_amk_rgblight=False,
+        underglow_brightness=-1, underglow_effect=-1, underglow_effect_speed=-1, underglow_color=(-1, -1),
+        backlight_brightness=-1, backlight_effect=-1,
+        rgb_version=1, rgb_maximum_brightness=200, rgb_supported_effects={0, 1, 5}, rgb_mode=1, rgb_speed=10,
+        rgb_hsv=(0, 255, 255),
+        settings={1: 200, 2: 0}, supported_settings={1, 2},
+        tap_dance_entries=[("KC_A", "KC_B", "KC_NO", "KC_NO", 200)],
+        combo_entries=[("KC_A", "KC_B", "KC_NO", "KC_NO", "KC_ESC")],
+        key_override_entries=[KeyOverrideEntry()],
+    )
+    return kb
+
+
+class TestKeyboardSnapshot(unittest.TestCase):
+
+    def test_roundtrip(self):
+        kb = make_keyboard()
+        state = KeyboardSnapshot.capture(kb)
+        restored = SimpleNamespace()
+        KeyboardSnapshot.apply(restored, KeyboardSnapshot.decode(KeyboardSnapshot.encode(state)))
+        for field in KeyboardSnapshot.STATE:
+            self.assertEqual(getattr(restored, field), getattr(kb, field), field)
+        self.assertIsInstance(restored.rgb_hsv, tuple)
+        self.assertIsInstance(restored.tap_dance_entries[0], tuple)
+
+    def test_merge_keeps_user_edits(self):
+        kb = make_keyboard()
+        base = KeyboardSnapshot.capture(kb)
+
+        # user edits made while the keyboard was being verified
+        kb.layout[(0, 0, 0)] = "KC_Q"
+        kb.settings[1] = 300
+
+        # changes made on the device since the snapshot was taken
+        device = make_keyboard()
+        device.layout[(0, 0, 0)] = "KC_Z"
+        device.layout[(0, 0, 1)] = "KC_C"
+        device.settings[2] = 1
+        device.rgb_mode = 5
+
+        changed = KeyboardSnapshot.merge(kb, base, KeyboardSnapshot.capture(device))
+        self.assertEqual(set(changed), {"layout", "settings", "rgb_mode"})
+        self.assertEqual(kb.layout[(0, 0, 0)], "KC_Q")
+        self.assertEqual(kb.layout[(0, 0, 1)], "KC_C")
+        self.assertEqual(kb.settings, {1: 300, 2: 1})
+        self.assertEqual(kb.rgb_mode, 5)
+
+    def test_merge_unchanged(self):
+        kb = make_keyboard()
+        base = KeyboardSnapshot.capture(kb)
+        self.assertEqual(KeyboardSnapshot.merge(kb, base, KeyboardSnapshot.capture(make_keyboard())), [])
+
+    def test_same_structure(self):
+        kb, device = make_keyboard(), make_keyboard()
+        self.assertTrue(KeyboardSnapshot.same_structure(kb, device))
+        device.layers = 4
+        self.assertFalse(KeyboardSnapshot.same_structure(kb, device))
+
+
+class TestSnapshotStore(unittest.TestCase):
+
+    def test_store(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            store = SnapshotStore(tmp)
+            state = KeyboardSnapshot.capture(make_keyboard())
+            self.assertIsNone(store.load(0x1234, DEFINITION, 9, 6))
+
+            store.save(0x1234, DEFINITION, 9, 6, state)
+            self.assertEqual(store.load(0x1234, DEFINITION, 9, 6), state)
+            # a different definition or protocol means the snapshot can't be trusted
+            self.assertIsNone(store.load(0x1234, dict(DEFINITION, lighting="vialrgb"), 9, 6))
+            self.assertIsNone(store.load(0x1234, DEFINITION, 9, 5))
+            self.assertIsNone(store.load(0x4321, DEFINITION, 9, 6))
+
+            store.remove(0x1234)
+            self.assertIsNone(store.load(0x1234, DEFINITION, 9, 6))
+
+    def test_corrupted(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            store = SnapshotStore(tmp)
+            with open(store.path(0x1234), "w") as outf:
+                outf.write("{not json")
+            self.assertIsNone(store.load(0x1234, DEFINITION, 9, 6))
+            self.assertFalse(os.path.exists(store.path(0x1234)))
+
+
+class FakeKeyboard(Keyboard):
+    """ Keyboard whose reads come from `device`, a make_keyboard() namespace, and counts them """
+
+    def __init__(self, device, store):
+        super().__init__(None, usb_send=None, snapshot_store=store)
+        self.device = device
+        self.reads = 0
+
+    def reload_layout(self, sideload_json=None):
+        self.sideload = False
+        self.keyboard_id = 0x1234
+        self.via_protocol, self.vial_protocol = 9, 6
+        self.definition = DEFINITION
+
+    def read(self, *fields):
+        self.reads += 1
+        for field in fields:
+            value = getattr(self.device, field)
+            setattr(self, field, value.copy() if isinstance(value, (dict, set, list)) else value)
+
+    def reload_layers(self):
+        self.read("layers")
+
+    def reload_macros_early(self):
+        self.read("macro_count", "macro_memory")
+
+    def reload_dynamic(self):
+        self.read("tap_dance_count", "combo_count", "key_override_count")
+
+    def reload_rgb_stage(self):
+        self.read(*[f for f in KeyboardSnapshot.STATE if f.startswith(("lighting_", "underglow_", "backlight_", "rgb_"))])
+
+    def reload_settings(self):
+        self.read("settings", "supported_settings")
+
+    def reload_keymap(self):
+        self.reads += 1
+        self.layout.update(self.device.layout)
+        self.encoder_layout.update(self.device.encoder_layout)
+        self.layout_options = self.device.layout_options
+
+    def reload_macros_late(self):
+        self.read("macro")
+
+    def reload_tap_dance(self):
+        self.read("tap_dance_entries")
+
+    def reload_combo(self):
+        self.read("combo_entries")
+
+    def reload_key_override(self):
+        self.read("key_override_entries")
+
+    def reload_stages(self, sideload_json=None):
+        return [s for s in super().reload_stages(sideload_json) if not s.background or s.name == "verify"]
+
+
+class TestWarmStart(unittest.TestCase):
+
+    def test_warm_start(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            store = SnapshotStore(tmp)
+            device = make_keyboard()
+
+            cold = FakeKeyboard(device, store)
+            cold.reload_foreground()
+            self.assertIsNone(cold.warm_snapshot)
+            cold.reload_background()
+            self.assertTrue(os.path.exists(store.path(0x1234)))
+
+            device.layout[(0, 0, 1)] = "KC_C"
+            warm = FakeKeyboard(device, store)
+            warm.reload_foreground()
+            # everything shown right away comes from the snapshot
+            self.assertIsNotNone(warm.warm_snapshot)
+            self.assertEqual(warm.reads, 0)
+            self.assertEqual(warm.layout[(0, 0, 1)], "KC_B")
+
+            warm.layout[(0, 0, 0)] = "KC_Q"
+            warm.reload_background()
+            self.assertEqual(warm.snapshot_changes, ["layout"])
+            self.assertEqual(warm.layout[(0, 0, 0)], "KC_Q")
+            self.assertEqual(warm.layout[(0, 0, 1)], "KC_C")
+            self.assertFalse(warm.snapshot_stale)
+
+    def test_structure_changed(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            store = SnapshotStore(tmp)
+            device = make_keyboard()
+            FakeKeyboard(device, store).reload()
+
+            device.layers = 4
+            warm = FakeKeyboard(device, store)
+            warm.reload()
+            self.assertTrue(warm.snapshot_stale)
+            self.assertEqual(warm.layers, 2)
+            self.assertFalse(os.path.exists(store.path(0x1234)))
+
+
+if __name__ == "__main__":
+    unittest.main()
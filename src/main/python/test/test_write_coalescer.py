@@ -0,0 +1,89 @@
+import unittest
+
+from PyQt5.QtCore import QCoreApplication
+
+from write_coalescer import WriteCoalescer
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestWriteCoalescer(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        if QCoreApplication.instance() is None:
+            cls.app = QCoreApplication([])
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.writes = WriteCoalescer(interval=0.05, clock=self.clock)
+        self.sent = []
+
+    def send(self, name, value):
+        self.sent.append((name, value))
+
+    def test_drag(self):
+        # a drag producing a value every 5ms for half a second
+        for x in range(100):
+            self.writes.submit("brightness", self.send, "brightness", x)
+            self.clock.now += 0.005
+            self.writes.poll()
+        self.clock.now += 0.05
+        self.writes.poll()
+
+        self.assertEqual(self.sent[0], ("brightness", 0))
+        self.assertEqual(self.sent[-1], ("brightness", 99))
+        self.assertLessEqual(len(self.sent), 12)
+        self.assertEqual((self.writes.submitted, self.writes.performed), (100, len(self.sent)))
+        self.assertFalse(self.writes.pending)
+
+    def test_settings_are_independent(self):
+        self.writes.submit("brightness", self.send, "brightness", 1)
+        self.writes.submit("speed", self.send, "speed", 2)
+        self.writes.submit("brightness", self.send, "brightness", 3)
+        self.writes.submit("speed", self.send, "speed", 4)
+        self.writes.submit("brightness", self.send, "brightness", 5)
+        self.assertEqual(self.sent, [("brightness", 1), ("speed", 2)])
+
+        # not due yet
+        self.clock.now += 0.01
+        self.writes.poll()
+        self.assertEqual(len(self.sent), 2)
+
+        self.clock.now += 0.05
+        self.writes.poll()
+        self.assertEqual(self.sent[2:], [("speed", 4), ("brightness", 5)])
+
+    def test_flush_and_clear(self):
+        self.writes.submit("a", self.send, "a", 1)
+        self.writes.submit("a", self.send, "a", 2)
+        self.writes.submit("b", self.send, "b", 1)
+        self.writes.submit("b", self.send, "b", 2)
+        self.writes.flush("a")
+        self.assertEqual(self.sent, [("a", 1), ("b", 1), ("a", 2)])
+
+        self.writes.clear()
+        self.clock.now += 1
+        self.writes.poll()
+        self.writes.flush()
+        self.assertEqual(len(self.sent), 3)
+
+    def test_timer(self):
+        writes = WriteCoalescer(interval=0.01)
+        writes.submit("a", self.send, "a", 1)
+        writes.submit("a", self.send, "a", 2)
+        self.assertTrue(writes.timer.isActive())
+        while writes.pending:
+            QCoreApplication.processEvents()
+        self.assertEqual(self.sent, [("a", 1), ("a", 2)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,22 @@
+import os
+
+from editor.qmk_settings import QmkSettings
+from protocol.keyboard_comm import Keyboard
+
+
+class AppContext:
+
+    @staticmethod
+    def get_resource(name):
+        return os.path.join(os.path.dirname(__file__), "..", "..", "resources", "base", name)
+
+
+def initialize_settings():
+    QmkSettings.initialize(AppContext())
+
+
+def keyboard(emu, **kwargs):
+    """ A Keyboard reloaded from the emulator, talking to it directly rather than through hid_send """
+    kb = Keyboard(emu, usb_send=emu.usb_send, **kwargs)
+    kb.reload()
+    return kb
@@ -10,9 +10,16 @@ from PyQt5.QtCore import QCoreApplication, QStandardPaths
 from PyQt5.QtGui import QPalette
 from PyQt5.QtWidgets import QApplication, QWidget, QScrollArea, QFrame
 
+from hid_metrics import HidMetrics
 from hidproxy import hid
+from packet_tracer import PacketTracer
+from protocol.constants import CMD_VIA_GET_KEYBOARD_VALUE, CMD_VIA_SET_KEYBOARD_VALUE, CMD_VIA_GET_KEYCODE, \
+    CMD_VIA_SET_KEYCODE, CMD_VIA_LIGHTING_SET_VALUE, CMD_VIA_LIGHTING_GET_VALUE, CMD_VIA_MACRO_GET_BUFFER, \
+    CMD_VIA_MACRO_SET_BUFFER, CMD_VIA_KEYMAP_GET_BUFFER, CMD_VIA_KEYMAP_SET_BUFFER, CMD_VIA_UNHANDLED, \
+    CMD_VIA_VIAL_PREFIX
 from keycodes.keycodes import Keycode
 from keymaps import KEYMAPS
+from retry_policy import RetryPolicy
 
 tr = QCoreApplication.translate
 
@@ -24,6 +31,31 @@ VIBL_SERIAL_NUMBER_MAGIC = "vibl:d4f8159c"
 
 MSG_LEN = 32
 
+# how many independent requests hid_send_many keeps in flight at once
+# webhid can only track a single outstanding report, so don't pipeline there
+HID_PIPELINE_WINDOW = 1 if sys.platform == "emscripten" else 8
+
+# how many leading bytes of a request the firmware repeats at the start of its response, 1 when not listed
+# Vial commands overwrite the response from the first byte so they can't be told apart; AMK (0xFD) ones
+# repeat the command and the subcommand
+RESPONSE_ECHO = {
+    CMD_VIA_GET_KEYBOARD_VALUE: 2,
+    CMD_VIA_SET_KEYBOARD_VALUE: 2,
+    CMD_VIA_GET_KEYCODE: 4,
+    CMD_VIA_SET_KEYCODE: 6,
+    CMD_VIA_LIGHTING_SET_VALUE: 2,
+    CMD_VIA_LIGHTING_GET_VALUE: 2,
+    CMD_VIA_MACRO_GET_BUFFER: 4,
+    CMD_VIA_MACRO_SET_BUFFER: 4,
+    CMD_VIA_KEYMAP_GET_BUFFER: 4,
+    CMD_VIA_KEYMAP_SET_BUFFER: 4,
+    CMD_VIA_VIAL_PREFIX: 0,
+    0xFD: 2,
+}
+
+# how many late responses to earlier requests hid_send skips while waiting for the response to its own
+HID_MAX_STALE = 16
+
 # these should match what we have in vial-qmk/keyboards/vial_example
 # so that people don't accidentally reuse a sample keyboard UID
 EXAMPLE_KEYBOARDS = [
@@ -37,36 +69,185 @@ EXAMPLE_KEYBOARDS = [
 EXAMPLE_KEYBOARD_PREFIX = 0xA6867BDFD3B00F
 
 
-def hid_send(dev, msg, retries=1):
+def hid_drain(dev, timeout_ms):
+    """ Discards any responses that are still queued up from earlier requests """
+    if sys.platform == "emscripten":
+        return
+    tracer = PacketTracer.get()
+    try:
+        while True:
+            data = dev.read(MSG_LEN, timeout_ms=timeout_ms)
+            if not data:
+                break
+            tracer.record(PacketTracer.IN, bytes(data))
+    except OSError:
+        pass
+
+
+def response_matches(msg, data):
+    """
+    Whether `data` can be the response to the (padded) request `msg`, rather than a late response
+    to an earlier request that timed out
+    """
+    echo = RESPONSE_ECHO.get(msg[0], 1)
+    if echo == 0:
+        return True
+    if data[0] == CMD_VIA_UNHANDLED and msg[0] != 0xFD:
+        return True
+    return data[:echo] == msg[:echo]
+
+
+class ResponseReader:
+    """
+    Picks the response to a request out of the packets read after sending it, skipping late responses
+    to earlier requests, up to HID_MAX_STALE of them. hid_read_response and AsyncHidTransport only
+    differ in how they read the packets.
+    """
+
+    def __init__(self, msg):
+        self.msg = msg
+        self.skipped = 0
+
+    def feed(self, data):
+        """ Returns the response once `data` is it, b"" when the read timed out or too much was skipped, else None """
+        if not data:
+            return b""
+        PacketTracer.get().record(PacketTracer.IN, data)
+        if response_matches(self.msg, data):
+            return data
+        self.skipped += 1
+        return b"" if self.skipped > HID_MAX_STALE else None
+
+
+def hid_read_response(dev, msg, policy, deadline=None):
+    """ Reads the response to `msg`, skipping late responses to earlier requests; b"" when it times out """
+    reader = ResponseReader(msg)
+    while True:
+        data = reader.feed(bytes(dev.read(MSG_LEN, timeout_ms=policy.timeout_ms(deadline))))
+        if data is not None:
+            return data
+
+
+def hid_send(dev, msg, retries=1, policy=None):
     if len(msg) > MSG_LEN:
         raise RuntimeError("message must be less than 32 bytes")
     msg += b"\x00" * (MSG_LEN - len(msg))
 
-    data = b""
-    first = True
+    if policy is None:
+        policy = RetryPolicy.legacy()
+    if policy.stale and policy.drain_stale:
+        hid_drain(dev, policy.drain_timeout_ms())
+    policy.stale = False
 
-    while retries > 0:
-        retries -= 1
-        if not first:
-            time.sleep(0.5)
-        first = False
+    data = b""
+    deadline = policy.start()
+    attempt = timeouts = 0
+    started = time.monotonic()
+    tracer = PacketTracer.get()
+
+    while attempt < retries:
+        if attempt > 0:
+            delay = policy.backoff(attempt)
+            if policy.expired(deadline, delay):
+                break
+            time.sleep(delay)
+        attempt += 1
         try:
             # add 00 at start for hidapi report id
             if dev.write(b"\x00" + msg) != MSG_LEN + 1:
                 continue
+            tracer.record(PacketTracer.OUT, msg)
 
-            data = bytes(dev.read(MSG_LEN, timeout_ms=500))
+            sent_at = time.monotonic()
+            data = hid_read_response(dev, msg, policy, deadline)
             if not data:
+                timeouts += 1
+                policy.on_timeout()
                 continue
+            policy.observe(time.monotonic() - sent_at)
         except OSError:
             continue
         break
 
+    HidMetrics.get().record(msg, latency=time.monotonic() - started, retries=max(0, attempt - 1),
+                            timeouts=timeouts, bytes_out=attempt * MSG_LEN, bytes_in=len(data), ok=bool(data))
     if not data:
         raise RuntimeError("failed to communicate with the device")
     return data
 
 
+def hid_send_many(dev, msgs, retries=1, window=HID_PIPELINE_WINDOW, policy=None):
+    """
+    Sends a batch of independent requests, keeping up to `window` of them in flight at once.
+    Responses are returned in the same order as the requests.
+
+    Requests must be safe to repeat (i.e. reads): if the pipeline stalls we cannot tell which
+    response got lost, so the whole batch is redone one request at a time.
+    """
+
+    if policy is None:
+        policy = RetryPolicy.legacy()
+
+    if window <= 1:
+        return [hid_send(dev, msg, retries=retries, policy=policy) for msg in msgs]
+
+    padded = []
+    for msg in msgs:
+        if len(msg) > MSG_LEN:
+            raise RuntimeError("message must be less than 32 bytes")
+        padded.append(msg + b"\x00" * (MSG_LEN - len(msg)))
+
+    if policy.stale and policy.drain_stale:
+        hid_drain(dev, policy.drain_timeout_ms())
+    policy.stale = False
+
+    out = []
+    sent_at = []
+    tracer = PacketTracer.get()
+    try:
+        while len(out) < len(padded):
+            while len(sent_at) < len(padded) and len(sent_at) - len(out) < window:
+                # add 00 at start for hidapi report id
+                if dev.write(b"\x00" + padded[len(sent_at)]) != MSG_LEN + 1:
+                    raise OSError("short write")
+                tracer.record(PacketTracer.OUT, padded[len(sent_at)])
+                sent_at.append(time.monotonic())
+
+            data = bytes(dev.read(MSG_LEN, timeout_ms=policy.timeout_ms()))
+            if not data:
+                policy.on_timeout()
+                break
+            tracer.record(PacketTracer.IN, data)
+            if not response_matches(padded[len(out)], data):
+                # a late response to an earlier request; if ours got lost the read above times out
+                continue
+            out.append(data)
+            HidMetrics.get().record(padded[len(out) - 1], latency=time.monotonic() - sent_at[len(out) - 1],
+                                    bytes_out=MSG_LEN, bytes_in=len(data))
+    except OSError:
+        pass
+
+    if len(out) < len(padded):
+        if len(out) < len(sent_at):
+            # the request is sent again below, this attempt only counts as a timeout
+            HidMetrics.get().record(padded[len(out)], timeouts=1, bytes_out=MSG_LEN)
+        # discard any stray responses still in flight, then fall back to one request at a time
+        hid_drain(dev, 50)
+        policy.stale = False
+        out = [hid_send(dev, msg, retries=retries, policy=policy) for msg in padded]
+
+    return out
+
+
+def sequential_send_many(usb_send):
+    """ Adapts a single-request usb_send function to the usb_send_many interface """
+
+    def send_many(dev, msgs, retries=1):
+        return [usb_send(dev, msg, retries=retries) for msg in msgs]
+
+    return send_many
+
+
 def is_rawhid(desc, quiet):
     if desc["usage_page"] != 0xFF60 or desc["usage"] != 0x61:
         if not quiet:
@@ -137,6 +318,28 @@ def chunks(data, sz):
         yield data[i:i+sz]
 
 
+def dirty_spans(offsets, width, chunk, can_fill=None):
+    """
+    Groups the offsets of changed `width`-byte items of a buffer into (offset, size) spans, for
+    writing the buffer `chunk` bytes per packet. A span also takes in the unchanged items up to
+    the next changed one when that doesn't make it take more packets, as long as can_fill(offset)
+    allows rewriting each of them.
+    """
+    def packets(size):
+        return -(-size // chunk)
+
+    spans = []
+    for offset in sorted(offsets):
+        if spans:
+            start, end = spans[-1]
+            if offset == end or packets(offset + width - start) <= packets(end - start) and \
+                    (can_fill is None or all(can_fill(x) for x in range(end, offset, width))):
+                spans[-1][1] = offset + width
+                continue
+        spans.append([offset, offset + width])
+    return [(start, end - start) for start, end in spans]
+
+
 def pad_for_vibl(msg):
     """ Pads message to vibl fixed 64-byte length """
     if len(msg) > 64:
@@ -167,11 +370,30 @@ def make_scrollable(layout):
     return scroll
 
 
+class KeycodeDisplayRecord:
+    """ What a key widget shows for a qmk_id under a keymap override """
+
+    __slots__ = ("text", "mask_text", "tooltip", "masked", "overriden", "mask_overriden")
+
+    def __init__(self, text, mask_text, tooltip, masked, overriden, mask_overriden):
+        self.text = text
+        self.mask_text = mask_text
+        self.tooltip = tooltip
+        self.masked = masked
+        # drawn in the palette's link color, which is looked up when displaying so that it follows the theme
+        self.overriden = overriden
+        self.mask_overriden = mask_overriden
+
+
 class KeycodeDisplay:
 
     keymap_override = KEYMAPS[0][1]
     clients = []
 
+    # qmk_id -> KeycodeDisplayRecord for the current keymap_override and keycode generation
+    records = dict()
+    records_generation = None
+
     @classmethod
     def get_label(cls, code):
         """ Get label for a specific keycode """
@@ -186,9 +408,8 @@ class KeycodeDisplay:
         return key is not None and key.qmk_id in cls.keymap_override
 
     @classmethod
-    def display_keycode(cls, widget, code):
+    def describe(cls, code):
         text = cls.get_label(code)
-        tooltip = Keycode.tooltip(code)
         mask = Keycode.is_mask(code)
         mask_text = ""
         inner = Keycode.find_inner_keycode(code)
@@ -196,22 +417,35 @@ class KeycodeDisplay:
             mask_text = cls.get_label(inner.qmk_id)
         if mask:
             text = text.split("\n")[0]
-        widget.masked = mask
-        widget.setText(text)
-        widget.setMaskText(mask_text)
-        widget.setToolTip(tooltip)
-        if cls.code_is_overriden(code):
-            widget.setColor(QApplication.palette().color(QPalette.Link))
-        else:
-            widget.setColor(None)
-        if inner and mask and cls.code_is_overriden(inner.qmk_id):
-            widget.setMaskColor(QApplication.palette().color(QPalette.Link))
-        else:
-            widget.setMaskColor(None)
+        return KeycodeDisplayRecord(text, mask_text, Keycode.tooltip(code), mask, cls.code_is_overriden(code),
+                                    bool(inner and mask and cls.code_is_overriden(inner.qmk_id)))
+
+    @classmethod
+    def record(cls, code):
+        """ describe(code), memoized until the keymap override or the keycodes change """
+        if cls.records_generation != Keycode.generation:
+            cls.records.clear()
+            cls.records_generation = Keycode.generation
+        record = cls.records.get(code)
+        if record is None:
+            record = cls.records[code] = cls.describe(code)
+        return record
+
+    @classmethod
+    def display_keycode(cls, widget, code):
+        record = cls.record(code)
+        widget.masked = record.masked
+        widget.setText(record.text)
+        widget.setMaskText(record.mask_text)
+        widget.setToolTip(record.tooltip)
+        link = QApplication.palette().color(QPalette.Link) if record.overriden or record.mask_overriden else None
+        widget.setColor(link if record.overriden else None)
+        widget.setMaskColor(link if record.mask_overriden else None)
 
     @classmethod
     def set_keymap_override(cls, override):
         cls.keymap_override = override
+        cls.records.clear()
         for client in cls.clients:
             client.on_keymap_override()
 
@@ -1,9 +1,15 @@
 # SPDX-License-Identifier: GPL-2.0-or-later
+import logging
 import time
 
+from definition_cache import DefinitionCache
+from hid_replay import HidRecorder
 from hidproxy import hid
+from protocol.device_worker import create_worker
+from protocol.reload_profiler import ReloadProfiler
+from protocol.snapshot import SnapshotStore
 from protocol.keyboard_comm import Keyboard
-from protocol.dummy_keyboard import DummyKeyboard
+from protocol.emulator import KeyboardEmulator
 from util import MSG_LEN, pad_for_vibl
 
 
@@ -15,7 +21,7 @@ class VialDevice:
         self.sideload = False
         self.via_stack = False
 
-    def open(self, override_json=None):
+    def open(self, override_json=None, progress=None):
         self.dev = hid.device()
         for x in range(10):
             try:
@@ -44,11 +50,49 @@ class VialKeyboard(VialDevice):
         self.sideload = sideload
         self.via_stack = via_stack
         self.keyboard = None
+        self.worker = None
+        self.recorder = None
+        self.recording_path = None
 
-    def open(self, override_json=None):
+    def open(self, override_json=None, progress=None):
         super().open(override_json)
-        self.keyboard = Keyboard(self.dev)
-        self.keyboard.reload(override_json)
+        # all traffic to the device goes through its own I/O thread so that writes
+        # issued by the editors don't block the GUI
+        self.worker = create_worker(self.title())
+        dev = self.dev
+        self.recording_path = HidRecorder.take_armed()
+        if self.recording_path is not None:
+            # every exchange of this session is saved when the keyboard is closed, see hid_replay.py
+            dev = self.recorder = HidRecorder(self.dev)
+        self.keyboard = Keyboard(dev, worker=self.worker, definition_cache=DefinitionCache.default(),
+                                 snapshot_store=SnapshotStore.default())
+        profile_path = ReloadProfiler.take_armed()
+        profiler = None
+        if profile_path is not None:
+            profiler = ReloadProfiler()
+            profiler.attach(self.keyboard)
+        self.keyboard.reload_foreground(override_json, progress)
+        # the keymap can be edited already, the slower AMK settings keep loading in the background
+        self.worker.post(self.keyboard.reload_background, progress)
+        if profiler is not None:
+            self.worker.post(profiler.finish, profile_path)
+
+    def close(self):
+        if self.keyboard is not None:
+            self.keyboard.cancel_reload()
+        if self.worker is not None:
+            self.worker.stop()
+            self.worker = None
+        if self.keyboard is not None:
+            # remember what was shown, including unsaved edits, for a warm start on the next connect
+            self.keyboard.save_snapshot()
+        if self.recorder is not None:
+            try:
+                self.recorder.save(self.recording_path)
+            except OSError as e:
+                logging.warning("Failed to save HID recording: %s", e)
+            self.recorder = None
+        super().close()
 
     def title(self):
         s = "{} {}".format(self.desc["manufacturer_string"], self.desc["product_string"]).strip()
@@ -91,15 +135,14 @@ class VialDummyKeyboard(VialKeyboard):
         self.sideload = True
         self.desc = {"path": "/dummy/keyboard"}
 
-    def open(self, override_json=None):
-        self.keyboard = DummyKeyboard(None, usb_send=self.raise_usb_send)
-        self.keyboard.reload(override_json)
+    def open(self, override_json=None, progress=None):
+        # edits are kept by an emulated keyboard, so every editor works without hardware
+        self.emulator = KeyboardEmulator(definition=override_json)
+        self.keyboard = Keyboard(self.emulator, usb_send=self.emulator.usb_send)
+        self.keyboard.reload(override_json, progress)
 
     def title(self):
         return "[Dummy Keyboard]"
 
-    def raise_usb_send(self, *args, **kwargs):
-        raise RuntimeError("usb_send - should not be called!")
-
     def close(self):
         pass
@@ -0,0 +1,96 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+from PyQt5.QtCore import Qt, QTimer
+from PyQt5.QtWidgets import QDockWidget, QTableWidget, QTableWidgetItem, QToolButton, QHBoxLayout, QVBoxLayout, \
+    QWidget, QFileDialog, QDialog, QHeaderView, QLabel
+
+from hid_metrics import HidMetrics
+from util import tr
+
+
+class HidMetricsPanel(QDockWidget):
+    """ Dockable table of HidMetrics, refreshed while it is visible """
+
+    COLUMNS = ["Command", "Count", "Retries", "Timeouts", "Failures", "Bytes out", "Bytes in",
+               "Mean ms", "p50 ms", "p95 ms", "Max ms"]
+
+    def __init__(self, parent=None):
+        super().__init__(tr("HidMetricsPanel", "HID metrics"), parent)
+        self.setObjectName("hid_metrics_panel")
+
+        self.table = QTableWidget(0, len(self.COLUMNS))
+        self.table.setHorizontalHeaderLabels([tr("HidMetricsPanel", c) for c in self.COLUMNS])
+        self.table.setEditTriggers(QTableWidget.NoEditTriggers)
+        self.table.verticalHeader().hide()
+        self.table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeToContents)
+
+        self.lbl_totals = QLabel()
+
+        btn_reset = QToolButton()
+        btn_reset.setText(tr("HidMetricsPanel", "Reset"))
+        btn_reset.setToolButtonStyle(Qt.ToolButtonTextOnly)
+        btn_reset.clicked.connect(self.on_reset)
+
+        btn_save = QToolButton()
+        btn_save.setText(tr("HidMetricsPanel", "Save JSON..."))
+        btn_save.setToolButtonStyle(Qt.ToolButtonTextOnly)
+        btn_save.clicked.connect(self.on_save)
+
+        buttons = QHBoxLayout()
+        buttons.setContentsMargins(0, 0, 0, 0)
+        buttons.addWidget(self.lbl_totals)
+        buttons.addStretch()
+        buttons.addWidget(btn_reset)
+        buttons.addWidget(btn_save)
+
+        vbox = QVBoxLayout()
+        vbox.addWidget(self.table, stretch=1)
+        vbox.addLayout(buttons)
+        w = QWidget()
+        w.setLayout(vbox)
+        self.setWidget(w)
+
+        self.timer = QTimer(self)
+        self.timer.setInterval(1000)
+        self.timer.timeout.connect(self.refresh)
+        self.visibilityChanged.connect(self.on_visibility_changed)
+
+    def on_visibility_changed(self, visible):
+        if visible:
+            self.refresh()
+            self.timer.start()
+        else:
+            self.timer.stop()
+
+    @staticmethod
+    def format_ms(value):
+        return "" if value is None else "{:.2f}".format(value)
+
+    def refresh(self):
+        commands = HidMetrics.get().to_json()["commands"]
+        self.table.setRowCount(len(commands))
+        total_count = total_bytes = 0
+        for row, c in enumerate(commands):
+            latency = c["latency_ms"]
+            values = [c["command"], c["count"], c["retries"], c["timeouts"], c["failures"], c["bytes_out"],
+                      c["bytes_in"], self.format_ms(latency["mean"]), self.format_ms(latency["p50"]),
+                      self.format_ms(latency["p95"]), self.format_ms(latency["max"])]
+            for col, value in enumerate(values):
+                item = QTableWidgetItem(str(value))
+                if col > 0:
+                    item.setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
+                self.table.setItem(row, col, item)
+            total_count += c["count"]
+            total_bytes += c["bytes_out"] + c["bytes_in"]
+        self.lbl_totals.setText(tr("HidMetricsPanel", "{} requests, {} bytes").format(total_count, total_bytes))
+
+    def on_reset(self):
+        HidMetrics.get().reset()
+        self.refresh()
+
+    def on_save(self):
+        dialog = QFileDialog()
+        dialog.setDefaultSuffix("json")
+        dialog.setAcceptMode(QFileDialog.AcceptSave)
+        dialog.setNameFilters(["JSON (*.json)"])
+        if dialog.exec_() == QDialog.Accepted:
+            HidMetrics.get().dump(dialog.selectedFiles()[0])
@@ -1,3 +1,4 @@
+import math
 from collections import defaultdict
 
 from PyQt5.QtGui import QPainter, QColor, QPainterPath, QTransform, QBrush, QPolygonF, QPalette
@@ -81,6 +82,9 @@ class KeyWidget:
             self.background_draw_path = self.calculate_background_draw_path()
             self.foreground_draw_path = self.calculate_foreground_draw_path()
             self.extra_draw_path = self.calculate_extra_draw_path()
+            # everything that is drawn for the key, the encoder arrow sticks out of the polygon
+            self.paint_rect = self.polygon.boundingRect().united(
+                self.transform().mapRect(self.extra_draw_path.boundingRect()))
 
             # calculate areas where the inner keycode will be located
             # nonmask = outer (e.g. Rsft_T)
@@ -106,16 +110,16 @@ class KeyWidget:
         x2 = rect.bottomRight().x()
         y2 = rect.bottomRight().y()
         points = [(x1, y1), (x1, y2), (x2, y2), (x2, y1)]
-        bbox = []
-        for p in points:
-            t = QTransform()
-            t.translate(self.shift_x, self.shift_y)
-            t.translate(self.rotation_x, self.rotation_y)
-            t.rotate(self.rotation_angle)
-            t.translate(-self.rotation_x, -self.rotation_y)
-            p = t.map(QPointF(p[0], p[1]))
-            bbox.append(p)
-        return bbox
+        t = self.transform()
+        return [t.map(QPointF(p[0], p[1])) for p in points]
+
+    def transform(self):
+        t = QTransform()
+        t.translate(self.shift_x, self.shift_y)
+        t.translate(self.rotation_x, self.rotation_y)
+        t.rotate(self.rotation_angle)
+        t.translate(-self.rotation_x, -self.rotation_y)
+        return t
 
     def calculate_background_draw_path(self):
         path = QPainterPath()
@@ -412,7 +416,12 @@ class KeyboardWidget(QWidget):
         mask_font = qp.font()
         mask_font.setPointSize(round(mask_font.pointSize() * 0.8))
 
+        # only the keys in the area being repainted are drawn, see update_key()
+        dirty = event.rect()
+        partial = not dirty.contains(self.rect())
         for idx, key in enumerate(self.widgets):
+            if partial and not self.key_rect(key).intersects(dirty):
+                continue
             qp.save()
 
             qp.scale(self.scale, self.scale)
@@ -472,6 +481,24 @@ class KeyboardWidget(QWidget):
 
         qp.end()
 
+    def key_rect(self, key):
+        """ Area of the widget which `key` is painted in, including the selection outline """
+        r = key.paint_rect
+        margin = math.ceil(2 * self.scale)
+        return QRectF(r.x() * self.scale, r.y() * self.scale, r.width() * self.scale,
+                      r.height() * self.scale).toAlignedRect().adjusted(-margin, -margin, margin, margin)
+
+    def update_key(self, key):
+        """ Schedules a repaint of just `key` """
+        if key is not None:
+            self.update(self.key_rect(key))
+
+    def set_active_key(self, key, mask=False):
+        if (key, mask) != (self.active_key, self.active_mask):
+            self.update_key(self.active_key)
+            self.update_key(key)
+        self.active_key, self.active_mask = key, mask
+
     def minimumSizeHint(self):
         return QSize(self.width, self.height)
 
@@ -490,12 +517,11 @@ class KeyboardWidget(QWidget):
         if not self.enabled:
             return
 
-        self.active_key, self.active_mask = self.hit_test(ev.pos())
+        self.set_active_key(*self.hit_test(ev.pos()))
         if self.active_key is not None:
             self.clicked.emit()
         else:
             self.deselected.emit()
-        self.update()
 
     def resizeEvent(self, ev):
         if self.isEnabled():
@@ -507,16 +533,14 @@ class KeyboardWidget(QWidget):
         keys_looped = self.widgets + [self.widgets[0]]
         for x, key in enumerate(keys_looped):
             if key == self.active_key:
-                self.active_key = keys_looped[x + 1]
-                self.active_mask = False
+                self.set_active_key(keys_looped[x + 1])
                 self.clicked.emit()
                 return
 
     def deselect(self):
         if self.active_key is not None:
-            self.active_key = None
+            self.set_active_key(None)
             self.deselected.emit()
-            self.update()
 
     def event(self, ev):
         if not self.enabled:
@@ -0,0 +1,82 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+import time
+from collections import OrderedDict
+
+from PyQt5.QtCore import QTimer
+
+
+class WriteCoalescer:
+    """
+    Last-write-wins queue for device writes driven by sliders and spin boxes.
+
+    Every setting is identified by a key. The first write to a setting goes out right away; writes
+    to it within `interval` seconds of that one only replace its pending value, which is written
+    once the interval is over. Dragging a slider therefore sends a packet every `interval` at
+    most, and the value it was left at is always the last one written.
+
+        self.writes = WriteCoalescer()
+        self.writes.submit("rt_sensitivity", self.keyboard.apply_rt_sensitivity, value)
+
+    Pending writes should be flushed before the device they are meant for goes away.
+    """
+
+    DEFAULT_INTERVAL = 0.05
+
+    def __init__(self, interval=DEFAULT_INTERVAL, clock=time.monotonic):
+        self.interval = interval
+        self.clock = clock
+        # key -> (fn, args) of the latest write which wasn't performed yet
+        self.pending = OrderedDict()
+        # key -> when it was last written
+        self.written = dict()
+        self.timer = None
+
+        self.submitted = 0
+        self.performed = 0
+
+    def set_interval(self, interval):
+        self.interval = interval
+        self.poll()
+
+    def submit(self, key, fn, *args):
+        self.submitted += 1
+        self.pending[key] = (fn, args)
+        self.pending.move_to_end(key)
+        if self.clock() - self.written.get(key, float("-inf")) >= self.interval:
+            self.flush(key)
+        else:
+            self.schedule()
+
+    def poll(self):
+        """ Performs the pending writes whose interval is over """
+        now = self.clock()
+        for key in list(self.pending):
+            if now - self.written.get(key, float("-inf")) >= self.interval:
+                self.flush(key)
+        if self.pending:
+            self.schedule()
+
+    def flush(self, key=None):
+        """ Performs the pending write of `key` right away, or every pending write """
+        keys = list(self.pending) if key is None else [key]
+        for key in keys:
+            if key not in self.pending:
+                continue
+            fn, args = self.pending.pop(key)
+            self.written[key] = self.clock()
+            self.performed += 1
+            fn(*args)
+
+    def clear(self):
+        """ Drops pending writes without performing them """
+        self.pending.clear()
+
+    def schedule(self):
+        if self.timer is None:
+            self.timer = QTimer()
+            self.timer.setSingleShot(True)
+            self.timer.timeout.connect(self.poll)
+        if not self.timer.isActive():
+            now = self.clock()
+            due = min(self.written.get(key, now) + self.interval for key in self.pending)
+            self.timer.start(max(0, int((due - now) * 1000)))